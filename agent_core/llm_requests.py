@@ -0,0 +1,203 @@
+import asyncio
+import random
+import time
+from collections import deque
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+# Коды, после которых есть смысл повторить: таймаут, конфликт, лимит, сбой на стороне API
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMCallFailed(Exception):
+    """Запрос так и не удался: дедлайн вышел, попытки кончились или ошибка не временная"""
+
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+def is_transient(error):
+    if isinstance(error, (asyncio.TimeoutError, APITimeoutError, APIConnectionError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRY_STATUSES
+    return False
+
+
+def retry_after_seconds(error):
+    """Retry-After из ответа 429/503, если сервер его прислал"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except Exception:
+        return None
+
+
+class LatencyTracker:
+    """Задержки последних window запросов одного вида (модели) и счётчики исходов"""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.hedged = 0
+        self.hedge_wins = 0 # Дубликат ответил раньше оригинала
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": max(self.samples) if self.samples else None,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class LLMRequestPolicy:
+    """
+    Обёртка над запросом к модели:
+    - deadline_s — общий лимит на вызов вместе с повторами;
+    - attempt_timeout_s — лимит одной попытки;
+    - временные ошибки (сеть, 429, 5xx, таймаут попытки) повторяются с задержкой
+      "full jitter" (случайно от 0 до base * 2^n, не больше max_delay_s) или по Retry-After;
+    - hedge=True: если попытка дольше p90 по этой модели, параллельно уходит дубликат,
+      побеждает первый ответ, второй отменяется. До hedge_min_samples замеров не хеджируем.
+    Задержки и исходы копятся по ключу (модели) — см. stats().
+    """
+
+    def __init__(self, deadline_s=90, attempt_timeout_s=45, max_attempts=4, base_delay_s=0.5, max_delay_s=8,
+                 hedge=False, hedge_quantile=0.9, hedge_min_samples=20, window=200):
+        self.deadline_s = deadline_s
+        self.attempt_timeout_s = attempt_timeout_s
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.window = window
+        self.trackers = {}
+        self.last_call = None # {"attempts", "hedged", "hedge_won", "ms"} последнего вызова
+
+    def tracker(self, key):
+        if key not in self.trackers:
+            self.trackers[key] = LatencyTracker(self.window)
+        return self.trackers[key]
+
+    def stats(self):
+        return {key: tracker.stats() for key, tracker in self.trackers.items()}
+
+    async def call(self, make_request, key="default", discard=None):
+        """
+        make_request() — фабрика корутины одного запроса (на каждую попытку и дубликат
+        создаётся новая). Возвращает её результат или бросает LLMCallFailed.
+        discard(result) — корутина, освобождающая результат проигравшего запроса
+        (например, закрыть открытый поток), если он тоже успел завершиться.
+        """
+        tracker = self.tracker(key)
+        tracker.calls += 1
+        started = time.monotonic()
+        deadline = started + self.deadline_s
+        self.last_call = {"attempts": 0, "hedged": False, "hedge_won": False, "ms": None}
+        attempt = 0
+        last_error = None
+
+        while attempt < self.max_attempts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            attempt += 1
+            self.last_call["attempts"] = attempt
+            attempt_started = time.monotonic()
+            try:
+                result = await self._attempt(make_request, tracker, min(remaining, self.attempt_timeout_s), discard)
+            except Exception as e:
+                last_error = e
+                if isinstance(e, asyncio.TimeoutError):
+                    tracker.timeouts += 1
+                if not is_transient(e):
+                    break
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** (attempt - 1)))
+                if attempt < self.max_attempts and time.monotonic() + delay < deadline:
+                    tracker.retries += 1
+                    print(f"[LLM] {key}: attempt {attempt} failed ({type(e).__name__}), retry in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                break
+
+            tracker.samples.append(round((time.monotonic() - attempt_started) * 1000, 1))
+            self.last_call["ms"] = round((time.monotonic() - started) * 1000, 1)
+            return result
+
+        tracker.failures += 1
+        self.last_call["ms"] = round((time.monotonic() - started) * 1000, 1)
+        reason = f"{type(last_error).__name__}: {last_error}" if last_error else "deadline exceeded"
+        raise LLMCallFailed(f"LLM request failed after {attempt} attempt(s): {reason}", attempt)
+
+    async def _attempt(self, make_request, tracker, timeout, discard=None):
+        """Одна попытка (с дубликатом, если оригинал дольше p90)"""
+        hedge_after = None
+        if self.hedge and len(tracker.samples) >= self.hedge_min_samples:
+            hedge_after = tracker.percentile(self.hedge_quantile) / 1000
+
+        primary = asyncio.ensure_future(make_request())
+        if hedge_after is None or hedge_after >= timeout:
+            try:
+                return await asyncio.wait_for(primary, timeout)
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError(f"no response in {timeout:.1f}s")
+
+        tasks = [primary]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                tracker.hedged += 1
+                self.last_call["hedged"] = True
+                tasks.append(asyncio.ensure_future(make_request()))
+
+            deadline = time.monotonic() + timeout - hedge_after
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError(f"no response in {timeout:.1f}s")
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not primary:
+                            tracker.hedge_wins += 1
+                            self.last_call["hedge_won"] = True
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    # Оба ответа пришли в одном wait: второй результат тоже держит соединение
+                    try:
+                        await discard(task.result())
+                    except Exception:
+                        pass
@@ -1,18 +1,28 @@
 import os
 import json
+import time
+import asyncio
 from openai import AsyncOpenAI, OpenAIError
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 from dotenv import load_dotenv
+from agent_core.llm_requests import LLMRequestPolicy
 
 load_dotenv()
 
 class AIClient:
-    def __init__(self):
+    def __init__(self, request_policy: LLMRequestPolicy = None):
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             print("WARNING: OPENAI_API_KEY не найден в .env")
             
-        self.client = AsyncOpenAI(api_key=self.api_key)
+        # Повторы и таймауты — в LLMRequestPolicy; свои повторы SDK отключаем, чтобы не умножались
+        self.client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        self.requests = request_policy or LLMRequestPolicy()
+        self.last_error = None # Почему не удался последний запрос (для лога)
         self.model = "gpt-5.1" # Новая флагманская модель
+        # usage последнего ответа и суммарно за жизнь клиента (для логов и кэша префикса)
+        self.last_usage = None
+        self.usage_totals = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
 
         self.tools = [
             {
@@ -37,7 +47,7 @@ class AIClient:
                     "parameters": {
                         "type": "object",
                         "properties": {
-                            "element_id": {"type": "integer", "description": "ID элемента"}
+                            "element_id": {"type": "string", "description": "ID элемента из снимка: \"12\" или \"2:7\" (элемент во фрейме 2)"}
                         },
                         "required": ["element_id"]
                     }
@@ -51,7 +61,7 @@ class AIClient:
                     "parameters": {
                         "type": "object",
                         "properties": {
-                            "element_id": {"type": "integer", "description": "ID элемента"},
+                            "element_id": {"type": "string", "description": "ID элемента из снимка: \"12\" или \"2:7\" (элемент во фрейме 2)"},
                             "text": {"type": "string", "description": "Текст для ввода"}
                         },
                         "required": ["element_id", "text"]
@@ -76,10 +86,27 @@ class AIClient:
                 "type": "function",
                 "function": {
                     "name": "read_visible_text",
-                    "description": "Прочитать весь видимый текст на странице. Полезно для чтения списков писем, статей или результатов поиска без кликов.",
+                    "description": "Прочитать текст страницы (по умолчанию основное содержимое, без меню и подвала). Длинный текст отдаётся частями. Полезно для чтения списков писем, статей или результатов поиска без кликов.",
                     "parameters": {
                         "type": "object",
-                        "properties": {}, 
+                        "properties": {
+                            "page": {"type": "integer", "description": "Номер части текста, начиная с 1"},
+                            "full_page": {"type": "boolean", "description": "Весь видимый текст страницы, включая навигацию и подвал"}
+                        },
+                    }
+                }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "find_elements",
+                    "description": "Найти интерактивные элементы, которых нет в снимке (он показывает только самые подходящие к задаче). С query — поиск по словам среди всех элементов страницы, без query — оставшиеся элементы по порядку, постранично.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "query": {"type": "string", "description": "Слова для поиска в тексте элементов"},
+                            "page": {"type": "integer", "description": "Номер страницы результатов, начиная с 1"}
+                        },
                     }
                 }
             },
@@ -101,11 +128,11 @@ class AIClient:
                 "type": "function",
                 "function": {
                     "name": "wait",
-                    "description": "Подождать указанное количество секунд. ИСПОЛЬЗУЙ ОБЯЗАТЕЛЬНО после кликов, которые открывают новые страницы или меняют интерфейс (фильтры, вход).",
+                    "description": "Подождать, пока страница догрузится (не дольше указанного числа секунд). После каждого действия браузер и так ждёт стабилизации страницы, поэтому вызывай только если контент явно ещё грузится. Если страница уже спокойна, возвращается сразу.",
                     "parameters": {
                         "type": "object",
                         "properties": {
-                            "seconds": {"type": "integer", "description": "Время ожидания в секундах (обычно 3-5)"}
+                            "seconds": {"type": "integer", "description": "Максимальное время ожидания в секундах (обычно 3-5)"}
                         },
                         "required": ["seconds"]
                     }
@@ -140,14 +167,138 @@ class AIClient:
 
     async def get_next_action(self, history, model_override=None):
         current_model = model_override if model_override else self.model
+        self.last_usage = None
+        self.last_error = None
         try:
-            response = await self.client.chat.completions.create(
-                model=current_model,
-                messages=history,
-                tools=self.tools,
-                tool_choice="auto"
+            response = await self.requests.call(
+                lambda: self.client.chat.completions.create(
+                    model=current_model,
+                    messages=history,
+                    tools=self.tools,
+                    tool_choice="auto"
+                ),
+                key=current_model
             )
+            self._record_usage(response.usage)
             return response.choices[0].message
         except Exception as e:
+            self.last_error = str(e)
             print(f"OpenAI API Error: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    async def stream_next_action(self, history, model_override=None, on_text=None, on_tool_call=None):
+        """
+        Потоковый вариант get_next_action. Текст ассистента отдаётся в on_text(delta)
+        по мере прихода, а каждый полностью собранный вызов инструмента — в
+        on_tool_call(tool_call) сразу, не дожидаясь конца сообщения.
+        Возвращает итоговое сообщение (как get_next_action) или None при ошибке.
+
+        Повторы и дубликат (hedge) — только до первого чанка: после него
+        инструменты уже могли уйти в исполнение. Остаток потока ограничен
+        тем же общим дедлайном.
+        """
+        current_model = model_override if model_override else self.model
+        content_parts = []
+        calls = {} # index -> {"id", "name", "arguments"}
+        current_index = None
+        self.last_usage = None
+        self.last_error = None
+
+        def dispatch(index):
+            if on_tool_call:
+                on_tool_call(self._build_tool_call(calls[index]))
+
+        async def read_stream(chunks, chunk):
+            nonlocal current_index
+            while chunk is not None:
+                # usage приходит последним чанком, без choices
+                if chunk.usage:
+                    self._record_usage(chunk.usage)
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+
+                    if delta.content:
+                        content_parts.append(delta.content)
+                        if on_text: on_text(delta.content)
+
+                    for tc in delta.tool_calls or []:
+                        if tc.index not in calls:
+                            # Начался следующий вызов — значит предыдущий полностью собран
+                            if current_index is not None:
+                                dispatch(current_index)
+                            calls[tc.index] = {"id": "", "name": "", "arguments": ""}
+                            current_index = tc.index
+                        entry = calls[tc.index]
+                        if tc.id: entry["id"] = tc.id
+                        if tc.function:
+                            if tc.function.name: entry["name"] += tc.function.name
+                            if tc.function.arguments: entry["arguments"] += tc.function.arguments
+                chunk = await anext(chunks, None)
+
+        started = time.monotonic()
+        stream = None
+        try:
+            stream, chunks, first_chunk = await self.requests.call(
+                lambda: self._open_stream(current_model, history), key=current_model,
+                discard=lambda opened: opened[0].close()
+            )
+            remaining = self.requests.deadline_s - (time.monotonic() - started)
+            # Остаток потока — в пределах общего дедлайна (wait_for, а не asyncio.timeout: нужен Python 3.10)
+            await asyncio.wait_for(read_stream(chunks, first_chunk), max(remaining, 0))
+
+            if current_index is not None:
+                dispatch(current_index)
+        except Exception as e:
+            self.last_error = str(e) or type(e).__name__
+            print(f"OpenAI API Error: {self.last_error}")
+            if stream:
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+            return None
+
+        return ChatCompletionMessage(
+            role="assistant",
+            content="".join(content_parts) or None,
+            tool_calls=[self._build_tool_call(calls[i]) for i in sorted(calls)] or None
+        )
+
+    async def _open_stream(self, model, history):
+        """Открывает поток и ждёт первый чанк: это и есть задержка, которую стоит хеджировать"""
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=history,
+            tools=self.tools,
+            tool_choice="auto",
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        chunks = stream.__aiter__()
+        try:
+            first_chunk = await anext(chunks, None)
+        except asyncio.CancelledError:
+            await stream.close() # Проиграл дубликату или вышел таймаут
+            raise
+        return stream, chunks, first_chunk
+
+    def _record_usage(self, usage):
+        self.last_usage = usage
+        if not usage:
+            return
+        self.usage_totals["prompt_tokens"] += usage.prompt_tokens
+        self.usage_totals["cached_tokens"] += self.cached_tokens(usage)
+        self.usage_totals["completion_tokens"] += usage.completion_tokens
+
+    @staticmethod
+    def cached_tokens(usage):
+        details = getattr(usage, "prompt_tokens_details", None)
+        return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+    @staticmethod
+    def _build_tool_call(entry):
+        return ChatCompletionMessageToolCall.model_validate({
+            "id": entry["id"],
+            "type": "function",
+            "function": {"name": entry["name"], "arguments": entry["arguments"]}
+        })
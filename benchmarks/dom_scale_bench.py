@@ -0,0 +1,372 @@
+"""
+Как чтение DOM масштабируется с размером страницы: синтетические страницы
+от 100 до 100 000 интерактивных элементов (вложенные списки, таблицы, карточки
+в shadow root, iframe с формами, навигация и подвал).
+
+    python -m benchmarks.dom_scale_bench                          # замер и сравнение с базовой линией
+    python -m benchmarks.dom_scale_bench --save-baseline          # записать результат как базовую линию
+    python -m benchmarks.dom_scale_bench --sizes 100,1000 --runs 5 --top-k 150
+    python -m benchmarks.dom_scale_bench --static                 # без браузера: только форматирование в Python
+    python -m benchmarks.dom_scale_bench --static --runs 30 --max-regression 100 --save-baseline  # так записана линия в репозитории
+
+Для каждого размера (медиана по runs):
+- script_ms / read_ms / write_ms — время DomService.get_accessibility_tree_script() внутри
+  страницы (только главный фрейм, как у скрипта);
+- legacy_ms — то же для прежнего скрипта (get_legacy_accessibility_tree_script: чтения и
+  записи вперемешку, без shadow root) — до/после пакетирования чтений и записей;
+- evaluate_ms — page.evaluate целиком, transfer_ms = evaluate_ms - script_ms
+  (сериализация результата и передача по CDP), payload_kb — размер результата в JSON;
+- snapshot_ms — BrowserDriver.get_page_content() целиком (все фреймы, трекер),
+  driver_evaluate_ms и format_ms — его части: скрипт во фреймах и сборка текста в Python;
+- output_chars / tokens — размер слепка для модели (tiktoken или "символы / 4").
+
+Базовая линия — benchmarks/baselines/dom_scale.json; сравнивается только с замером
+в том же режиме (браузер/--static) и с тем же --top-k. В репозитории лежит только линия
+для --static (30 прогонов): в ней нет script_ms, transfer_ms и payload_kb. Браузерную
+запишите --save-baseline на своей машине (она заменит файл).
+
+Допуск на время хранится в самой линии (meta.max_regression, задаётся --max-regression
+при --save-baseline; по умолчанию 25%); для размеров (payload_kb, output_chars, tokens)
+он всегда 5%. Регрессия — рост больше допуска и больше порога шума из COMPARED.
+Для --static допуск 100%: медиана format_ms на одной машине между запусками по
+30 прогонов гуляет в 1,5-2 раза, так что ловится только замедление вдвое и больше,
+а размеры слепка детерминированы и проверяются строго.
+Shadow root объявлены декларативно (<template shadowrootmode="open">) — нужен Chromium 124+.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.snapshot_tokens import count_tokens, _ENCODING
+from browser_controller.driver import BrowserDriver
+from page_perception.dom_service import DomService
+
+# Прежний скрипт не отдаёт своё время — замеряем его в странице обёрткой
+LEGACY_TIMED_JS = """
+() => {
+    const collect = """ + DomService.get_legacy_accessibility_tree_script() + """;
+    const started = performance.now();
+    const items = collect();
+    return {ms: performance.now() - started, count: items.length};
+}
+"""
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "dom_scale.json")
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+DEFAULT_MAX_REGRESSION = 25 # %, если в базовой линии допуск не записан
+# Что сравниваем с базовой линией и минимальная разница, которую считаем не шумом
+COMPARED = {
+    "script_ms": 2.0, "transfer_ms": 2.0, "snapshot_ms": 5.0, "format_ms": 1.0,
+    "payload_kb": 1.0, "output_chars": 100, "tokens": 25,
+}
+# Размеры не шумят, как время: для них допуск свой и строгий
+SIZE_METRICS = {"payload_kb", "output_chars", "tokens"}
+SIZE_MAX_REGRESSION = 5 # %
+
+
+class SyntheticPage:
+    """
+    HTML страницы примерно на count интерактивных элементов и её iframe.
+    items — что должен найти сборщик (для --static и сверки с браузером).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.items = []
+        self.frames = [] # HTML каждого iframe
+
+    def _element(self, html, tag, text, type_="", role="", landmark=""):
+        self.items.append({
+            "id": len(self.items) + 1, "tagName": tag, "text": text, "type": type_, "role": role, "landmark": landmark,
+        })
+        return html
+
+    def _link(self, text, landmark):
+        return self._element(f'<a href="#{len(self.items)}">{text}</a>', "a", text, landmark=landmark)
+
+    def _button(self, text, landmark):
+        return self._element(f"<button>{text}</button>", "button", text, landmark=landmark)
+
+    def _checkbox(self, label, landmark):
+        return self._element(f'<input type="checkbox" aria-label="{label}">', "input", label, "checkbox", landmark=landmark)
+
+    def build(self):
+        count = self.count
+        links = max(count // 50, 3) # Шапка и подвал: по 2% элементов
+        frames = 1 if count < 1000 else 2 if count < 10000 else 4
+        budget = count - 2 * links
+        lists, table, shadow = int(budget * 0.45), int(budget * 0.30), int(budget * 0.15)
+        framed = budget - lists - table - shadow
+
+        parts = ["<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Synthetic page</title>",
+                 "<style>ul ul { margin-left: 16px } td { padding: 2px 6px } product-card { display: block }</style>",
+                 "</head><body>"]
+        parts.append("<header><nav><ul>")
+        parts.extend(f"<li>{self._link(f'Раздел {i}', 'nav')}</li>" for i in range(links))
+        parts.append("</ul></nav></header><main>")
+
+        # Вложенные списки: категория -> товар -> действия (3 элемента на товар)
+        parts.append("<h2>Каталог</h2><ul>")
+        product = 0
+        while product * 3 < lists:
+            if product % 10 == 0:
+                parts.append(f"<li>Категория {product // 10 + 1}<ul>")
+            parts.append(f"<li>{self._link(f'Товар {product + 1}', 'main')}<ul>"
+                         f"<li>{self._button('В корзину', 'main')}</li><li>{self._link('Сравнить', 'main')}</li></ul></li>")
+            product += 1
+            if product % 10 == 0:
+                parts.append("</ul></li>")
+        if product % 10:
+            parts.append("</ul></li>")
+        parts.append("</ul>")
+
+        # Таблица: строка — флажок, ссылка и кнопка
+        parts.append("<h2>Заказы</h2><table><tbody>")
+        for row in range(table // 3):
+            parts.append(f"<tr><td>{row + 1}</td><td>{self._checkbox(f'Выбрать заказ {row + 1}', 'main')}</td>"
+                         f"<td>{self._link('Открыть', 'main')}</td><td>{self._button('Удалить', 'main')}</td></tr>")
+        parts.append("</tbody></table>")
+
+        # Карточки в открытом shadow root
+        parts.append("<h2>Рекомендации</h2>")
+        for card in range(shadow // 2):
+            parts.append(f'<product-card><template shadowrootmode="open">'
+                         f"{self._button('Купить', 'main')}{self._link(f'Подробнее о предложении {card + 1}', 'main')}"
+                         f"</template></product-card>")
+
+        # iframe с формами: поле и кнопка на запись
+        per_frame = framed // frames
+        for index in range(frames):
+            rows = []
+            for field in range(per_frame // 2):
+                placeholder = f"Поле {index + 1}.{field + 1}"
+                rows.append(self._element(f'<p><input placeholder="{placeholder}">', "input", placeholder, landmark="form"))
+                rows.append(self._button("Сохранить", "form") + "</p>")
+            self.frames.append("<!DOCTYPE html><html><head><meta charset=\"utf-8\"></head><body><form>"
+                               + "".join(rows) + "</form></body></html>")
+            parts.append(f'<iframe src="FRAME_{index}" width="600" height="300"></iframe>')
+
+        parts.append("</main><footer>")
+        parts.extend(self._link(f"Справка {i}", "footer") + " " for i in range(links))
+        parts.append("</footer></body></html>")
+        return "".join(parts)
+
+    def write(self, directory):
+        """Пишет страницу и её фреймы в directory; возвращает путь к странице"""
+        html = self.build()
+        name = f"page-{self.count}"
+        for index, frame_html in enumerate(self.frames):
+            frame_name = f"{name}-frame-{index}.html"
+            with open(os.path.join(directory, frame_name), "w", encoding="utf-8") as f:
+                f.write(frame_html)
+            html = html.replace(f'src="FRAME_{index}"', f'src="{frame_name}"')
+        path = os.path.join(directory, name + ".html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(html)
+        return path
+
+
+def median_row(rows):
+    """Медиана по прогонам для каждого числового поля"""
+    result = dict(rows[0])
+    for key, value in rows[0].items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, int):
+            # Счётчики остаются целыми и при чётном числе прогонов
+            result[key] = statistics.median_low(row[key] for row in rows)
+        elif isinstance(value, float):
+            result[key] = round(statistics.median(row[key] for row in rows), 2)
+    return result
+
+
+def measure_static(page, runs, top_k):
+    """Без браузера: только сборка текста слепка в Python на ожидаемых элементах"""
+    driver = BrowserDriver(max_elements=top_k)
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        content = "\n".join(driver.format_full_snapshot(page.items)) + "\n"
+        samples.append({
+            "format_ms": round((time.perf_counter() - started) * 1000, 2),
+            "output_chars": len(content),
+            "tokens": count_tokens(content),
+        })
+    return samples
+
+
+async def measure_browser(driver, path, runs, goto_timeout_ms):
+    url = "file://" + os.path.abspath(path)
+    samples = []
+    for _ in range(runs):
+        # Каждый прогон — на свежем документе: без data-agent-id и трекера от прошлого
+        await driver.page.goto(url, wait_until="load", timeout=goto_timeout_ms)
+        started = time.perf_counter()
+        result = await driver.page.evaluate(DomService.get_accessibility_tree_script(), {"viewportMargin": None})
+        evaluate_ms = (time.perf_counter() - started) * 1000
+        timing = result["timing"]
+
+        await driver.page.goto(url, wait_until="load", timeout=goto_timeout_ms)
+        legacy = await driver.page.evaluate(LEGACY_TIMED_JS)
+
+        await driver.page.goto(url, wait_until="load", timeout=goto_timeout_ms)
+        started = time.perf_counter()
+        content = await driver.get_page_content()
+        snapshot_ms = (time.perf_counter() - started) * 1000
+        if content.startswith("Error reading DOM"):
+            raise RuntimeError(content.strip())
+        snapshot_timing = driver.last_snapshot_timing
+
+        samples.append({
+            "elements": driver.last_snapshot_elements,
+            "main_elements": len(result["items"]),
+            "frames": snapshot_timing["frames"],
+            "shadow_roots": timing.get("shadowRoots", 0),
+            "script_ms": round(timing["totalMs"], 2),
+            "read_ms": round(timing["readMs"], 2),
+            "write_ms": round(timing["writeMs"], 2),
+            "legacy_ms": round(legacy["ms"], 2),
+            "evaluate_ms": round(evaluate_ms, 2),
+            "transfer_ms": round(evaluate_ms - timing["totalMs"], 2),
+            "payload_kb": round(len(json.dumps(result, ensure_ascii=False).encode("utf-8")) / 1024, 1),
+            "snapshot_ms": round(snapshot_ms, 2),
+            "driver_evaluate_ms": snapshot_timing["evaluateMs"],
+            "format_ms": snapshot_timing["formatMs"],
+            "output_chars": len(content),
+            "tokens": count_tokens(content),
+        })
+    return samples
+
+
+async def run(sizes, runs, top_k, static, fixtures_dir, goto_timeout_ms):
+    rows = []
+    meta = {"mode": "static" if static else "browser", "top_k": top_k, "runs": runs,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "tokens": "tiktoken o200k_base" if _ENCODING else "chars/4", "date": time.strftime("%Y-%m-%d")}
+    driver = None
+    if not static:
+        driver = BrowserDriver(max_elements=top_k, state_file=os.path.join(fixtures_dir, "state.json"))
+        await driver.start_browser(headless=True)
+        meta["browser"] = driver.browser.version
+    try:
+        for size in sizes:
+            page = SyntheticPage(size)
+            path = page.write(fixtures_dir)
+            row = {"size": size, "expected": len(page.items), "html_kb": round(os.path.getsize(path) / 1024, 1)}
+            if static:
+                samples = measure_static(page, runs, top_k)
+            else:
+                samples = await measure_browser(driver, path, runs, goto_timeout_ms)
+            row.update(median_row(samples))
+            rows.append(row)
+            print(f"[dom_scale] {size}: done", file=sys.stderr)
+    finally:
+        if driver:
+            await driver.close()
+    return {"meta": meta, "rows": rows}
+
+
+def print_report(result):
+    rows = result["rows"]
+    columns = [column for column in (
+        "size", "expected", "elements", "frames", "html_kb", "script_ms", "read_ms", "write_ms", "legacy_ms",
+        "transfer_ms",
+        "payload_kb", "snapshot_ms", "format_ms", "output_chars", "tokens",
+    ) if column in rows[0]]
+    print("  ".join(f"{column:>12}" for column in columns))
+    for row in rows:
+        print("  ".join(f"{str(row[column]):>12}" for column in columns))
+    meta = result["meta"]
+    print(f"(медианы по {meta['runs']} прогон(ам), режим {meta['mode']}, top_k={meta['top_k']}, токены: {meta['tokens']})")
+
+
+def compare(result, baseline, max_regression_pct):
+    """Печатает отличия от базовой линии; возвращает список регрессий"""
+    if (baseline["meta"]["mode"], baseline["meta"]["top_k"]) != (result["meta"]["mode"], result["meta"]["top_k"]):
+        print(f"Baseline is for mode={baseline['meta']['mode']}, top_k={baseline['meta']['top_k']}: not comparable")
+        return []
+    print(f"\nСравнение с базовой линией от {baseline['meta']['date']} ({baseline['meta'].get('browser', 'без браузера')}, "
+          f"допуск {max_regression_pct:g}%):")
+    old_rows = {row["size"]: row for row in baseline["rows"]}
+    regressions = []
+    for row in result["rows"]:
+        old = old_rows.get(row["size"])
+        if not old:
+            continue
+        changes = []
+        for metric, noise in COMPARED.items():
+            if metric not in row or metric not in old:
+                continue
+            delta = row[metric] - old[metric]
+            pct = delta * 100 / old[metric] if old[metric] else 0
+            mark = ""
+            limit = SIZE_MAX_REGRESSION if metric in SIZE_METRICS else max_regression_pct
+            if pct > limit and delta > noise:
+                mark = " !"
+                regressions.append(f"{row['size']}: {metric} {old[metric]} -> {row[metric]} ({pct:+.0f}%)")
+            changes.append(f"{metric} {pct:+.0f}%{mark}")
+        print(f"  {row['size']:>7}: " + ", ".join(changes))
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="DOM extraction scaling on synthetic pages, compared to a baseline")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Interactive elements per page")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=None, help="BrowserDriver max_elements (default: all)")
+    parser.add_argument("--static", action="store_true", help="No browser: Python formatting only")
+    parser.add_argument("--fixtures-dir", help="Keep generated pages here (default: temp dir)")
+    parser.add_argument("--goto-timeout", type=float, default=120, help="Page load timeout, seconds")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--max-regression", type=float,
+                        help="Percent slower/larger that counts as regression (default: from the baseline, else 25)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with code 1 on regressions")
+    parser.add_argument("--out", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+
+    if args.fixtures_dir:
+        os.makedirs(args.fixtures_dir, exist_ok=True)
+        result = await run(sizes, args.runs, args.top_k, args.static, args.fixtures_dir, args.goto_timeout * 1000)
+    else:
+        with tempfile.TemporaryDirectory(prefix="dom-scale-") as fixtures_dir:
+            result = await run(sizes, args.runs, args.top_k, args.static, fixtures_dir, args.goto_timeout * 1000)
+    print_report(result)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        result["meta"]["max_regression"] = DEFAULT_MAX_REGRESSION if args.max_regression is None else args.max_regression
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}: run with --save-baseline to create one")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    max_regression = args.max_regression
+    if max_regression is None:
+        max_regression = baseline["meta"].get("max_regression", DEFAULT_MAX_REGRESSION)
+    regressions = compare(result, baseline, max_regression)
+    if regressions:
+        print("Regressions:\n  " + "\n  ".join(regressions))
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Строка слепка: "[12] button 'Найти'", "[5-8,12] button 'В корзину'" или "[2:7] button 'Оплатить'"
+# (элемент во фрейме; в дельтах с префиксом "+ " или "~ "); группа отдаёт первый id.
+# Строки "[31] =5" пропускаем: текст есть у [5] выше.
+ELEMENT_LINE = re.compile(r"^(?:[+~] )?\[((?:\d+:)?\d+)[\d,:-]*\] \S+ '(.*)'$")
+
+
+class ScriptedLLM:
+    """
+    Подмена OpenAI chat completions для офлайн-замеров: на каждый запрос
+    отдаёт следующий шаг сценария. Шаг — список вызовов инструментов;
+    вместо element_id можно указать "target" (подстроку текста элемента),
+    и id будет найден в последнем слепке страницы из запроса.
+    """
+
+    def __init__(self, latency_ms=0, chunk_delay_ms=0, model_latency_ms=None):
+        self.latency_ms = latency_ms # Имитация "думания" модели до первого токена
+        self.model_latency_ms = dict(model_latency_ms or {}) # Своя задержка для отдельных моделей
+        self.chunk_delay_ms = chunk_delay_ms # Пауза между чанками в потоковом режиме
+        self.steps = []
+        self.requests = [] # Размер каждого запроса, для отчёта
+        self._previous_prompt = ""
+        self._lock = threading.Lock()
+        self._call_ids = 0
+
+    def load(self, steps):
+        with self._lock:
+            self.steps = list(steps)
+            self.requests = []
+            self._previous_prompt = ""
+
+    def latency_for(self, model):
+        return self.model_latency_ms.get(model, self.latency_ms)
+
+    def next_response(self, body):
+        messages = body.get("messages", [])
+        prompt = json.dumps(messages, ensure_ascii=False)
+        with self._lock:
+            # Кэш префикса как у провайдера: общая часть с прошлым запросом
+            common = 0
+            for a, b in zip(prompt, self._previous_prompt):
+                if a != b:
+                    break
+                common += 1
+            self._previous_prompt = prompt
+            step = self.steps.pop(0) if self.steps else [
+                {"name": "task_complete", "args": {"summary": "Script exhausted"}}
+            ]
+
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": 20 * len(step),
+            "total_tokens": len(prompt) // 4 + 20 * len(step),
+            "prompt_tokens_details": {"cached_tokens": common // 4},
+        }
+        self.requests.append({"prompt_chars": len(prompt), "messages": len(messages)})
+
+        tool_calls = []
+        for action in step:
+            args = dict(action.get("args", {}))
+            if "target" in action:
+                args["element_id"] = self._resolve(messages, action["target"])
+            self._call_ids += 1
+            tool_calls.append({
+                "id": f"call_{self._call_ids}",
+                "type": "function",
+                "function": {"name": action["name"], "arguments": json.dumps(args, ensure_ascii=False)},
+            })
+        return tool_calls, usage
+
+    @staticmethod
+    def _resolve(messages, target):
+        """Ищет id элемента по тексту, начиная с самого свежего слепка"""
+        for message in reversed(messages):
+            content = message.get("content")
+            # Слепки страницы и ответы find_elements (элементы, не попавшие в слепок)
+            if not content or not content.startswith(("Current URL:", "Elements ")):
+                continue
+            for line in content.split("\n"):
+                match = ELEMENT_LINE.match(line)
+                if match and target in match.group(2):
+                    element_id = match.group(1)
+                    return element_id if ":" in element_id else int(element_id)
+        return -1
+
+
+class FakeLLMServer:
+    """HTTP-сервер с эндпоинтом /v1/chat/completions (обычный и потоковый ответ)"""
+
+    def __init__(self, llm: ScriptedLLM, host="127.0.0.1", port=0):
+        self.llm = llm
+        handler = self._make_handler(llm)
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def _make_handler(llm):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                tool_calls, usage = llm.next_response(body)
+                time.sleep(llm.latency_for(body.get("model")) / 1000)
+                if body.get("stream"):
+                    self._stream(body, tool_calls, usage)
+                else:
+                    self._send_json({
+                        "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                        "model": body.get("model", "fake"),
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": None, "tool_calls": tool_calls},
+                            "finish_reason": "tool_calls",
+                        }],
+                        "usage": usage,
+                    })
+
+            def _send_json(self, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body, tool_calls, usage):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                def chunk(delta=None, finish=None, usage_payload=None):
+                    payload = {
+                        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model", "fake"),
+                        "choices": [] if usage_payload else [{"index": 0, "delta": delta or {}, "finish_reason": finish}],
+                    }
+                    if usage_payload:
+                        payload["usage"] = usage_payload
+                    self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(llm.chunk_delay_ms / 1000)
+
+                for index, call in enumerate(tool_calls):
+                    chunk({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                           "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                    chunk({"tool_calls": [{"index": index, "function": {"arguments": call["function"]["arguments"]}}]})
+                chunk({}, finish="tool_calls")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    chunk(usage_payload=usage)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
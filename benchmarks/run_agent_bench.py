@@ -0,0 +1,188 @@
+"""
+Офлайн-замер цикла агента: Orchestrator + настоящий Chromium на локальных
+HTML-фикстурах + подменённый OpenAI (benchmarks/fake_llm.py) со скриптом действий.
+
+    python -m benchmarks.run_agent_bench
+    python -m benchmarks.run_agent_bench --scenario inbox --no-stream --out bench.json
+    python -m benchmarks.run_agent_bench --trace traces/   # открыть в ui.perfetto.dev
+    python -m benchmarks.run_agent_bench --route --cheap-latency-ms 120
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fake_llm import ScriptedLLM, FakeLLMServer
+from orchestrator.model_router import CHEAP_MODEL
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Шаг сценария — то, что "модель" вернёт в одном ответе. {base} — адрес сервера фикстур.
+SCENARIOS = {
+    "search": {
+        "task": "Найди playwright в поиске и открой первый результат",
+        "steps": [
+            [{"name": "navigate", "args": {"url": "{base}/search.html"}}],
+            [{"name": "type_text", "target": "Поиск", "args": {"text": "playwright"}},
+             {"name": "press_key", "args": {"key": "Enter"}}],
+            [{"name": "click_element", "target": "Результат 1"}],
+            [{"name": "read_visible_text"}],
+            [{"name": "task_complete", "args": {"summary": "Открыт первый результат"}}],
+        ],
+    },
+    "inbox": {
+        "task": "Удали рекламные письма",
+        "steps": [
+            [{"name": "navigate", "args": {"url": "{base}/inbox.html"}}],
+            [{"name": "read_visible_text"}],
+            [{"name": "click_element", "target": "Выбрать письмо 7"},
+             {"name": "click_element", "target": "Выбрать письмо 14"},
+             {"name": "click_element", "target": "Выбрать письмо 21"}],
+            [{"name": "click_element", "target": "Удалить"}],
+            [{"name": "task_complete", "args": {"summary": "Удалено 3 письма"}}],
+        ],
+    },
+    "catalog": {
+        "task": "Добавь в корзину товары 1, 2 и 3",
+        "steps": [
+            [{"name": "navigate", "args": {"url": "{base}/catalog.html"}}],
+            [{"name": "click_element", "target": "В корзину"}],
+            [{"name": "click_element", "target": "В корзину"}],
+            [{"name": "click_element", "target": "В корзину"}],
+            [{"name": "wait", "args": {"seconds": 2}}],
+            [{"name": "task_complete", "args": {"summary": "3 товара в корзине"}}],
+        ],
+    },
+}
+
+
+def start_fixture_server():
+    handler = functools.partial(QuietHandler, directory=FIXTURES_DIR)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def expand(steps, base):
+    expanded = []
+    for step in steps:
+        actions = []
+        for action in step:
+            action = dict(action)
+            action["args"] = {
+                key: value.replace("{base}", base) if isinstance(value, str) else value
+                for key, value in action.get("args", {}).items()
+            }
+            actions.append(action)
+        expanded.append(actions)
+    return expanded
+
+
+async def run_scenario(name, scenario, llm, base, stream, headless, trace_dir=None, lightweight=False, route=False,
+                       top_k=None):
+    # Импорты здесь: AIClient читает OPENAI_BASE_URL при создании клиента
+    from browser_controller.driver import BrowserDriver
+    from orchestrator.engine import Orchestrator
+    from browser_controller.resource_policy import ResourcePolicy
+    from orchestrator.model_router import ModelRouter
+
+    llm.load(expand(scenario["steps"], base))
+    driver = BrowserDriver(
+        state_file=os.path.join("user_data", "bench_state.json"),
+        resource_policy=ResourcePolicy() if lightweight else None,
+        max_elements=top_k
+    )
+    await driver.start_browser(headless=headless)
+    try:
+        orchestrator = Orchestrator(
+            driver, lambda *args: None, stream=stream,
+            trace_dir=os.path.join(trace_dir, name) if trace_dir else None,
+            router=ModelRouter() if route else None
+        )
+        started = time.perf_counter()
+        outcome = await orchestrator.process_task(scenario["task"])
+        total_ms = (time.perf_counter() - started) * 1000
+    finally:
+        await driver.close()
+
+    return {
+        "scenario": name,
+        "stream": stream,
+        "status": outcome["status"],
+        "total_ms": round(total_ms, 1),
+        "startup": driver.startup_timing,
+        "steps": orchestrator.step_metrics,
+        "resources": driver.resource_policy.stats() if driver.resource_policy else None,
+        "models": orchestrator.router.stats() if orchestrator.router else None,
+        "llm_requests": orchestrator.ai.requests.stats(),
+    }
+
+
+def print_report(result):
+    print(f"\n== {result['scenario']} ({'stream' if result['stream'] else 'blocking'}): "
+          f"{result['status']}, {result['total_ms'] / 1000:.2f}s")
+    columns = ["step", "model", "dom_ms", "llm_ms", "tools_ms", "settle_ms", "snapshot_chars", "prompt_tokens", "cached_tokens"]
+    print("  ".join(f"{column:>14}" for column in columns))
+    for step in result["steps"]:
+        print("  ".join(f"{str(step[column]):>14}" for column in columns))
+    totals = {column: sum(step[column] or 0 for step in result["steps"]) for column in columns[2:]}
+    print("  ".join([f"{'total':>14}", f"{'':>14}"] + [f"{round(totals[column], 1):>14}" for column in columns[2:]]))
+    for model, stats in (result["models"] or {}).items():
+        print(f"  {model}: {stats['calls']} calls, median {stats['median_latency_ms']} ms, "
+              f"p90 {stats['p90_latency_ms']} ms, cost {stats['cost_usd']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline agent loop benchmark")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument("--no-stream", action="store_true", help="Use blocking LLM responses")
+    parser.add_argument("--latency-ms", type=int, default=300, help="Simulated LLM latency per step")
+    parser.add_argument("--headful", action="store_true")
+    parser.add_argument("--out", help="Write results as JSON to this file")
+    parser.add_argument("--lightweight", action="store_true", help="Block images, media, fonts and ad domains")
+    parser.add_argument("--route", action="store_true", help="Route routine steps to a cheap model (ModelRouter)")
+    parser.add_argument("--cheap-latency-ms", type=int, help="Simulated latency of the cheap model (default: --latency-ms)")
+    parser.add_argument("--top-k", type=int, help="Send only the K most task-relevant elements per snapshot")
+    parser.add_argument("--trace", metavar="DIR", help="Save per-scenario traces (Chrome trace + JSONL) here")
+    args = parser.parse_args()
+
+    fixtures = start_fixture_server()
+    base = f"http://127.0.0.1:{fixtures.server_address[1]}"
+    model_latency = {}
+    if args.cheap_latency_ms is not None:
+        model_latency[CHEAP_MODEL] = args.cheap_latency_ms
+    llm = ScriptedLLM(latency_ms=args.latency_ms, model_latency_ms=model_latency)
+    server = FakeLLMServer(llm).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+
+    results = []
+    try:
+        for name in args.scenario or sorted(SCENARIOS):
+            result = await run_scenario(name, SCENARIOS[name], llm, base,
+                                        stream=not args.no_stream, headless=not args.headful,
+                                        trace_dir=args.trace, lightweight=args.lightweight, route=args.route,
+                                        top_k=args.top_k)
+            print_report(result)
+            results.append(result)
+    finally:
+        server.stop()
+        fixtures.shutdown()
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+"""
+Сколько токенов занимает слепок страницы: прежняя запись (строка на элемент)
+против компактной (page_perception/snapshot_format) на HTML-фикстурах.
+
+    python -m benchmarks.snapshot_tokens            # элементы собирает настоящий Chromium
+    python -m benchmarks.snapshot_tokens --static   # без браузера: разбор HTML (приближённо)
+
+Токены считает tiktoken (o200k_base), если он установлен; иначе — оценка "символы / 4".
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+from html.parser import HTMLParser
+
+from benchmarks.run_agent_bench import FIXTURES_DIR
+from page_perception.snapshot_format import encode_items, encode_plain
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+
+def count_tokens(text):
+    if _ENCODING:
+        return len(_ENCODING.encode(text))
+    return len(text) // 4
+
+
+class _StaticCollector(HTMLParser):
+    """Те же элементы, что ищет скрипт в странице, но без layout: видимость не проверяется"""
+
+    VOID = {"input", "br", "img", "meta", "link", "hr"}
+    SKIP = {"script", "style", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.items = []
+        self._open = [] # (tag, item или None)
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.SKIP:
+            self._skip += 1
+            return
+        role = attrs.get("role") or ""
+        interactive = tag in ("a", "button", "input", "textarea") or role in ("button", "link")
+        item = None
+        if interactive and "hidden" not in attrs:
+            item = {
+                "id": len(self.items) + 1, "tagName": tag, "type": attrs.get("type") or "", "role": role,
+                "text": attrs.get("placeholder") or attrs.get("aria-label") or "",
+            }
+            if tag == "input":
+                item["text"] = item["text"] or attrs.get("value") or ""
+            self.items.append(item)
+        if tag not in self.VOID:
+            self._open.append((tag, item))
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip = max(self._skip - 1, 0)
+            return
+        while self._open:
+            open_tag, _ = self._open.pop()
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        for _, item in self._open:
+            if item is not None and item["tagName"] != "input":
+                item.setdefault("_parts", []).append(data)
+
+    def finish(self):
+        for item in self.items:
+            parts = item.pop("_parts", None)
+            if parts:
+                item["text"] = " ".join(" ".join(parts).split())[:100]
+        return self.items
+
+
+def static_items(path):
+    collector = _StaticCollector()
+    with open(path, "r", encoding="utf-8") as f:
+        collector.feed(f.read())
+    return collector.finish()
+
+
+async def browser_items(paths):
+    from playwright.async_api import async_playwright
+    from page_perception.dom_service import DomService
+
+    result = {}
+    async with async_playwright() as playwright:
+        browser = await playwright.chromium.launch(headless=True)
+        page = await browser.new_page(viewport={"width": 1280, "height": 900})
+        for path in paths:
+            await page.goto("file://" + os.path.abspath(path))
+            snapshot = await page.evaluate(DomService.get_accessibility_tree_script(), {"viewportMargin": None})
+            result[path] = snapshot["items"]
+        await browser.close()
+    return result
+
+
+def measure(name, items):
+    row = {"page": name, "elements": len(items)}
+    for label, encode in (("plain", encode_plain), ("compact", encode_items)):
+        started = time.perf_counter()
+        text = "\n".join(encode(items))
+        row[f"{label}_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        row[f"{label}_chars"] = len(text)
+        row[f"{label}_tokens"] = count_tokens(text)
+    row["saved_pct"] = round(100 - row["compact_tokens"] * 100 / row["plain_tokens"], 1) if row["plain_tokens"] else 0
+    return row
+
+
+def print_report(rows):
+    columns = ["page", "elements", "plain_tokens", "compact_tokens", "saved_pct", "plain_ms", "compact_ms"]
+    print("  ".join(f"{column:>14}" for column in columns))
+    for row in rows:
+        print("  ".join(f"{str(row[column]):>14}" for column in columns))
+    print(f"(токены: {'tiktoken o200k_base' if _ENCODING else 'оценка символы/4'})")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Snapshot token count: plain vs compact encoding")
+    parser.add_argument("--static", action="store_true", help="Parse fixture HTML instead of running Chromium")
+    parser.add_argument("--out", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+    if args.static:
+        items_by_path = {path: static_items(path) for path in paths}
+    else:
+        items_by_path = await browser_items(paths)
+
+    rows = [measure(os.path.basename(path), items_by_path[path]) for path in paths]
+    print_report(rows)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""
+Замер запуска браузера: холодный старт (launch, как раньше) против подключения
+по CDP к тёплому Chromium с постоянным профилем (warm=True).
+
+    python -m benchmarks.startup_bench
+    python -m benchmarks.startup_bench --runs 10 --headful --out startup.json
+
+Профиль берётся временный; тёплый браузер в конце гасится.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+
+from playwright.async_api import async_playwright
+
+from browser_controller.driver import BrowserDriver
+from browser_controller.warm_browser import shutdown_warm_browser
+
+
+async def measure(runs, headless, profile_dir, state_file):
+    results = {"launched": [], "spawned": [], "attached": []}
+
+    for _ in range(runs):
+        driver = BrowserDriver(state_file=state_file)
+        await driver.start_browser(headless=headless)
+        results["launched"].append(driver.startup_timing)
+        await driver.close()
+
+    # Первый тёплый запуск поднимает браузер, остальные — только подключаются
+    for _ in range(runs + 1):
+        driver = BrowserDriver(state_file=state_file)
+        await driver.start_browser(headless=headless, warm=True, profile_dir=profile_dir)
+        results[driver.startup_timing["mode"]].append(driver.startup_timing)
+        await driver.close()
+
+    playwright = await async_playwright().start()
+    try:
+        await shutdown_warm_browser(playwright, profile_dir)
+    finally:
+        await playwright.stop()
+    return results
+
+
+def print_report(results):
+    columns = ["playwright_ms", "browser_ms", "context_ms", "total_ms"]
+    print(f"{'mode':>10}  {'runs':>5}  " + "  ".join(f"{column:>14}" for column in columns))
+    for mode, timings in results.items():
+        if not timings:
+            continue
+        medians = [statistics.median(timing[column] for timing in timings) for column in columns]
+        print(f"{mode:>10}  {len(timings):>5}  " + "  ".join(f"{round(value, 1):>14}" for value in medians))
+    print("(медианы, мс)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Browser startup: cold launch vs warm CDP attach")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--headful", action="store_true")
+    parser.add_argument("--out", help="Write raw timings as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = await measure(args.runs, not args.headful, f"{tmp}/profile", f"{tmp}/state.json")
+    print_report(results)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,133 +1,269 @@
 import asyncio
+import json
 import os
+import time
 from playwright.async_api import async_playwright, Page, Browser, Playwright, BrowserContext
 from page_perception.dom_service import DomService
+from page_perception.snapshot_format import encode_items, encode_plain, format_ids, split_id, join_id
+from page_perception import relevance
+from browser_controller.settle import PageSettleWaiter
+from browser_controller.resource_policy import ResourcePolicy
+from browser_controller.tab_registry import TabRegistry, normalize_url
+from browser_controller.warm_browser import connect_warm_browser, PROFILE_DIR
 
 USER_DATA_DIR = "user_data"
 STATE_FILE = os.path.join(USER_DATA_DIR, "state.json")
+MAX_REGISTRY_SIZE = 5000 # Отпечатков на одну страницу
+TEXT_CHUNK_CHARS = 8000 # Размер одной части read_visible_text
+FIND_PAGE_SIZE = 40 # Элементов на страницу find_elements
+
+async def launch_chromium(playwright, width=1280, height=900, position_x=0, position_y=0, headless=False, slow_mo=0):
+    """Запускает Chromium с нашими флагами (общий для одиночного драйвера и менеджера сессий)"""
+    args = [
+        f"--window-size={width},{height}",
+        f"--window-position={position_x},{position_y}",
+        "--disable-blink-features=AutomationControlled"
+    ]
+    return await playwright.chromium.launch(
+        headless=headless,
+        slow_mo=slow_mo, # Искусственное замедление не нужно: ждём через PageSettleWaiter
+        args=args
+    )
 
 class BrowserDriver:
-    def __init__(self):
+    def __init__(self, viewport_margin=None, state_file=STATE_FILE, resource_policy: ResourcePolicy = None,
+                 tabs: TabRegistry = None, snapshot_format="compact", max_elements=None):
         self.playwright: Playwright = None
         self.browser: Browser = None
         self.context: BrowserContext = None
         self.page: Page = None
+        self.last_snapshot_mode = None # "full" или "delta"
+        self.last_snapshot_timing = None # Замеры скрипта в странице (readMs/writeMs/totalMs)
+        self.last_snapshot_elements = 0 # Всего интерактивных элементов на странице
+        # None — все элементы страницы; число — только вьюпорт плюс столько пикселей запаса
+        self.viewport_margin = viewport_margin
+        # Вместо фиксированных пауз ждём, пока страница успокоится
+        self.settle = PageSettleWaiter()
+        self.last_settle_ms = 0
+        self.settle_ms_total = 0 # Накопительно, для замеров по шагам
+        # Куки/LocalStorage этого драйвера (у каждой сессии свой файл)
+        self.state_file = state_file
+        # False, если браузер общий (менеджер сессий) — тогда закрываем только свой контекст
+        self.owns_browser = True
+        # True — браузер подключён по CDP и переживает агента: при закрытии не гасим его
+        self.keep_browser_alive = False
+        self.startup_timing = None # Сколько занял запуск: режим и этапы, мс
+        # Реестр стабильных id по документам: (номер фрейма, url) -> {"fpToId", "idToFp", "nextId"}.
+        # Номер фрейма в ключе: у about:blank/srcdoc и одинаковых iframe реестры должны быть свои
+        self.element_registry = {}
+        # Облегчённая загрузка (без картинок, шрифтов, рекламы); None — грузим всё
+        self.resource_policy = resource_policy
+        # Последний извлечённый текст по режиму ("main"/"full"): части плюс документ и его версия
+        self._text_cache = {}
+        # Вкладки по адресам, живость из событий страниц; лишние и простаивающие закрываются
+        self.tabs = tabs or TabRegistry()
+        # "compact" — повторы свёрнуты, тип/роль в записи (см. snapshot_format); "plain" — строка на элемент
+        self.snapshot_format = snapshot_format
+        # Больше max_elements элементов — в полный слепок идут самые подходящие к задаче,
+        # остальные доступны через find_elements. None — показываем все
+        self.max_elements = max_elements
+        self._elements = {} # id -> элемент: всё, что есть на странице по последнему слепку
+        self._shown_ids = set() # Что из этого модель уже видела
+        # Номера iframe для id вида "2:5": номер -> фрейм и обратно (0 — сама страница)
+        self._frames = {}
+        self._frame_numbers = {}
+        self._next_frame_number = 1
         
         if not os.path.exists(USER_DATA_DIR):
             os.makedirs(USER_DATA_DIR)
 
-    async def start_browser(self, width=1280, height=900, position_x=0, position_y=0):
-        print("[BrowserController] Launching browser...")
+    async def start_browser(self, width=1280, height=900, position_x=0, position_y=0, slow_mo=0, headless=False,
+                            warm=False, cdp_url=None, profile_dir=PROFILE_DIR):
+        """
+        warm=True — не запускать браузер заново, а подключиться по CDP к уже
+        работающему Chromium с постоянным профилем (или запустить его так, чтобы
+        он пережил перезапуск агента). cdp_url — подключиться к чужому браузеру.
+        """
+        started = time.perf_counter()
         self.playwright = await async_playwright().start()
-        
-        args = [
-            f"--window-size={width},{height}",
-            f"--window-position={position_x},{position_y}",
-            "--disable-blink-features=AutomationControlled"
-        ]
-
-        self.browser = await self.playwright.chromium.launch(
-            headless=False,
-            slow_mo=100, # Чуть быстрее, так как мы добавим умные ожидания
-            args=args
-        )
-        
-        # Загрузка состояния
-        if os.path.exists(STATE_FILE):
-            try:
-                self.context = await self.browser.new_context(
-                    viewport={'width': width, 'height': height},
-                    storage_state=STATE_FILE
-                )
-            except Exception as e:
-                print(f"Error loading state: {e}")
-                self.context = await self.browser.new_context(viewport={'width': width, 'height': height})
+        playwright_ready = time.perf_counter()
+
+        if warm or cdp_url:
+            print("[BrowserController] Connecting to warm browser...")
+            browser, mode = await connect_warm_browser(
+                self.playwright, cdp_url, profile_dir,
+                width=width, height=height, position_x=position_x, position_y=position_y, headless=headless
+            )
+            # Браузер живёт дольше агента: при закрытии только отключаемся
+            self.keep_browser_alive = True
+            browser_ready = time.perf_counter()
+            page = await self.attach(browser, width, height, reuse_context=True, seed_cookies=(mode == "spawned"))
+        else:
+            print("[BrowserController] Launching browser...")
+            browser = await launch_chromium(
+                self.playwright, width, height, position_x, position_y, headless=headless, slow_mo=slow_mo
+            )
+            mode = "launched"
+            browser_ready = time.perf_counter()
+            page = await self.attach(browser, width, height)
+
+        finished = time.perf_counter()
+        self.startup_timing = {
+            "mode": mode,
+            "playwright_ms": round((playwright_ready - started) * 1000, 1),
+            "browser_ms": round((browser_ready - playwright_ready) * 1000, 1),
+            "context_ms": round((finished - browser_ready) * 1000, 1),
+            "total_ms": round((finished - started) * 1000, 1),
+        }
+        print(f"[BrowserController] Browser ready in {self.startup_timing['total_ms']:.0f} ms ({mode})")
+        return page
+
+    async def attach(self, browser, width=1280, height=900, seed_state=None, reuse_context=False, seed_cookies=False):
+        """
+        Открывает собственный изолированный контекст в уже запущенном браузере.
+        seed_state — откуда взять куки, если у драйвера ещё нет своего state_file.
+        reuse_context — работать в основном контексте браузера (подключение по CDP):
+        куки уже лежат в профиле, открытые вкладки остаются; seed_cookies —
+        профиль только что создан, переносим в него куки из state_file.
+        """
+        self.browser = browser
+        viewport = {'width': width, 'height': height}
+
+        if reuse_context and browser.contexts:
+            self.context = browser.contexts[0]
+            if seed_cookies:
+                await self._seed_cookies(seed_state)
         else:
-            self.context = await self.browser.new_context(viewport={'width': width, 'height': height})
+            # Загрузка состояния
+            state = self.state_file if os.path.exists(self.state_file) else seed_state
+            if state and os.path.exists(state):
+                try:
+                    self.context = await self.browser.new_context(viewport=viewport, storage_state=state)
+                except Exception as e:
+                    print(f"Error loading state: {e}")
+                    self.context = await self.browser.new_context(viewport=viewport)
+            else:
+                self.context = await self.browser.new_context(viewport=viewport)
+        await self.settle.install(self.context)
+        self.tabs.install(self.context)
+        if self.resource_policy:
+            await self.resource_policy.install(self.context)
         
-        # При старте открываем одну вкладку
-        self.page = await self.context.new_page()
+        # Продолжаем в уже открытой вкладке (тёплый браузер), иначе открываем одну
+        open_pages = [page for page in self.context.pages if not page.is_closed()]
+        self.page = open_pages[-1] if open_pages else await self.context.new_page()
         return self.page
 
+    async def _seed_cookies(self, seed_state=None):
+        state = self.state_file if os.path.exists(self.state_file) else seed_state
+        if not state or not os.path.exists(state):
+            return
+        try:
+            with open(state, "r", encoding="utf-8") as f:
+                cookies = json.load(f).get("cookies", [])
+            if cookies:
+                await self.context.add_cookies(cookies)
+        except Exception as e:
+            print(f"Error loading state: {e}")
+
+    async def wait_for_settle(self, timeout_ms=None):
+        """Ждёт, пока текущая вкладка успокоится (сеть, мутации DOM, анимации)"""
+        settled, waited_ms = await self.settle.wait(self.page, timeout_ms)
+        self.last_settle_ms = waited_ms
+        self.settle_ms_total += waited_ms
+        return settled
+
     async def _ensure_page_active(self):
         """Гарантирует, что мы работаем с живой, активной вкладкой"""
         if not self.browser or not self.browser.is_connected():
             return # Браузер закрыт, ничего не поделаешь
 
-        # 1. Если текущая страница жива и видна - ок
-        try:
-            if self.page and not self.page.is_closed():
-                # Пинг
-                await self.page.evaluate("1")
-                return 
-        except:
-            pass # Страница умерла
-
-        # 2. Ищем последнюю активную вкладку
-        if self.context.pages:
-            # Берем последнюю открытую (обычно это та, на которую смотрит юзер или которая открылась последней)
-            self.page = self.context.pages[-1]
-            try:
-                await self.page.bring_to_front()
-            except: pass
+        # 1. Текущая вкладка жива (не было close/crash) — ок, без пинга
+        if self.tabs.is_alive(self.page):
+            self.tabs.touch(self.page)
         else:
-            self.page = await self.context.new_page()
+            # 2. Берём последнюю использованную (обычно та, что открылась последней)
+            self.page = self.tabs.latest()
+            if self.page:
+                try:
+                    await self.page.bring_to_front()
+                except: pass
+            else:
+                self.page = await self.context.new_page()
+                self.tabs.track(self.page)
+
+        await self.tabs.collect(self.page)
 
     async def navigate(self, url: str):
         await self._ensure_page_active()
         if not url.startswith('http'): url = 'https://' + url
 
         # 1. Сначала проверяем ТЕКУЩУЮ страницу
-        # Игнорируем разницу в слэшах в конце
-        if self.page.url.rstrip('/') == url.rstrip('/'):
+        if normalize_url(self.page.url) == normalize_url(url):
              return f"Already on this page: {url}"
 
-        # 2. Проверяем другие вкладки (SMART NAVIGATE)
-        # Ищем по домену или полному совпадению
-        for page in self.context.pages:
-            if url in page.url: # Простое вхождение
-                self.page = page
-                await self.page.bring_to_front()
-                return f"Switched to existing tab: {self.page.url}"
+        # 2. Вкладка с этим адресом уже открыта — переключаемся на неё
+        existing = self.tabs.find(url)
+        if existing and existing is not self.page:
+            self.page = existing
+            self.tabs.touch(self.page)
+            await self.page.bring_to_front()
+            return f"Switched to existing tab: {self.page.url}"
 
         # 3. Если не нашли, переходим
         try:
-            await self.page.goto(url)
-            await self.page.wait_for_load_state("domcontentloaded")
+            await self.page.goto(url, wait_until="domcontentloaded")
+            await self.wait_for_settle()
             return f"Navigated to {url}"
         except Exception as e:
             return f"Error navigating: {e}"
 
-            
-
-    async def click_element(self, element_id: int):
+    async def click_element(self, element_id):
         await self._ensure_page_active()
-        selector = f'[data-agent-id="{element_id}"]'
+        frame, local_id = self._locate(element_id)
+        if frame is None:
+            return f"Error clicking {element_id}: no such element, re-read the page"
+        selector = f'[data-agent-id="{local_id}"]'
         
         pages_before = len(self.context.pages)
         
         try:
-            await self.page.click(selector, timeout=2500, force=True)
+            status = await self._resolve_element(element_id)
+            if status == "missing":
+                return f"Error clicking {element_id}: element is gone, re-read the page"
+
+            await frame.click(selector, timeout=2500, force=True)
             
-            # Ждем чуть-чуть реакции
-            await asyncio.sleep(1)
+            # Ждем реакции страницы (загрузки, перерисовки, анимации)
+            await self.wait_for_settle()
             
             # Проверяем, не открылась ли новая вкладка
             if len(self.context.pages) > pages_before:
                 self.page = self.context.pages[-1]
+                self.tabs.track(self.page)
                 await self.page.bring_to_front()
                 await self.page.wait_for_load_state("domcontentloaded")
+                await self.wait_for_settle()
                 return f"Clicked {element_id}, opened NEW TAB: {self.page.url}"
 
+            if status == "resolved":
+                return f"Clicked element {element_id} (re-located after page re-render)"
             return f"Clicked element {element_id}"
         except Exception as e:
             return f"Error clicking {element_id}: {str(e)}"
 
-    async def type_text(self, element_id: int, text: str):
+    async def type_text(self, element_id, text: str):
         await self._ensure_page_active()
-        selector = f'[data-agent-id="{element_id}"]'
+        frame, local_id = self._locate(element_id)
+        if frame is None:
+            return f"Error typing: no element {element_id}, re-read the page"
+        selector = f'[data-agent-id="{local_id}"]'
         try:
-            await self.page.fill(selector, text, timeout=2000)
+            if await self._resolve_element(element_id) == "missing":
+                return f"Error typing: element {element_id} is gone, re-read the page"
+            await frame.fill(selector, text, timeout=2000)
+            # Подсказки/автодополнение появляются не сразу
+            await self.wait_for_settle()
             return f"Typed '{text}' into element {element_id}"
         except Exception as e:
             return f"Error typing: {str(e)}"
@@ -136,49 +272,392 @@ class BrowserDriver:
         await self._ensure_page_active()
         try:
             await self.page.keyboard.press(key)
-            await asyncio.sleep(0.5)
+            await self.wait_for_settle()
             return f"Pressed key: {key}"
         except Exception as e:
             return f"Error pressing key: {str(e)}"
 
     async def wait(self, seconds: int):
-        print(f"[Driver] Waiting {seconds}s...")
-        await asyncio.sleep(seconds)
-        return f"Waited {seconds}s"
+        await self._ensure_page_active()
+        # Если страница уже спокойна, ждать нечего
+        if await self.settle.is_settled(self.page):
+            return "Page already settled, no wait needed"
+
+        print(f"[Driver] Waiting up to {seconds}s for page to settle...")
+        settled = await self.wait_for_settle(timeout_ms=seconds * 1000)
+        if settled:
+            return f"Page settled after {self.last_settle_ms / 1000:.1f}s"
+        return f"Waited {seconds}s, page is still changing"
 
-    async def read_visible_text(self):
+    async def read_visible_text(self, page: int = 1, full_page: bool = False):
+        """
+        Текст страницы частями по TEXT_CHUNK_CHARS: основное содержимое или,
+        при full_page=True, весь видимый текст. page — номер части, с 1.
+        Пока документ не менялся, части берутся из кэша без повторного извлечения.
+        """
         await self._ensure_page_active()
         try:
-            text = await self.page.evaluate("document.body.innerText")
-            clean_text = '\n'.join([line.strip() for line in text.split('\n') if line.strip()])
-            return clean_text[:25000]
+            mode = "full" if full_page else "main"
+            cached = self._text_cache.get(mode)
+            options = {"fullPage": full_page}
+            if cached:
+                options.update(knownDoc=cached["doc"], knownVersion=cached["version"])
+            result = await self.page.evaluate(DomService.get_main_content_script(), options)
+            if not result["cached"]:
+                cached = self._text_cache[mode] = {
+                    "doc": result["doc"],
+                    "version": result["version"],
+                    "url": result["url"],
+                    "source": result["source"],
+                    "chunks": self._split_text(result["text"]),
+                }
+            return self._format_text_chunk(cached, page)
         except Exception as e:
             return f"Error reading text: {e}"
 
-    async def get_page_content(self):
+    @staticmethod
+    def _split_text(text):
+        """Режет по границам строк; слишком длинные строки — как есть, по размеру части"""
+        chunks = []
+        current = []
+        size = 0
+        for line in text.split("\n"):
+            while len(line) > TEXT_CHUNK_CHARS:
+                head, line = line[:TEXT_CHUNK_CHARS], line[TEXT_CHUNK_CHARS:]
+                if current:
+                    chunks.append("\n".join(current))
+                    current, size = [], 0
+                chunks.append(head)
+            if current and size + len(line) + 1 > TEXT_CHUNK_CHARS:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current and any(current):
+            chunks.append("\n".join(current))
+        return chunks
+
+    @staticmethod
+    def _format_text_chunk(cached, page):
+        chunks = cached["chunks"]
+        if not chunks:
+            return f"No readable text on {cached['url']}"
+        total = len(chunks)
+        if page < 1 or page > total:
+            return f"Error: page {page} does not exist, the text has {total} part(s)"
+
+        scope = "main content" if cached["source"] == "main" else "whole page"
+        lines = [f"[Text of {cached['url']} ({scope}), part {page} of {total}]", chunks[page - 1]]
+        if page < total:
+            lines.append(f"[Continued: read_visible_text(page={page + 1})]")
+        if cached["source"] == "main" and page == total:
+            lines.append("[Navigation, header and footer omitted: read_visible_text(full_page=true) for the whole page]")
+        return "\n".join(lines)
+
+    async def get_page_content(self, delta: bool = False, query: str = None):
+        """
+        Слепок интерактивных элементов. При delta=True отдаёт только изменения
+        относительно прошлого вызова (трекер сам вернёт полный слепок после навигации).
+        query — текст задачи: по нему отбираются элементы, если их больше max_elements.
+        Скрипт выполняется во всех фреймах вкладки одновременно; id элементов из
+        iframe — с номером фрейма ("2:5"), click_element/type_text их понимают.
+        """
         await self._ensure_page_active()
         if not self.page: return "Browser not started"
         
         try:
-            # Получаем элементы
-            items = await self.page.evaluate(DomService.get_accessibility_tree_script())
-            
-            text_representation = f"Current URL: {self.page.url}\nInteractive Elements:\n"
-            for item in items:
-                text_representation += f"[{item['id']}] {item['tagName']} '{item['text']}'\n"
-            return text_representation
+            started = time.perf_counter()
+            frames = self._live_frames()
+            options = {"forceFull": not delta, "viewportMargin": self.viewport_margin}
+            snapshots = await self._snapshot_frames(frames, options)
+            main = snapshots[0]
+            if isinstance(main, Exception):
+                raise main
+            if delta and main["mode"] == "full":
+                # Навигация: страница целиком новая, дельты фреймов не к чему применять
+                options["forceFull"] = True
+                snapshots[1:] = await self._snapshot_frames(frames[1:], options)
+            evaluated = time.perf_counter()
+
+            self.last_snapshot_mode = main["mode"]
+            # evaluateMs — вызовы скрипта во фреймах целиком (с сериализацией и передачей),
+            # formatMs — сборка текста слепка в Python
+            self.last_snapshot_timing = dict(
+                main["timing"], frames=len(frames), evaluateMs=round((evaluated - started) * 1000, 2)
+            )
+            self.last_snapshot_elements = 0
+            snapshot = {"items": [], "added": [], "changed": [], "removed": []}
+            for (number, frame), frame_snapshot in zip(frames, snapshots):
+                if isinstance(frame_snapshot, Exception):
+                    # Фрейм отвалился или перезагружается прямо сейчас — в этот раз без него
+                    print(f"[Driver] Frame {number} skipped: {frame_snapshot}")
+                    continue
+                self._merge_frame(number, frame_snapshot, snapshot)
+            if main["mode"] == "delta":
+                # Элементы фреймов, которых больше нет
+                live = {number for number, _ in frames}
+                snapshot["removed"].extend(
+                    element_id for element_id in self._elements if split_id(element_id)[0] not in live
+                )
+
+            encode = encode_items if self.snapshot_format == "compact" else encode_plain
+            lines = [f"Current URL: {self.page.url}"]
+            if main["mode"] == "full":
+                lines.extend(self.format_full_snapshot(snapshot["items"], query))
+            else:
+                added, changed = snapshot["added"], snapshot["changed"]
+                for item in added + changed:
+                    self._elements[item["id"]] = item
+                for element_id in snapshot["removed"]:
+                    self._elements.pop(element_id, None)
+                    self._shown_ids.discard(element_id)
+                # Изменения элементов, которых модель не видела, ей ни о чём не скажут
+                changed = [item for item in changed if item["id"] in self._shown_ids]
+                hidden = 0
+                if self.max_elements and len(added) > self.max_elements:
+                    # Подгрузка ленты, смена вида в SPA: новых элементов столько же, сколько в полном слепке
+                    added, hidden = relevance.select_top(added, query, self.max_elements)
+                self._shown_ids.update(item["id"] for item in added)
+                changes = len(added) + len(changed) + len(snapshot["removed"]) + hidden
+                lines.append(f"Interactive Elements (changes since previous snapshot, {self.last_snapshot_elements} total):")
+                if not changes:
+                    lines.append("No changes")
+                lines.extend(encode(added, "+ "))
+                lines.extend(encode(changed, "~ "))
+                if snapshot["removed"]:
+                    removed = sorted(snapshot["removed"], key=split_id)
+                    if self.snapshot_format == "compact":
+                        lines.append(f"- [{format_ids(removed)}]")
+                    else:
+                        lines.extend(f"- [{element_id}]" for element_id in removed)
+                if hidden:
+                    lines.append(f"(+{hidden} more new elements not shown, less relevant to the task: use find_elements)")
+            content = "\n".join(lines) + "\n"
+            self.last_snapshot_timing["formatMs"] = round((time.perf_counter() - evaluated) * 1000, 2)
+            return content
         except Exception as e:
             return f"Error reading DOM: {e}"
 
+    def format_full_snapshot(self, items, query=None):
+        """
+        Строки полного слепка по всем элементам страницы (с отбором по задаче,
+        если их больше max_elements). Запоминает, что есть на странице и что показано.
+        """
+        encode = encode_items if self.snapshot_format == "compact" else encode_plain
+        self._elements = {item["id"]: item for item in items}
+        hidden = 0
+        if self.max_elements and len(items) > self.max_elements:
+            items, hidden = relevance.select_top(items, query, self.max_elements)
+        self._shown_ids = {item["id"] for item in items}
+        lines = ["Interactive Elements:"]
+        for number, group in self._group_by_frame(items):
+            if number:
+                lines.append(f"In frame {number} ({self._frames[number].url}):")
+            lines.extend(encode(group))
+        if hidden:
+            lines.append(f"(+{hidden} more elements not shown, less relevant to the task: use find_elements)")
+        return lines
+
+    def _live_frames(self):
+        """[(номер, фрейм)] текущей вкладки: сама страница (0) и её iframe в порядке документа"""
+        for number, frame in list(self._frames.items()):
+            if frame.is_detached():
+                del self._frames[number]
+                self._frame_numbers.pop(frame, None)
+        frames = [(0, self.page.main_frame)]
+        for frame in self.page.frames:
+            if frame is self.page.main_frame or frame.is_detached():
+                continue
+            if frame not in self._frame_numbers:
+                self._frame_numbers[frame] = self._next_frame_number
+                self._frames[self._next_frame_number] = frame
+                self._next_frame_number += 1
+            frames.append((self._frame_numbers[frame], frame))
+        return frames
+
+    async def _snapshot_frames(self, frames, options):
+        """Слепки фреймов параллельно; упавший фрейм — исключение на его месте"""
+        return list(await asyncio.gather(
+            *(self._snapshot_frame(number, frame, dict(options)) for number, frame in frames), return_exceptions=True
+        ))
+
+    async def _snapshot_frame(self, number, frame, options):
+        snapshot = await frame.evaluate(DomService.get_snapshot_tracker_script(), options)
+        if snapshot["mode"] == "need_registry":
+            # Новый документ: отдаём трекеру известные отпечатки этой страницы
+            registry = self._registry_for(number, snapshot["url"])
+            options["registry"] = {"fpToId": registry["fpToId"], "nextId": registry["nextId"]}
+            snapshot = await frame.evaluate(DomService.get_snapshot_tracker_script(), options)
+        self._remember_ids(number, snapshot["url"], snapshot["assigned"], snapshot["nextId"])
+        return snapshot
+
+    def _merge_frame(self, number, frame_snapshot, snapshot):
+        """Дописывает слепок фрейма в общий, проставляя элементам id с номером фрейма"""
+        self.last_snapshot_elements += frame_snapshot["total"]
+        for key in ("items", "added", "changed"):
+            for item in frame_snapshot.get(key, []):
+                item["id"] = join_id(number, item["id"])
+        removed = [join_id(number, element_id) for element_id in frame_snapshot.get("removed", [])]
+
+        if self.last_snapshot_mode == "full" or frame_snapshot["mode"] == "delta":
+            snapshot["items"].extend(frame_snapshot.get("items", []))
+            snapshot["added"].extend(frame_snapshot.get("added", []))
+            snapshot["changed"].extend(frame_snapshot.get("changed", []))
+            snapshot["removed"].extend(removed)
+            return
+
+        # Страница отдала дельту, а фрейм — полный слепок (новый iframe или он сильно
+        # изменился): сводим его к дельте по тому, что видели в этом фрейме раньше
+        current = {item["id"]: item for item in frame_snapshot["items"]}
+        for element_id, item in current.items():
+            old = self._elements.get(element_id)
+            if old is None:
+                snapshot["added"].append(item)
+            elif any(old.get(key) != item.get(key) for key in ("text", "tagName", "type", "role")):
+                snapshot["changed"].append(item)
+        snapshot["removed"].extend(
+            element_id for element_id in self._elements
+            if split_id(element_id)[0] == number and element_id not in current
+        )
+
+    @staticmethod
+    def _group_by_frame(items):
+        """Подряд идущие элементы одного фрейма: [(номер, [элементы])]"""
+        groups = []
+        for item in items:
+            number = split_id(item["id"])[0]
+            if not groups or groups[-1][0] != number:
+                groups.append((number, []))
+            groups[-1][1].append(item)
+        return groups
+
+    async def find_elements(self, query: str = "", page: int = 1):
+        """
+        Элементы из последнего слепка, которые не попали в него из-за max_elements:
+        с query — поиск по словам (лучшие совпадения первыми, среди всех элементов),
+        без query — по порядку на странице, постранично.
+        """
+        items = list(self._elements.values())
+        if query:
+            found = relevance.search(items, query)
+            title = f"Elements matching '{query}'"
+        else:
+            found = [item for item in items if item["id"] not in self._shown_ids]
+            title = "Elements not shown in the snapshot"
+        if not found:
+            return f"{title}: none"
+
+        pages = (len(found) + FIND_PAGE_SIZE - 1) // FIND_PAGE_SIZE
+        page = min(max(int(page or 1), 1), pages)
+        chunk = found[(page - 1) * FIND_PAGE_SIZE:page * FIND_PAGE_SIZE]
+        self._shown_ids.update(item["id"] for item in chunk)
+        encode = encode_items if self.snapshot_format == "compact" else encode_plain
+        lines = [f"{title} ({len(found)} total, page {page}/{pages}):"]
+        lines.extend(encode(chunk))
+        if page < pages:
+            lines.append(f"(more: find_elements page={page + 1})")
+        return "\n".join(lines)
+
+    def _registry_for(self, number, url):
+        key = (number, url.split("#")[0])
+        if key not in self.element_registry:
+            self.element_registry[key] = {"fpToId": {}, "idToFp": {}, "nextId": 1}
+        return self.element_registry[key]
+
+    def _remember_ids(self, number, url, assigned, next_id):
+        registry = self._registry_for(number, url)
+        for fp, element_id in assigned.items():
+            registry["fpToId"][fp] = element_id
+            registry["idToFp"][element_id] = fp
+        registry["nextId"] = next_id
+        # Реестр живёт всю сессию — не даём ему расти без предела на "живых" страницах
+        if len(registry["fpToId"]) > MAX_REGISTRY_SIZE:
+            for fp in list(registry["fpToId"])[:len(registry["fpToId"]) - MAX_REGISTRY_SIZE]:
+                element_id = registry["fpToId"].pop(fp)
+                if registry["idToFp"].get(element_id) == fp:
+                    del registry["idToFp"][element_id]
+
+    def _locate(self, element_id):
+        """
+        id из слепка -> (фрейм, id внутри фрейма): 5 — сама страница, "2:5" — iframe 2.
+        (None, None), если id не разобрать или фрейма уже нет.
+        """
+        try:
+            number, local_id = split_id(element_id)
+        except (TypeError, ValueError):
+            return None, None
+        frame = self.page.main_frame if number == 0 else self._frames.get(number)
+        if frame is None or frame.is_detached():
+            return None, None
+        return frame, local_id
+
+    async def _resolve_element(self, element_id):
+        """
+        Проверяет, что id ещё указывает на живой элемент. Если страница перерисовалась,
+        находит элемент с тем же отпечатком и переносит id на него.
+        Возвращает 'ok' | 'resolved' | 'missing'.
+        """
+        frame, local_id = self._locate(element_id)
+        if frame is None:
+            return "missing"
+        return await frame.evaluate(
+            DomService.get_element_resolve_script(), {"id": local_id, "fp": self.element_fingerprint(element_id)}
+        )
+
+    def element_fingerprint(self, element_id):
+        """Отпечаток элемента с этим id на текущей странице (None, если не знаем)"""
+        frame, local_id = self._locate(element_id)
+        if frame is None:
+            return None
+        registry = self.element_registry.get((split_id(element_id)[0], frame.url.split("#")[0]))
+        return registry["idToFp"].get(local_id) if registry else None
+
+    def element_item(self, element_id):
+        """Элемент с этим id из последнего слепка (тег, текст, тип, роль) или None"""
+        try:
+            return self._elements.get(join_id(*split_id(element_id)))
+        except (TypeError, ValueError):
+            return None
+
+    async def find_by_fingerprint(self, fp):
+        """id живого элемента с этим отпечатком на текущей странице (в любом её фрейме) или None"""
+        for number, frame in self._live_frames():
+            registry = self.element_registry.get((number, frame.url.split("#")[0]))
+            local_id = registry["fpToId"].get(fp) if registry else None
+            if local_id is None:
+                continue
+            element_id = join_id(number, local_id)
+            if await self._resolve_element(element_id) != "missing":
+                return element_id
+        return None
+
+    async def save_state(self):
+        """Куки и LocalStorage — в state_file (при закрытии и по ходу задачи)"""
+        if not self.context:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+            await self.context.storage_state(path=self.state_file)
+        except: pass
+
     async def close(self):
+        if self.resource_policy:
+            print(f"[BrowserController] {self.resource_policy.summary()}")
+        if self.tabs.closed_idle:
+            print(f"[BrowserController] Closed {self.tabs.closed_idle} idle tabs")
         # Безопасное закрытие без Traceback
-        if self.context:
-            try: await self.context.storage_state(path=STATE_FILE)
-            except: pass
+        await self.save_state()
         
         # Игнорируем ошибки при закрытии (если уже закрыт)
         try:
+            if not self.owns_browser:
+                if self.context: await self.context.close()
+                return
+            if self.keep_browser_alive:
+                # Отключаемся; браузер, профиль и вкладки остаются для следующего запуска
+                if self.playwright: await self.playwright.stop()
+                return
             if self.browser: await self.browser.close()
             if self.playwright: await self.playwright.stop()
         except:
-            pass
\ No newline at end of file
+            pass
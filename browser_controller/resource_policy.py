@@ -0,0 +1,123 @@
+from collections import Counter
+from urllib.parse import urlsplit
+
+# Реклама и аналитика: агенту не нужны, а страницу грузят заметно
+DEFAULT_BLOCKED_DOMAINS = {
+    "doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+    "googletagmanager.com", "googletagservices.com", "adservice.google.com",
+    "mc.yandex.ru", "an.yandex.ru", "yandexadexchange.net", "top-fwz1.mail.ru", "ad.mail.ru",
+    "connect.facebook.net", "scorecardresearch.com", "hotjar.com", "criteo.com", "criteo.net",
+    "adnxs.com", "taboola.com", "outbrain.com", "amazon-adsystem.com", "ads-twitter.com",
+}
+
+DEFAULT_BLOCKED_TYPES = {"image", "media", "font"}
+
+# Точный размер заблокированного ответа неизвестен (мы его не скачали) —
+# оцениваем по типичным размерам ресурсов, байт
+ESTIMATED_SIZE = {"image": 40_000, "media": 500_000, "font": 35_000, "script": 25_000, "stylesheet": 15_000}
+ESTIMATED_SIZE_OTHER = 5_000
+
+
+class ResourcePolicy:
+    """
+    Облегчённая загрузка страниц: через context.route отбрасываем картинки, видео,
+    шрифты и запросы к рекламным/аналитическим доменам. Агент читает только DOM,
+    так что страница для него не меняется, а domcontentloaded наступает раньше.
+
+    overrides — для сайтов, которые без этого ломаются: {"site.com": {"image"}}
+    разрешает перечисленные типы на страницах site.com, {"site.com": {"cdn.ads.com"}} —
+    запросы к этим доменам (записи с точкой), {"site.com": "*"} — всё.
+    """
+
+    def __init__(self, blocked_types=None, blocked_domains=None, overrides=None):
+        self.blocked_types = set(DEFAULT_BLOCKED_TYPES if blocked_types is None else blocked_types)
+        self.blocked_domains = set(DEFAULT_BLOCKED_DOMAINS if blocked_domains is None else blocked_domains)
+        self.overrides = dict(overrides or {})
+
+        self.allowed = 0
+        self.blocked_by_type = Counter()
+        self.blocked_by_domain = Counter()
+        self.estimated_bytes_saved = 0
+
+    async def install(self, context):
+        await context.route("**/*", self._handle)
+
+    async def _handle(self, route, request):
+        try:
+            reason = self._block_reason(request)
+        except Exception:
+            # Не смогли решить (например, у запросов service worker нет request.frame) —
+            # пропускаем: запрос без ответа повесил бы страницу
+            reason = None
+
+        if reason is None:
+            self.allowed += 1
+            try:
+                await route.fallback() # Дальше — другие обработчики или сеть
+            except Exception:
+                pass # Вкладка закрылась, пока запрос ждал решения
+            return
+
+        kind, value = reason
+        if kind == "type":
+            self.blocked_by_type[value] += 1
+        else:
+            self.blocked_by_domain[value] += 1
+        self.estimated_bytes_saved += ESTIMATED_SIZE.get(request.resource_type, ESTIMATED_SIZE_OTHER)
+        try:
+            await route.abort("blockedbyclient")
+        except Exception:
+            pass
+
+    def _block_reason(self, request):
+        """None — пропустить; иначе ("type", тип) или ("domain", домен)"""
+        resource_type = request.resource_type
+        frame = request.frame
+        # Сам документ вкладки не трогаем никогда
+        if resource_type == "document" and frame.parent_frame is None:
+            return None
+
+        allowed = self._overrides_for(frame)
+        if allowed == "*":
+            return None
+
+        host = urlsplit(request.url).hostname or ""
+        domain = self._matching_domain(host, self.blocked_domains)
+        if domain and not self._matching_domain(host, {entry for entry in allowed if "." in entry}):
+            return "domain", domain
+        if resource_type in self.blocked_types and resource_type not in allowed:
+            return "type", resource_type
+        return None
+
+    def _overrides_for(self, frame):
+        if not self.overrides:
+            return ()
+        try:
+            page_url = frame.page.url
+        except Exception:
+            page_url = frame.url
+        site = self._matching_domain(urlsplit(page_url).hostname or "", self.overrides)
+        return self.overrides[site] if site else ()
+
+    @staticmethod
+    def _matching_domain(host, domains):
+        """Ищет host и его родительские домены (a.b.site.com -> b.site.com -> site.com)"""
+        while host:
+            if host in domains:
+                return host
+            host = host.partition(".")[2]
+        return None
+
+    def stats(self):
+        return {
+            "allowed": self.allowed,
+            "blocked": sum(self.blocked_by_type.values()) + sum(self.blocked_by_domain.values()),
+            "blocked_by_type": dict(self.blocked_by_type),
+            "blocked_by_domain": dict(self.blocked_by_domain.most_common(10)),
+            "estimated_bytes_saved": self.estimated_bytes_saved,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Blocked {stats['blocked']} of {stats['blocked'] + stats['allowed']} requests, "
+                f"~{stats['estimated_bytes_saved'] / 1_000_000:.1f} MB saved (estimated)")
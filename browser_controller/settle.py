@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+# Ставится в каждый документ до его скриптов: запоминает время последней мутации DOM,
+# чтобы "страница уже спокойна" можно было проверить одним evaluate без ожидания.
+SETTLE_INIT_SCRIPT = """
+(() => {
+    if (window.__agentSettle) return;
+    const state = window.__agentSettle = {lastMutation: performance.now()};
+    const start = () => {
+        new MutationObserver(() => { state.lastMutation = performance.now(); })
+            .observe(document.documentElement, {subtree: true, childList: true, attributes: true, characterData: true});
+    };
+    if (document.documentElement) start();
+    else document.addEventListener('readystatechange', start, {once: true});
+})();
+"""
+
+# Ждёт в странице, пока не будет мутаций quietMs и конечных анимаций; не дольше timeoutMs.
+# Бесконечные анимации (спиннеры-украшения, бегущие строки) не учитываем — их конец не наступит.
+SETTLE_WAIT_SCRIPT = """
+({quietMs, timeoutMs}) => new Promise((resolve) => {
+    if (!window.__agentSettle) {
+        const state = window.__agentSettle = {lastMutation: performance.now()};
+        new MutationObserver(() => { state.lastMutation = performance.now(); })
+            .observe(document.documentElement, {subtree: true, childList: true, attributes: true, characterData: true});
+    }
+    const state = window.__agentSettle;
+    const started = performance.now();
+
+    const animating = () => {
+        if (!document.getAnimations) return false;
+        return document.getAnimations().some((a) => {
+            if (a.playState !== 'running') return false;
+            const timing = a.effect && a.effect.getComputedTiming ? a.effect.getComputedTiming() : null;
+            return !timing || timing.iterations !== Infinity;
+        });
+    };
+
+    const tick = () => {
+        const now = performance.now();
+        if (now - state.lastMutation >= quietMs && !animating()) {
+            resolve({settled: true, waitedMs: now - started});
+        } else if (now - started >= timeoutMs) {
+            resolve({settled: false, waitedMs: now - started});
+        } else {
+            setTimeout(tick, 50);
+        }
+    };
+    tick();
+})
+"""
+
+
+class PageSettleWaiter:
+    """
+    Событийное ожидание "страница успокоилась" вместо фиксированных sleep:
+    нет запросов в полёте, нет мутаций DOM quiet_ms и нет анимаций — всё с жёстким лимитом.
+    """
+
+    # Эти запросы живут сколько угодно и никогда не "заканчиваются"
+    IGNORED_RESOURCE_TYPES = {"websocket", "eventsource", "manifest", "other"}
+
+    def __init__(self, quiet_ms=300, timeout_ms=5000, max_request_age_ms=3000):
+        self.quiet_ms = quiet_ms
+        self.timeout_ms = timeout_ms
+        # Запрос, висящий дольше этого (long polling, аналитика), не считается "загрузкой"
+        self.max_request_age_ms = max_request_age_ms
+        self._inflight = {} # page -> {request: время старта}
+
+    async def install(self, context):
+        """Подключает отслеживание ко всем текущим и будущим вкладкам контекста"""
+        await context.add_init_script(SETTLE_INIT_SCRIPT)
+        context.on("page", self.attach)
+        for page in context.pages:
+            self.attach(page)
+
+    def attach(self, page):
+        if page in self._inflight:
+            return
+        requests = self._inflight[page] = {}
+
+        def on_request(request):
+            if request.resource_type not in self.IGNORED_RESOURCE_TYPES:
+                requests[request] = time.monotonic()
+
+        def on_done(request):
+            requests.pop(request, None)
+
+        page.on("request", on_request)
+        page.on("requestfinished", on_done)
+        page.on("requestfailed", on_done)
+        page.on("close", lambda _: self._inflight.pop(page, None))
+
+    def pending_requests(self, page):
+        requests = self._inflight.get(page)
+        if not requests:
+            return 0
+        oldest_allowed = time.monotonic() - self.max_request_age_ms / 1000
+        # Запросы без requestfinished/requestfailed (вкладка ушла со страницы, long polling)
+        # иначе копились бы весь срок жизни вкладки — забываем их, как только они устарели
+        for request in [request for request, started in requests.items() if started < oldest_allowed]:
+            del requests[request]
+        return len(requests)
+
+    async def is_settled(self, page):
+        """Мгновенная проверка, без ожидания"""
+        if self.pending_requests(page):
+            return False
+        try:
+            result = await page.evaluate(SETTLE_WAIT_SCRIPT, {"quietMs": self.quiet_ms, "timeoutMs": 0})
+            return result["settled"]
+        except Exception:
+            return False
+
+    async def wait(self, page, timeout_ms=None):
+        """Ждёт успокоения страницы. Возвращает (settled, waited_ms)"""
+        timeout_ms = self.timeout_ms if timeout_ms is None else timeout_ms
+        started = time.monotonic()
+        deadline = started + timeout_ms / 1000
+
+        while True:
+            remaining_ms = (deadline - time.monotonic()) * 1000
+            if remaining_ms <= 0:
+                return False, (time.monotonic() - started) * 1000
+
+            try:
+                result = await page.evaluate(
+                    SETTLE_WAIT_SCRIPT, {"quietMs": self.quiet_ms, "timeoutMs": remaining_ms}
+                )
+            except Exception:
+                # Контекст выполнения уничтожен навигацией — ждём новый документ и пробуем снова
+                try:
+                    await page.wait_for_load_state("domcontentloaded", timeout=max(remaining_ms, 1))
+                except Exception:
+                    if page.is_closed():
+                        return False, (time.monotonic() - started) * 1000
+                # Документ уже загружен, а evaluate всё падает — без паузы цикл крутился бы вхолостую
+                await asyncio.sleep(0.05)
+                continue
+
+            if not result["settled"]:
+                return False, (time.monotonic() - started) * 1000
+            if not self.pending_requests(page):
+                return True, (time.monotonic() - started) * 1000
+
+            # DOM спокоен, но сеть ещё грузит — ответ может снова поменять DOM
+            await asyncio.sleep(0.05)
@@ -0,0 +1,121 @@
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Ключ вкладки: без фрагмента, www., порта по умолчанию и завершающего слэша.
+    "HTTPS://www.Site.ru:443/path/#top" -> "https://site.ru/path"
+    """
+    if not url:
+        return ""
+    if "://" not in url and not url.startswith(("about:", "data:", "chrome:")):
+        url = "https://" + url
+    parts = urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS:
+        return url
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port != DEFAULT_PORTS[parts.scheme]:
+        host = f"{host}:{parts.port}"
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip("/"), parts.query, ""))
+
+
+class TabRegistry:
+    """
+    Вкладки контекста с индексом по нормализованному адресу. Живость и адрес
+    узнаём из событий страницы (framenavigated/close/crash), а не пингом перед
+    каждым действием. collect() закрывает вкладки, которые давно не трогали
+    (idle_seconds) или которые не помещаются в max_tabs (первыми — самые давние).
+    None в любом лимите — не ограничивать.
+    """
+
+    def __init__(self, max_tabs=8, idle_seconds=600):
+        self.max_tabs = max_tabs
+        self.idle_seconds = idle_seconds
+        self._last_used = {} # page -> time.monotonic() последнего использования
+        self._by_url = {} # нормализованный адрес -> page
+        self._url_of = {} # page -> нормализованный адрес
+        self.closed_idle = 0 # Сколько вкладок закрыл collect() за всё время
+
+    def install(self, context):
+        context.on("page", self.track)
+        for page in context.pages:
+            self.track(page)
+
+    def track(self, page):
+        if page in self._last_used or page.is_closed():
+            return
+        self._last_used[page] = time.monotonic()
+        self._index(page, page.url)
+
+        def on_navigated(frame):
+            if frame.parent_frame is None:
+                self._index(page, frame.url)
+
+        page.on("framenavigated", on_navigated)
+        page.on("close", lambda _: self._forget(page))
+        page.on("crash", lambda _: self._forget(page))
+
+    def is_alive(self, page):
+        return page is not None and page in self._last_used and not page.is_closed()
+
+    def touch(self, page):
+        if page in self._last_used:
+            self._last_used[page] = time.monotonic()
+
+    def find(self, url):
+        """Живая вкладка с этим адресом (после нормализации) или None"""
+        return self._by_url.get(normalize_url(url))
+
+    def latest(self):
+        """Последняя использованная живая вкладка"""
+        if not self._last_used:
+            return None
+        return max(self._last_used, key=self._last_used.get)
+
+    def __len__(self):
+        return len(self._last_used)
+
+    async def collect(self, current=None):
+        """Закрывает простаивающие и лишние вкладки (кроме current). Возвращает их число"""
+        now = time.monotonic()
+        candidates = sorted((page for page in self._last_used if page is not current), key=self._last_used.get)
+        to_close = []
+        if self.idle_seconds is not None:
+            to_close = [page for page in candidates if now - self._last_used[page] > self.idle_seconds]
+        if self.max_tabs is not None:
+            excess = len(self._last_used) - len(to_close) - self.max_tabs
+            remaining = [page for page in candidates if page not in to_close]
+            to_close += remaining[:max(excess, 0)]
+
+        for page in to_close:
+            self._forget(page)
+            try:
+                await page.close()
+            except Exception:
+                pass # Уже закрыта
+        self.closed_idle += len(to_close)
+        return len(to_close)
+
+    def _index(self, page, url):
+        old_key = self._url_of.get(page)
+        if old_key is not None and self._by_url.get(old_key) is page:
+            del self._by_url[old_key]
+        key = normalize_url(url)
+        self._url_of[page] = key
+        self._by_url[key] = page
+
+    def _forget(self, page):
+        self._last_used.pop(page, None)
+        key = self._url_of.pop(page, None)
+        if key is not None and self._by_url.get(key) is page:
+            del self._by_url[key]
+            # Если есть другая вкладка с тем же адресом — индекс теперь указывает на неё
+            for other, other_key in self._url_of.items():
+                if other_key == key:
+                    self._by_url[key] = other
+                    break
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import subprocess
+import time
+import urllib.request
+
+PROFILE_DIR = os.path.join("user_data", "chromium-profile")
+# Chromium пишет сюда порт отладчика, когда запущен с --remote-debugging-port=0
+ACTIVE_PORT_FILE = "DevToolsActivePort"
+SPAWN_TIMEOUT_S = 15
+
+
+def _devtools_version(endpoint, timeout=1.0):
+    """GET /json/version; None — по адресу никто не отвечает"""
+    try:
+        with urllib.request.urlopen(endpoint.rstrip("/") + "/json/version", timeout=timeout) as response:
+            return json.loads(response.read())
+    except Exception:
+        return None
+
+
+def profile_endpoint(profile_dir=PROFILE_DIR):
+    """Адрес отладчика браузера, который держит этот профиль (по DevToolsActivePort)"""
+    try:
+        with open(os.path.join(profile_dir, ACTIVE_PORT_FILE), "r") as f:
+            port = int(f.readline().strip())
+    except Exception:
+        return None
+    return f"http://127.0.0.1:{port}"
+
+
+def spawn_chromium(executable, profile_dir=PROFILE_DIR, width=1280, height=900, position_x=0, position_y=0, headless=False):
+    """
+    Запускает Chromium отдельным процессом (своя сессия ОС), так что он
+    переживает выход агента. Порт выбирает сам браузер и пишет его в профиль.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    try:
+        os.remove(os.path.join(profile_dir, ACTIVE_PORT_FILE)) # Чтобы не прочитать порт прошлого запуска
+    except OSError:
+        pass
+    args = [
+        executable,
+        "--remote-debugging-port=0",
+        f"--user-data-dir={os.path.abspath(profile_dir)}",
+        f"--window-size={width},{height}",
+        f"--window-position={position_x},{position_y}",
+        "--disable-blink-features=AutomationControlled",
+        "--no-first-run",
+        "--no-default-browser-check",
+        "about:blank",
+    ]
+    if headless:
+        args.insert(1, "--headless=new")
+    subprocess.Popen(
+        args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+async def wait_for_endpoint(profile_dir=PROFILE_DIR, timeout_s=SPAWN_TIMEOUT_S):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        endpoint = profile_endpoint(profile_dir)
+        if endpoint and await asyncio.to_thread(_devtools_version, endpoint):
+            return endpoint
+        await asyncio.sleep(0.1)
+    raise TimeoutError(f"Chromium did not open a debugging port in {timeout_s}s")
+
+
+async def connect_warm_browser(playwright, cdp_url=None, profile_dir=PROFILE_DIR, **launch_kwargs):
+    """
+    Подключается к уже запущенному Chromium по CDP. cdp_url — явный адрес
+    (браузер запущен кем-то ещё); иначе ищем браузер нашего профиля и, если
+    его нет, запускаем. Возвращает (browser, "attached" | "spawned").
+    """
+    if cdp_url:
+        return await playwright.chromium.connect_over_cdp(cdp_url), "attached"
+
+    endpoint = profile_endpoint(profile_dir)
+    if endpoint and await asyncio.to_thread(_devtools_version, endpoint):
+        return await playwright.chromium.connect_over_cdp(endpoint), "attached"
+
+    spawn_chromium(playwright.chromium.executable_path, profile_dir, **launch_kwargs)
+    endpoint = await wait_for_endpoint(profile_dir)
+    return await playwright.chromium.connect_over_cdp(endpoint), "spawned"
+
+
+async def shutdown_warm_browser(playwright, profile_dir=PROFILE_DIR):
+    """Гасит браузер профиля (отключение по CDP его не закрывает). False — он не запущен"""
+    endpoint = profile_endpoint(profile_dir)
+    if not endpoint or not await asyncio.to_thread(_devtools_version, endpoint):
+        return False
+    browser = await playwright.chromium.connect_over_cdp(endpoint)
+    session = await browser.new_browser_cdp_session()
+    try:
+        await session.send("Browser.close")
+    except Exception:
+        pass # Соединение рвётся вместе с браузером
+    return True
+
+
+async def _stop():
+    from playwright.async_api import async_playwright
+    async with async_playwright() as playwright:
+        stopped = await shutdown_warm_browser(playwright)
+    print("Chromium профиля закрыт" if stopped else "Chromium профиля не запущен")
+
+
+if __name__ == "__main__":
+    # Погасить тёплый браузер, оставшийся после main.py: python -m browser_controller.warm_browser
+    asyncio.run(_stop())
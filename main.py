@@ -1,46 +1,87 @@
 import asyncio
-from browser_controller.driver import BrowserDriver
+import os
+from browser_controller.driver import BrowserDriver, USER_DATA_DIR
 from ui_runner.sidebar import AgentSidebar
 from orchestrator.engine import Orchestrator
 from agent_core.openai_client import AIClient
+from orchestrator.trajectory_cache import TrajectoryCache
+from orchestrator.model_router import ModelRouter, CHEAP_MODEL as DEFAULT_CHEAP_MODEL
+from agent_core.llm_requests import LLMRequestPolicy
+
+UI_FRAME_SECONDS = 1 / 30 # Отзывчивость окна; чаще — только лишняя нагрузка на цикл
+JOURNAL_FILE = os.path.join(USER_DATA_DIR, "journal.jsonl") # История диалога, переживает перезапуск
+RESUME_WORDS = ["продолжи", "продолжить", "continue", "resume"]
+# AGENT_WARM_BROWSER=1 — браузер с постоянным профилем переживает перезапуск агента: следующий
+# запуск подключается к нему по CDP, а не стартует Chromium заново. Он остаётся запущенным и после
+# выхода — закрыть: python -m browser_controller.warm_browser. AGENT_CDP_URL — подключиться к своему
+# Chromium (запущенному с --remote-debugging-port)
+WARM_BROWSER = os.getenv("AGENT_WARM_BROWSER") == "1"
+CDP_URL = os.getenv("AGENT_CDP_URL")
+# На больших страницах в слепок идут самые подходящие к задаче элементы, остальные — через find_elements
+MAX_SNAPSHOT_ELEMENTS = 150
+# Дублировать запрос к модели, если он дольше p90 (быстрее хвост задержек, но дубликаты оплачиваются)
+HEDGE_REQUESTS = os.getenv("AGENT_HEDGE") == "1"
+# Модель для рутинных шагов (см. ModelRouter); "" — все шаги идут в модель из панели
+CHEAP_MODEL = os.getenv("AGENT_CHEAP_MODEL", DEFAULT_CHEAP_MODEL)
 
 async def run_agent():
-    driver = BrowserDriver()
+    driver = BrowserDriver(max_elements=MAX_SNAPSHOT_ELEMENTS)
     loop = asyncio.get_running_loop()
+    # Удачные прогоны повторяются без запросов к модели, итог проверяет модель (переживает "сброс" памяти)
+    trajectories = TrajectoryCache()
+    # Дедлайны и повторы запросов к модели. Один на весь запуск: статистика задержек
+    # переживает "сброс". Дублирование медленных запросов (hedge) — за отдельные деньги, по желанию
+    llm_requests = LLMRequestPolicy(hedge=HEDGE_REQUESTS)
     
     # Храним экземпляр оркестратора здесь, чтобы он жил между нажатиями кнопки
     orchestrator = None
+    pending_task = None # Задача, прерванная падением прошлого запуска
+
+    # Создаем адаптер для логов
+    def log_adapter(type_msg, title, content=""):
+        if type_msg == "thinking_start":
+            sidebar.start_thinking()
+        elif type_msg == "thinking_end":
+            sidebar.stop_thinking()
+        else:
+            sidebar.add_log(type_msg, title, content)
+
+    def new_orchestrator():
+        # Модель из панели — сильная; рутинные шаги уходят дешёвой (см. ModelRouter)
+        return Orchestrator(
+            driver, log_adapter, trajectory_cache=trajectories, journal_path=JOURNAL_FILE, router=ModelRouter(cheap_model=CHEAP_MODEL),
+            request_policy=llm_requests
+        )
 
     # --- Callbacks ---
 
     async def on_user_task(task_text, model_name):
-        nonlocal orchestrator
+        nonlocal orchestrator, pending_task
         
         sidebar.set_working_state(True)
-        
-        # Создаем адаптер для логов
-        def log_adapter(type_msg, title, content=""):
-            if type_msg == "thinking_start":
-                sidebar.start_thinking()
-            elif type_msg == "thinking_end":
-                sidebar.stop_thinking()
-            else:
-                sidebar.add_log(type_msg, title, content)
 
         # Логика сброса памяти
         if task_text.lower() in ["reset", "clear", "сброс", "новая задача"]:
-            orchestrator = Orchestrator(driver, log_adapter)
+            if orchestrator and orchestrator.journal:
+                orchestrator.journal.reset()
+            orchestrator = new_orchestrator()
+            pending_task = None
             sidebar.add_log("system", "♻️ Память агента очищена. Готов к новой задаче.", "")
             sidebar.set_working_state(False)
             return
 
         # Инициализация оркестратора при первом запуске
         if orchestrator is None:
-            orchestrator = Orchestrator(driver, log_adapter)
+            orchestrator = new_orchestrator()
         
         try:
-            # Запускаем обработку (или продолжаем диалог)
-            await orchestrator.process_task(task_text, model_name=model_name)
+            # Запускаем обработку (или продолжаем диалог / прерванную задачу)
+            if pending_task and task_text.lower() in RESUME_WORDS:
+                pending_task = None
+                await orchestrator.process_task(None, model_name=model_name)
+            else:
+                pending_task = None
+                await orchestrator.process_task(task_text, model_name=model_name)
         except Exception as e:
             sidebar.add_log("error", f"Critical Error: {str(e)}")
             import traceback
@@ -58,12 +99,28 @@ async def run_agent():
     
     print("Запуск системы...")
     # Открываем браузер
-    await driver.start_browser(width=1280, height=900, position_x=0, position_y=0)
+    await driver.start_browser(
+        width=1280, height=900, position_x=0, position_y=0, warm=WARM_BROWSER, cdp_url=CDP_URL
+    )
+    timing = driver.startup_timing
+    sidebar.add_log("system", f"🚀 Браузер готов за {timing['total_ms'] / 1000:.2f} с ({timing['mode']})", "")
+
+    # Поднимаем историю прошлого запуска (если процесс упал или был закрыт посреди диалога)
+    orchestrator = new_orchestrator()
+    try:
+        pending_task = await orchestrator.restore()
+        if pending_task:
+            sidebar.add_log("system", f"⏸ Прервана задача: {pending_task[:200]}. Напишите «продолжи», чтобы продолжить.", "")
+    except Exception as e:
+        print(f"Не удалось восстановить сессию: {e}")
+        orchestrator = new_orchestrator()
     
     try:
+        # Лог выводится по таймеру самого Tk, так что часто крутить update() незачем:
+        # каждый тик отнимает время у цикла агента
         while sidebar.is_running:
             sidebar.update()
-            await asyncio.sleep(0.01)
+            await asyncio.sleep(UI_FRAME_SECONDS)
     except KeyboardInterrupt:
         pass
     finally:
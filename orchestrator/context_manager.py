@@ -0,0 +1,239 @@
+try:
+    import tiktoken
+except ImportError: # Без tiktoken считаем токены приблизительно
+    tiktoken = None
+from orchestrator.history_store import HistoryRecord
+
+DOM_REMOVED_STUB = "[DOM content removed to save memory]"
+TRUNCATED_MARK = "\n[... truncated to save memory]"
+DIGEST_HEADER = "[Сводка предыдущих шагов]"
+
+# Виды сообщений, по которым решаем, что и когда выкидывать
+SYSTEM, TASK, SNAPSHOT_FULL, SNAPSHOT_DELTA, ASSISTANT, TOOL, DIGEST, REPLAY = (
+    "system", "task", "snapshot_full", "snapshot_delta", "assistant", "tool", "digest", "replay"
+)
+SNAPSHOT_KINDS = (SNAPSHOT_FULL, SNAPSHOT_DELTA)
+
+
+class ContextManager:
+    """
+    История диалога с бюджетом токенов.
+
+    Сообщения добавляются через add() с указанием вида и хранятся как
+    HistoryRecord; счётчики (токены, возраст в шагах, активные слепки DOM)
+    обновляются инкрементально. В API уходит to_wire().
+    compact() вызывается перед каждым запросом и работает пачками:
+    пока история в бюджете, она только растёт в конец (префикс для кэша
+    провайдера не меняется); при превышении — сжимается до low_watermark:
+    сначала старые слепки DOM, потом большие результаты инструментов,
+    и в конце самые старые шаги сворачиваются в короткую сводку.
+    """
+
+    def __init__(self, token_budget=48000, low_watermark=0.7, keep_recent_steps=4,
+                 evict_batch=4, tool_result_keep_chars=1500, digest_max_chars=4000, journal=None):
+        self.token_budget = token_budget
+        self.low_watermark = low_watermark
+        self.keep_recent_steps = keep_recent_steps # Последние шаги не трогаем никогда
+        self.evict_batch = evict_batch # Сколько лишних слепков копим перед чисткой
+        self.tool_result_keep_chars = tool_result_keep_chars
+        self.digest_max_chars = digest_max_chars
+
+        self.records = [] # HistoryRecord по порядку
+        self._active_snapshots = [] # Индексы неочищенных слепков по порядку
+        self.journal = journal # SessionJournal: каждое добавленное сообщение пишется и туда
+        self.total_tokens = 0
+        self.step = 0
+
+        self._encoder = None
+        if tiktoken:
+            try:
+                self._encoder = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                pass
+
+    # --- Добавление ---
+
+    def add(self, message, kind):
+        """message — dict, сообщение SDK или HistoryRecord"""
+        record = HistoryRecord.from_message(message, kind)
+        if kind in SNAPSHOT_KINDS:
+            self.step += 1 # Каждый шаг оркестратора начинается со слепка
+            self._active_snapshots.append(len(self.records))
+        record.tokens = self.count_tokens(record)
+        record.step = self.step
+        self.records.append(record)
+        self.total_tokens += record.tokens
+        if self.journal:
+            self.journal.append_record(record)
+
+    def extend(self, messages, kind):
+        for message in messages:
+            self.add(message, kind)
+
+    def to_wire(self):
+        return [record.to_wire() for record in self.records]
+
+    def restore(self, records):
+        """Восстанавливает историю из журнала (сам журнал при этом не пишется)"""
+        journal, self.journal = self.journal, None
+        try:
+            for record in records:
+                self.add(record, record.kind)
+        finally:
+            self.journal = journal
+        self.compact()
+
+    # --- Подсчёт токенов ---
+
+    def count_tokens(self, record):
+        text = record.content or ""
+        for tool_call in record.tool_calls:
+            text += tool_call.name + tool_call.arguments
+        return self._count_text(text) + 4 # Служебные токены на сообщение
+
+    def _count_text(self, text):
+        if self._encoder:
+            return len(self._encoder.encode(text, disallowed_special=()))
+        # ~4 байта UTF-8 на токен: и для латиницы, и для кириллицы это близко к правде
+        return len(text.encode("utf-8")) // 4
+
+    # --- Сжатие ---
+
+    def compact(self):
+        """Возвращает (было, стало) токенов, если что-то сжималось, иначе None"""
+        before = self.total_tokens
+
+        # 1. Устаревшие слепки DOM — пачкой, чтобы не менять префикс каждый шаг
+        stale = self._stale_snapshots()
+        if len(stale) >= self.evict_batch:
+            for i in stale:
+                self._strip_snapshot(i)
+
+        if self.total_tokens > self.token_budget:
+            target = int(self.token_budget * self.low_watermark)
+
+            # 2. По возрасту: оставшиеся устаревшие слепки и большие результаты инструментов
+            stale = set(self._stale_snapshots())
+            for i, record in enumerate(self.records):
+                if self.total_tokens <= target:
+                    break
+                if self.step - record.step < self.keep_recent_steps:
+                    break # Дальше только свежие шаги
+                if i in stale:
+                    self._strip_snapshot(i)
+                elif record.kind == TOOL:
+                    self._truncate_tool_result(i)
+
+            # Всё ещё много — режем большие результаты и в свежих шагах, кроме текущего
+            if self.total_tokens > target:
+                for i, record in enumerate(self.records):
+                    if record.kind == TOOL and record.step < self.step:
+                        self._truncate_tool_result(i)
+
+            # 3. Самые старые шаги — в сводку
+            if self.total_tokens > target:
+                self._summarize(target)
+
+        if self.total_tokens != before:
+            return before, self.total_tokens
+        return None
+
+    def _stale_snapshots(self):
+        """
+        Слепки, которые можно выкинуть: всё, кроме 2 последних и цепочки дельт
+        начиная с последнего полного слепка (дельты без базы бессмысленны).
+        """
+        last_full = -1
+        for i in self._active_snapshots:
+            if self.records[i].kind == SNAPSHOT_FULL:
+                last_full = i
+        return [i for i in self._active_snapshots[:-2] if i < last_full]
+
+    def _strip_snapshot(self, i):
+        url_line = self.records[i].content.split("\n")[0]
+        self._replace(i, f"{url_line}\n{DOM_REMOVED_STUB}")
+        self._active_snapshots.remove(i)
+
+    def _truncate_tool_result(self, i):
+        content = self.records[i].content or ""
+        if len(content) <= self.tool_result_keep_chars + len(TRUNCATED_MARK):
+            return
+        self._replace(i, content[:self.tool_result_keep_chars] + TRUNCATED_MARK)
+
+    def _replace(self, i, content):
+        record = self.records[i]
+        record.set_content(content)
+        tokens = self.count_tokens(record)
+        self.total_tokens += tokens - record.tokens
+        record.tokens = tokens
+
+    def _summarize(self, target):
+        """Сворачивает самый старый непрерывный кусок истории в одно сообщение-сводку"""
+        start = 1 if self.records and self.records[0].kind == SYSTEM else 0
+        end = start
+        folded = 0
+        last_full = max((i for i in self._active_snapshots if self.records[i].kind == SNAPSHOT_FULL), default=len(self.records))
+
+        for i in range(start, len(self.records)):
+            record = self.records[i]
+            if self.step - record.step < self.keep_recent_steps or i >= last_full:
+                break
+            folded += record.tokens
+            # Резать можно только там, где за сообщением не идут ответы его инструментов
+            next_kind = self.records[i + 1].kind if i + 1 < len(self.records) else None
+            if next_kind != TOOL:
+                end = i + 1
+                if self.total_tokens - folded <= target:
+                    break
+
+        if end - start < 2:
+            return
+
+        digest = HistoryRecord("system", self._build_digest(start, end), kind=DIGEST)
+        digest.tokens = self.count_tokens(digest)
+        digest.step = self.records[end - 1].step
+        removed = sum(record.tokens for record in self.records[start:end])
+
+        self.records[start:end] = [digest]
+        self.total_tokens += digest.tokens - removed
+        # Индексы сдвинулись — пересобираем (это редкое событие)
+        self._active_snapshots = [
+            i for i, record in enumerate(self.records)
+            if record.kind in SNAPSHOT_KINDS and DOM_REMOVED_STUB not in record.content
+        ]
+
+    def _build_digest(self, start, end):
+        lines = []
+        last_url = None
+        for record in self.records[start:end]:
+            kind = record.kind
+            content = record.content or ""
+            if kind == DIGEST:
+                lines.extend(content.split("\n")[1:])
+            elif kind == TASK:
+                lines.append(f"Задача пользователя: {_shorten(content, 1000)}")
+            elif kind in SNAPSHOT_KINDS:
+                url = content.split("\n")[0]
+                if url != last_url:
+                    lines.append(url)
+                    last_url = url
+            elif kind == ASSISTANT:
+                if content:
+                    lines.append(f"Ассистент: {_shorten(content, 300)}")
+                for tool_call in record.tool_calls:
+                    lines.append(f"{tool_call.name}({_shorten(tool_call.arguments, 150)})")
+            elif kind == TOOL:
+                lines.append(f"  → {_shorten(content, 150)}")
+            elif kind == REPLAY:
+                lines.append(_shorten(content, 600))
+
+        # Сама сводка тоже не должна расти бесконечно — старое отрезаем
+        body = "\n".join(lines)
+        if len(body) > self.digest_max_chars:
+            body = "…\n" + body[-self.digest_max_chars:].split("\n", 1)[-1]
+        return f"{DIGEST_HEADER}\n{body}"
+
+
+def _shorten(text, limit):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit] + "…"
@@ -1,42 +1,19 @@
 import json
+import os
+import time
 import asyncio
+import contextlib
+from openai.types.chat import ChatCompletionMessage
 from agent_core.openai_client import AIClient
-
-class Orchestrator:
-    def __init__(self, driver, log_callback):
-        self.driver = driver
-        self.ai = AIClient()
-        self.log = log_callback
-        self.history = [] 
-
-    def _optimize_context(self):
-        """Очистка старого контекста для экономии токенов"""
-        dom_messages_indices = []
-        for i, msg in enumerate(self.history):
-            if isinstance(msg, dict):
-                role = msg.get("role")
-                content = msg.get("content")
-            else:
-                role = getattr(msg, "role", None)
-                content = getattr(msg, "content", None)
-
-            if role == "user" and content and "Current URL:" in str(content):
-                dom_messages_indices.append(i)
-        
-        # Оставляем только 2 последних слепка DOM
-        if len(dom_messages_indices) > 2:
-            indices_to_clean = dom_messages_indices[:-2]
-            for i in indices_to_clean:
-                if isinstance(self.history[i], dict):
-                    original_content = self.history[i]["content"]
-                    if "\n" in original_content:
-                        url_line = original_content.split('\n')[0]
-                        self.history[i]["content"] = f"{url_line}\n[DOM content removed to save memory]"
-
-    async def process_task(self, user_text: str, model_name: str = None):
-        # 1. Инициализация системного промпта
-        if not self.history:
-            system_prompt = """
+from orchestrator import context_manager as ctx
+from orchestrator.context_manager import ContextManager
+from orchestrator.history_store import SessionJournal
+from orchestrator.tracing import Tracer
+from orchestrator.trajectory_cache import REPLAYABLE_TOOLS, ELEMENT_TOOLS, is_risky, page_key
+
+# Системный промпт и список инструментов — неизменяемый префикс каждого запроса.
+# Провайдер кэширует префикс промпта, поэтому эти байты не должны меняться между шагами.
+SYSTEM_PROMPT = """
                 Ты — быстрый и точный веб-агент (на базе GPT-5.1), управляющий реальным браузером через инструменты.
                 Твоя задача — максимально автономно выполнять запросы пользователя в вебе (почта, магазины, сервисы, видео, формы и т.п.), оставаясь безопасным и не выдумывая то, чего ты не прочитал на странице.
 
@@ -47,6 +24,8 @@ class Orchestrator:
                   НАБЛЮДАЙ → ПОНИМАЙ ИНТЕРФЕЙС → ПЛАНИРУЙ → ДЕЙСТВУЙ → ПРОВЕРЯЙ РЕЗУЛЬТАТ.
                 • Никогда не фантазируй содержимое страницы. Всё, что ты утверждаешь о странице, должно быть прочитано через инструменты.
                 • Если видишь служебный “снимок страницы” (текст вроде «Current URL: …» с фрагментами DOM/видимого текста), воспринимай это как наблюдение среды, а не как запрос пользователя. На такие сообщения не отвечай как пользователю — используй их, чтобы выбрать следующие действия.
+                • Снимок бывает полным («Interactive Elements:») или разностным («Interactive Elements (changes since previous snapshot…)»). В разностном: «+» — появился элемент, «~» — изменился, «- [id]» — исчез; остальные элементы из предыдущих снимков на месте и их id по-прежнему действительны.
+                • Запись элемента: «[id] тег 'текст'»; тип поля — через двоеточие (input:search), роль — через @ (div@button). «[5-28] button 'В корзину'» — подряд идущие одинаковые элементы с id 5, 6, …, 28 (по порядку на странице: 5 — первый). «[31] =5» — элемент такой же, как [5], но с собственным id 31. Элементы внутри встроенных фреймов (формы входа, оплаты, виджеты) идут под строкой «In frame 2 (адрес):» и имеют id с номером фрейма: «[2:7] button 'Оплатить'» — передавай такой id целиком, строкой "2:7". Действуй всегда по конкретному id.
 
                 ──────────────── 2. ДОСТУПНЫЕ ИНСТРУМЕНТЫ ────────────────
 
@@ -58,7 +37,7 @@ class Orchestrator:
 
                 • click_element(element_id)
                   – Клик по интерактивному элементу, которому заранее присвоен data-agent-id = element_id.
-                  – ID действителен только для текущего состояния страницы. После сильного изменения интерфейса (переход, открытие письма/карточки и т.п.) НЕ используй старые ID — сначала перечитай страницу.
+                  – ID стабилен: тот же элемент сохраняет свой ID между снимками и после перерисовки страницы. Но после сильного изменения интерфейса (переход, открытие письма/карточки и т.п.) сначала перечитай страницу и убедись, что нужный элемент на месте.
 
                 • type_text(element_id, text)
                   – Ввод текста в поле/форму.
@@ -69,16 +48,23 @@ class Orchestrator:
                   – Используй для запуска поиска или отправки формы, если это требуется после ввода текста.
 
                 • wait(seconds)
-                  – Пауза. Используй, если страница может не успеть подгрузиться после навигации/клика.
+                  – Ожидание догрузки страницы (не дольше seconds).
+                  – Обычно не нужен: после каждого действия браузер сам ждёт, пока страница успокоится. Используй, только если видишь, что контент ещё грузится.
 
-                • read_visible_text()
-                  – Возвращает текст, видимый на странице, и список интерактивных элементов с их id и описанием.
+                • read_visible_text(page, full_page)
+                  – Возвращает текст страницы: по умолчанию только основное содержимое (без меню, шапки и подвала), full_page=true — весь видимый текст.
+                  – Длинный текст отдаётся частями: если в ответе есть «Continued: read_visible_text(page=N)», а нужная информация ещё не найдена, запроси следующую часть.
                   – Это твой основной способ понять:
                     • где списки (писем, товаров, вакансий, уведомлений),
                     • какие есть кнопки/ссылки,
                     • что написано в темах, описаниях, подсказках.
                   – Перед тем как что-то классифицировать (спам, реклама, фишинг, важное, товар, вакансия и т.п.), всегда сначала вызывай этот инструмент.
 
+                • find_elements(query, page)
+                  – На больших страницах снимок показывает только элементы, подходящие к задаче, и пишет «(+N more elements not shown…)».
+                  – Если нужной кнопки/ссылки в снимке нет — ищи её через find_elements(query="слова из подписи"); без query — листай оставшиеся элементы по страницам.
+                  – Найденные id действительны так же, как id из снимка.
+
                 • ask_user(question)
                   – Вопрос пользователю.
                   – Используй редко и только когда без уточнения нельзя безопасно действовать или критерий действия непонятен.
@@ -246,129 +232,665 @@ class Orchestrator:
 
                 """
 
+# Инструменты, которые только читают страницу: их можно выполнять параллельно друг с другом.
+# Всё остальное (включая wait, ask_user, task_complete) выполняется строго по порядку.
+READ_ONLY_TOOLS = {"read_visible_text", "find_elements"}
+
+
+class _ToolBatch:
+    """Состояние одной пачки вызовов: флаги останова и время, пока работал хоть один инструмент"""
+
+    def __init__(self):
+        self.skip_remaining = False
+        self.stop_outcome = None # Выход из process_task (например, ждем юзера)
+        self.busy_ms = 0
+        self._running = 0
+        self._busy_since = 0
+
+    def started(self):
+        if not self._running:
+            self._busy_since = time.perf_counter()
+        self._running += 1
+
+    def finished(self):
+        self._running -= 1
+        if not self._running:
+            self.busy_ms += (time.perf_counter() - self._busy_since) * 1000
+
+
+class Orchestrator:
+    def __init__(self, driver, log_callback, delta_snapshots=True, max_delta_chain=8, stream=True,
+                 token_budget=48000, evict_batch=4, trace_dir=None, trajectory_cache=None,
+                 journal_path=None, router=None, request_policy=None):
+        self.driver = driver
+        # request_policy (LLMRequestPolicy) — дедлайны, повторы и hedge запросов к модели;
+        # общий на несколько оркестраторов, чтобы копить статистику задержек
+        self.ai = AIClient(request_policy)
+        self.log = log_callback
+        # Журнал на диске: после падения историю можно поднять через restore()
+        self.journal = SessionJournal(journal_path) if journal_path else None
+        # История в пределах бюджета токенов; self.history — то, что уходит в API
+        self.context = ContextManager(token_budget=token_budget, evict_batch=evict_batch, journal=self.journal)
+        # Потоковый ответ модели: инструменты стартуют, не дожидаясь конца сообщения
+        self.stream = stream
+
+        # Инкрементальные слепки DOM: после полного слепка шлём только изменения.
+        # Цепочку дельт периодически обрываем полным слепком, чтобы старое можно было чистить.
+        self.delta_snapshots = delta_snapshots
+        self.max_delta_chain = max_delta_chain
+        self._deltas_since_full = 0
+
+        # Замеры по шагам последней задачи (см. _record_step)
+        self.step_metrics = []
+        self._llm_ms = 0
+        self._tools_ms = 0
+
+        # Спаны последней задачи; при заданном trace_dir каждая задача сохраняется на диск
+        self.tracer = Tracer()
+        self.trace_dir = trace_dir
+        self._task_count = 0
+
+        # Кэш удачных прогонов (TrajectoryCache): известные задачи повторяются без LLM.
+        # _recording — шаги текущей задачи (None — не записываем)
+        self.trajectories = trajectory_cache
+        self._recording = None
+        self._recording_field = None # Поле, в которое последним вводили текст (для Enter)
+        self._trajectory_key = None
+        self._trajectory_slots = []
+
+        # ModelRouter: дешёвая модель на рутинных шагах, сильная (model_name) — на трудных.
+        # None — каждый шаг идёт в model_name
+        self.router = router
+
+    @property
+    def history(self):
+        return self.context.to_wire()
 
-            self.history.append({"role": "system", "content": system_prompt})
+    async def process_task(self, user_text: str, model_name: str = None):
+        """
+        Выполняет задачу (или продолжает диалог). Возвращает итог:
+        {"status": "completed" | "needs_user" | "error" | "max_steps", "summary": str}
+        user_text=None — продолжить прерванную задачу (см. restore).
+        """
+        self.tracer.reset()
+        self._task_count += 1
+        with self.tracer.span("task", "agent", task=(user_text or "[resume]")[:200]) as span:
+            outcome = await self._run_task(user_text, model_name)
+            span.set(status=outcome["status"], steps=len(self.step_metrics))
+            self._save_trajectory(outcome)
+            policy = getattr(self.driver, "resource_policy", None)
+            if policy:
+                span.set(resources=policy.stats())
+            if self.router:
+                span.set(models=self.router.stats())
+            span.set(llm_requests=self.ai.requests.stats())
+        if self.router and self.router.usage:
+            self.log("metrics", f"Models: {self.router.summary()}", "")
+        if self.journal:
+            # Журнал — заново из текущей (сжатой) истории: размер и время restore не растут от запуска к запуску
+            self.journal.rewrite(
+                self.context.records, [{"type": "task_end", "status": outcome["status"], "summary": outcome["summary"]}]
+            )
+            await self._checkpoint()
+        if self.trace_dir:
+            self.export_trace(self.trace_dir)
+        return outcome
+
+    async def restore(self):
+        """
+        Поднимает историю из журнала после перезапуска, если последняя задача не
+        завершилась (процесс упал или был закрыт посреди неё). Куки и LocalStorage
+        драйвер уже загрузил из своего state_file; здесь возвращаемся на последнюю страницу.
+        Возвращает текст прерванной задачи (продолжить — process_task(None)) или None;
+        если прерванной задачи нет, журнал сбрасывается и сессия начинается с чистого листа.
+        """
+        if not self.journal or not self.journal.exists():
+            return None
+        records, events = self.journal.load()
+        tasks = [index for index, record in enumerate(records) if record.kind == ctx.TASK]
+        finished = not tasks or any(
+            event.get("type") == "task_end" and event["at"] > tasks[-1] for event in events
+        )
+        if finished:
+            self.journal.reset()
+            return None
+        self.context.restore(records)
+
+        last_url = None
+        for record in reversed(records):
+            if record.kind in ctx.SNAPSHOT_KINDS and record.content.startswith("Current URL: "):
+                last_url = record.content.split("\n")[0][len("Current URL: "):]
+                break
+        if last_url and last_url.startswith("http"):
+            await self.driver.navigate(last_url)
+
+        self.log("system", f"♻️ Сессия восстановлена из журнала ({len(records)} сообщений)", "")
+        return records[tasks[-1]].content
+
+    async def _checkpoint(self):
+        """Журнал и куки — на диск, чтобы после падения продолжить с этого места"""
+        self.journal.flush()
+        await self.driver.save_state()
+
+    def export_trace(self, directory):
+        """Сохраняет трассу последней задачи: task-N.trace.json (Chrome) и task-N.jsonl"""
+        base = os.path.join(directory, f"task-{self._task_count}")
+        try:
+            self.tracer.export_chrome_trace(base + ".trace.json")
+            self.tracer.export_jsonl(base + ".jsonl")
+        except Exception as e:
+            print(f"[Orchestrator] Trace export failed: {e}")
+
+    async def _run_task(self, user_text, model_name):
+        # 1. Инициализация системного промпта
+        fresh = not self.context.records
+        if fresh:
+            self.context.add({"role": "system", "content": SYSTEM_PROMPT}, ctx.SYSTEM)
             self.log("system", "🚀 Новая сессия (GPT-5.1)", "")
 
-        self.history.append({"role": "user", "content": user_text})
+        if user_text is not None:
+            self.context.add({"role": "user", "content": user_text}, ctx.TASK)
         
         step = 0
         max_steps = 25
-
-        if len(self.history) > 3: self.log("system", "Выполняю...", "")
+        outcome = {"status": "max_steps", "summary": f"Step limit ({max_steps}) reached"}
+        self.step_metrics = []
+        if self.router:
+            self.router.start_task()
+
+        # Записываем и повторяем только задачи с чистого листа: продолжение диалога зависит от истории
+        self._recording = None
+        if self.trajectories and fresh and user_text is not None:
+            self._start_recording(user_text)
+            entry = self.trajectories.lookup(self._trajectory_key)
+            if entry:
+                await self._replay_trajectory(entry)
+
+        if len(self.context.records) > 3: self.log("system", "Выполняю...", "")
         else: self.log("system", "Анализ задачи...", "")
 
         while step < max_steps:
             step += 1
-            self._optimize_context()
+            with self.tracer.span("step", "agent", step=step) as step_span:
+                compacted = self.context.compact()
+                if compacted:
+                    self.log("metrics", f"Context compacted: {compacted[0]} → {compacted[1]} tokens", "")
+                    step_span.set(compacted_tokens=compacted)
+                    if self.journal:
+                        self.journal.rewrite(self.context.records)
+
+                # 2. Читаем страницу (первый шаг задачи — всегда полный слепок)
+                dom_started = time.perf_counter()
+                try:
+                    use_delta = self.delta_snapshots and step > 1 and self._deltas_since_full < self.max_delta_chain
+                    with self.tracer.span("get_page_content", "dom", step=step, delta=use_delta) as span:
+                        page_state = await self.driver.get_page_content(delta=use_delta, query=self._relevance_query())
+                        span.set(
+                            mode=self.driver.last_snapshot_mode,
+                            elements=self.driver.last_snapshot_elements,
+                            snapshot_chars=len(page_state),
+                            script=self.driver.last_snapshot_timing,
+                        )
+                    if "Error" in page_state:
+                         self.log("error", "Ошибка чтения страницы", page_state)
+                         outcome = {"status": "error", "summary": page_state}
+                         break
+                    if self.driver.last_snapshot_mode == "full":
+                        self._deltas_since_full = 0
+                        kind = ctx.SNAPSHOT_FULL
+                    else:
+                        self._deltas_since_full += 1
+                        kind = ctx.SNAPSHOT_DELTA
+                    self.context.add({"role": "user", "content": page_state}, kind)
+                    if self._recording is not None:
+                        self._recording.append([])
+                except Exception as e:
+                    self.log("error", "Браузер недоступен", str(e))
+                    outcome = {"status": "error", "summary": f"Browser unavailable: {e}"}
+                    break
+
+                dom_ms = (time.perf_counter() - dom_started) * 1000
+                context_tokens = self.context.total_tokens
+                settle_before = self.driver.settle_ms_total
+                self._llm_ms = self._tools_ms = 0
+
+                # 3. AI Думает (в потоковом режиме инструменты исполняются, пока ответ ещё идёт)
+                strong_model = model_name or self.ai.model
+                model = strong_model
+                if self.router:
+                    model, reason = self.router.choose(strong_model, step, self.driver.last_snapshot_elements)
+                    step_span.set(model=model, route=reason)
+                message, tool_messages, stop_outcome = await self._ask_model(model, step, context_tokens)
+                if self.router:
+                    self.router.record(model, self._llm_ms, self.ai.last_usage)
+                    if not message and not tool_messages and model != strong_model:
+                        # Дешёвая модель не ответила (нет доступа, перегрузка) — шаг заново на сильной
+                        self.log("metrics", f"{model} не ответила, повторяю шаг на {strong_model}", "")
+                        self.router.escalate()
+                        model = strong_model
+                        step_span.set(model=model, route="fallback")
+                        message, tool_messages, stop_outcome = await self._ask_model(model, step, context_tokens)
+                        self.router.record(model, self._llm_ms, self.ai.last_usage)
+                    elif self.ai.last_error and model != strong_model:
+                        # Ответ дешёвой модели оборвался после части вызовов: они уже исполнены
+                        # и в истории, дальше — сильная модель
+                        self.router.escalate()
+
+                if not message:
+                    self.log("error", "AI Silent", self.ai.last_error or "")
+                    outcome = {"status": "error", "summary": f"AI Silent: {self.ai.last_error}" if self.ai.last_error else "AI Silent"}
+                    break
+
+                self._log_usage()
+                self._record_step(step, dom_ms, context_tokens, len(page_state),
+                                  self.driver.settle_ms_total - settle_before, model)
+                step_span.set(context_tokens=context_tokens, tool_calls=len(tool_messages))
+                self.context.add(message, ctx.ASSISTANT)
+                self.context.extend(tool_messages, ctx.TOOL)
+                if self.router:
+                    self.router.observe(
+                        [(call.function.name, call.function.arguments) for call in message.tool_calls or []],
+                        [tool_message["content"] for tool_message in tool_messages]
+                    )
+                if self.journal:
+                    await self._checkpoint()
 
-            # 2. Читаем страницу
-            try:
-                page_state = await self.driver.get_page_content()
-                if "Error" in page_state:
-                     self.log("error", "Ошибка чтения страницы", page_state)
-                     break
-                self.history.append({"role": "user", "content": page_state})
-            except Exception as e:
-                self.log("error", "Браузер недоступен", str(e))
-                break
-
-            # 3. AI Думает
-            self.log("thinking_start", "", "") 
-            message = await self.ai.get_next_action(self.history, model_override=model_name)
-            self.log("thinking_end", "", "")
-
-            if not message:
-                self.log("error", "AI Silent", "")
-                break
+                # Если был ask_user или task_complete, выходим из цикла полностью
+                if stop_outcome:
+                    return stop_outcome
 
-            self.history.append(message)
-
-            if message.tool_calls:
-                
-                # Флаги управления потоком
-                skip_remaining = False 
-                should_break_loop = False # Выход из process_task (например, ждем юзера)
-                
-                for tool_call in message.tool_calls:
-                    func_name = tool_call.function.name
-                    
-                    # Если предыдущий инструмент в пачке упал, остальные пропускаем, 
-                    # НО ОБЯЗАТЕЛЬНО записываем их в историю как Skipped!
-                    if skip_remaining:
-                        self.history.append({
-                            "tool_call_id": tool_call.id,
-                            "role": "tool",
-                            "name": func_name,
-                            "content": "Skipped because previous action in batch failed or requested stop."
-                        })
-                        continue
-
-                    # Выполнение
-                    args_str = tool_call.function.arguments
-                    try: args = json.loads(args_str)
-                    except: args = {}
-                    
-                    self.log("tool_call", func_name, args_str)
-                    
-                    result = "Done"
-                    
-                    try:
-                        if func_name == "navigate":
-                            result = await self.driver.navigate(args["url"])
-                        
-                        elif func_name == "click_element":
-                            result = await self.driver.click_element(args["element_id"])
-                            # Если ошибка клика, прерываем остальные действия в батче, 
-                            # чтобы перечитать DOM
-                            if "Error" in result: 
-                                skip_remaining = True
-                        
-                        elif func_name == "type_text":
-                            result = await self.driver.type_text(args["element_id"], args["text"])
-                        
-                        elif func_name == "press_key":
-                            result = await self.driver.press_key(args["key"])
-
-                        elif func_name == "wait":
-                            result = await self.driver.wait(args["seconds"])
-                        
-                        elif func_name == "read_visible_text":
-                            result = await self.driver.read_visible_text()
-                            self.log("tool_result", "Text extracted", "Текст получен (скрыт)")
-                        
-                        elif func_name == "ask_user":
-                            self.log("agent", f"🔒 {args['question']}", "")
-                            self.log("system", "✋ Жду ответа...", "")
-                            result = "User interaction requested."
-                            should_break_loop = True 
-                            skip_remaining = True # Остальные действия пропускаем
-                        
-                        elif func_name == "task_complete":
-                            self.log("success", args.get('summary', 'Done'), "")
-                            result = "Completed"
-                            should_break_loop = True
-                            skip_remaining = True
-
-                    except Exception as e:
-                        result = f"Error: {e}"
-                        skip_remaining = True # Ошибка выполнения -> стоп батч
-
-                    if func_name != "read_visible_text":
-                        self.log("tool_result", str(result), str(result))
-                    
-                    self.history.append({
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": func_name,
-                        "content": str(result)
-                    })
+                if not message.tool_calls and message.content and not self.stream:
+                    self.log("agent", message.content, "")
 
-                # Если был ask_user или task_complete, выходим из цикла полностью
-                if should_break_loop:
-                    return
+        return outcome
 
-            else:
-                if message.content: self.log("agent", message.content, "")
-                
-            await asyncio.sleep(0.1)
\ No newline at end of file
+    def _relevance_query(self):
+        """Текст, под который ранжируются элементы слепка: текущая задача и последняя реплика модели"""
+        parts = []
+        for record in reversed(self.context.records):
+            if record.kind == ctx.TASK:
+                parts.append(record.content or "")
+                break
+            if record.kind == ctx.ASSISTANT and record.content and not parts:
+                parts.append(record.content) # Только самая свежая реплика модели в текущей задаче
+        return " ".join(parts)
+
+    def _record_step(self, step, dom_ms, context_tokens, snapshot_chars, settle_ms, model=None):
+        """Разбивка времени шага: чтение DOM, ожидание LLM, инструменты (из них — ожидание страницы)"""
+        usage = self.ai.last_usage
+        self.step_metrics.append({
+            "step": step,
+            "model": model,
+            "dom_ms": round(dom_ms, 1),
+            "llm_ms": round(self._llm_ms, 1),
+            "tools_ms": round(self._tools_ms, 1),
+            "settle_ms": round(settle_ms, 1),
+            "snapshot_mode": self.driver.last_snapshot_mode,
+            "snapshot_chars": snapshot_chars,
+            "context_tokens": context_tokens,
+            "prompt_tokens": usage.prompt_tokens if usage else None,
+            "cached_tokens": self.ai.cached_tokens(usage) if usage else None,
+            "completion_tokens": usage.completion_tokens if usage else None,
+        })
+
+    async def _ask_model(self, model, step, context_tokens):
+        """Запрос к модели и исполнение её вызовов. Возвращает (сообщение, результаты инструментов, итог)"""
+        self.log("thinking_start", "", "")
+        self._llm_ms = 0
+        if self.stream:
+            return await self._stream_step(model, step, context_tokens)
+
+        llm_started = time.perf_counter()
+        with self.tracer.span("get_next_action", "llm", step=step, context_tokens=context_tokens) as span:
+            message = await self.ai.get_next_action(self.history, model_override=model)
+            self._trace_llm(span, message, model)
+        self._llm_ms = (time.perf_counter() - llm_started) * 1000
+        self.log("thinking_end", "", "")
+        tool_messages, stop_outcome = [], None
+        if message and message.tool_calls:
+            queue = asyncio.Queue()
+            for tool_call in message.tool_calls:
+                queue.put_nowait(tool_call)
+            queue.put_nowait(None)
+            tool_messages, stop_outcome = await self._consume_tool_calls(queue)
+        return message, tool_messages, stop_outcome
+
+    def _trace_llm(self, span, message, model_name):
+        """Токены и число вызовов инструментов в спан запроса к модели"""
+        usage = self.ai.last_usage
+        call = self.ai.requests.last_call or {}
+        span.set(
+            model=model_name or self.ai.model,
+            attempts=call.get("attempts"),
+            hedged=call.get("hedged"),
+            hedge_won=call.get("hedge_won"),
+            tool_calls=len(message.tool_calls or []) if message else 0,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            cached_tokens=self.ai.cached_tokens(usage) if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+        )
+
+    def _log_usage(self):
+        """Токены последнего запроса, включая попавшие в кэш префикса"""
+        usage = self.ai.last_usage
+        if not usage:
+            return
+        cached = self.ai.cached_tokens(usage)
+        share = cached * 100 // usage.prompt_tokens if usage.prompt_tokens else 0
+        self.log(
+            "metrics",
+            f"Tokens: prompt {usage.prompt_tokens} (cached {cached}, {share}%), completion {usage.completion_tokens}",
+            ""
+        )
+
+    async def _stream_step(self, model_name, step, context_tokens):
+        """
+        Один шаг в потоковом режиме: текст ассистента сразу уходит в лог,
+        а каждый собранный вызов инструмента — в очередь исполнителя.
+        """
+        queue = asyncio.Queue()
+        consumer = asyncio.create_task(self._consume_tool_calls(queue))
+        first_delta = True
+        dispatched = [] # Вызовы, ушедшие в исполнение
+
+        def on_first_delta():
+            nonlocal first_delta
+            if first_delta:
+                first_delta = False
+                self.log("thinking_end", "", "")
+
+        def on_text(delta):
+            on_first_delta()
+            self.log("agent_delta", delta, "")
+
+        def on_tool_call(tool_call):
+            on_first_delta()
+            dispatched.append(tool_call)
+            queue.put_nowait(tool_call)
+
+        llm_started = time.perf_counter()
+        try:
+            with self.tracer.span("stream_next_action", "llm", step=step, context_tokens=context_tokens) as span:
+                message = await self.ai.stream_next_action(
+                    self.history, model_override=model_name, on_text=on_text, on_tool_call=on_tool_call
+                )
+                self._trace_llm(span, message, model_name)
+            self._llm_ms = (time.perf_counter() - llm_started) * 1000
+        except BaseException:
+            # Задачу отменили (таймаут пакетного прогона, закрытие сессии) посреди ответа:
+            # уже поставленные в очередь клики не должны идти в закрывающуюся сессию
+            consumer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await consumer
+            raise
+        finally:
+            queue.put_nowait(None)
+            on_first_delta()
+        tool_messages, stop_outcome = await consumer
+        if message is None and dispatched:
+            # Поток оборвался, но часть вызовов уже исполнена и страница изменилась:
+            # сообщение ассистента собираем из них, чтобы история совпадала с браузером
+            self.log("error", f"Ответ модели оборвался после {len(dispatched)} вызов(ов)", self.ai.last_error or "")
+            message = ChatCompletionMessage(role="assistant", content=None, tool_calls=dispatched)
+        return message, tool_messages, stop_outcome
+
+    async def _consume_tool_calls(self, queue):
+        """
+        Исполняет вызовы инструментов по мере их поступления в очередь (None — конец пачки).
+        Подряд идущие read-only вызовы выполняются параллельно; вызов, меняющий
+        страницу, ждёт завершения всех предыдущих и выполняется один.
+        Возвращает (сообщения role=tool в порядке вызовов, итог задачи или None).
+        """
+        batch = _ToolBatch()
+        slots = [] # По одному на вызов, в порядке вызовов
+        reads = [] # Выполняющиеся read-only вызовы текущей группы
+
+        try:
+            while True:
+                tool_call = await queue.get()
+                if tool_call is None:
+                    break
+                read_only = tool_call.function.name in READ_ONLY_TOOLS
+                if reads and not read_only:
+                    await asyncio.gather(*reads)
+                    reads = []
+
+                slot = {"tool_call_id": tool_call.id, "role": "tool", "name": tool_call.function.name, "content": None}
+                slots.append(slot)
+
+                # Если предыдущий инструмент в пачке упал, остальные пропускаем, 
+                # НО ОБЯЗАТЕЛЬНО записываем их в историю как Skipped!
+                if batch.skip_remaining:
+                    slot["content"] = "Skipped because previous action in batch failed or requested stop."
+                    continue
+
+                if read_only:
+                    reads.append(asyncio.create_task(self._run_tool(tool_call, slot, batch)))
+                else:
+                    await self._run_tool(tool_call, slot, batch)
+
+            if reads:
+                await asyncio.gather(*reads)
+        except asyncio.CancelledError:
+            # Отмена: параллельные чтения не должны пережить шаг
+            for read in reads:
+                read.cancel()
+            await asyncio.gather(*reads, return_exceptions=True)
+            raise
+        self._tools_ms += batch.busy_ms
+        return slots, batch.stop_outcome
+
+    async def _run_tool(self, tool_call, slot, batch):
+        """Исполняет один вызов и записывает результат в его slot"""
+        func_name = tool_call.function.name
+        args_str = tool_call.function.arguments
+        try: args = json.loads(args_str)
+        except: args = {}
+
+        self.log("tool_call", func_name, args_str)
+
+        action = None
+        if self._recording is not None:
+            action = self._recordable_action(func_name, args)
+
+        batch.started()
+        settle_before = self.driver.settle_ms_total
+        try:
+            with self.tracer.span(func_name, "tool", args=args_str[:300]) as span:
+                try:
+                    result, stop_batch, outcome = await self._execute_tool(func_name, args)
+                    if stop_batch:
+                        batch.skip_remaining = True
+                    if outcome:
+                        batch.stop_outcome = outcome
+                except Exception as e:
+                    result = f"Error: {e}"
+                    batch.skip_remaining = True # Ошибка выполнения -> стоп батч
+                span.set(
+                    result=str(result)[:300],
+                    result_chars=len(str(result)),
+                    settle_ms=round(self.driver.settle_ms_total - settle_before, 1),
+                )
+        finally:
+            # И при отмене (таймаут задачи): иначе счётчик занятости пачки остаётся открытым
+            batch.finished()
+
+        if func_name != "read_visible_text":
+            self.log("tool_result", str(result), str(result))
+        slot["content"] = str(result)
+
+        if action and self._recording is not None and not str(result).startswith("Error"):
+            self._recording[-1].append(action)
+
+    # --- Кэш траекторий ---
+
+    def _start_recording(self, user_text):
+        start_url = self.driver.page.url if self.driver.page else ""
+        self._trajectory_key, self._trajectory_slots = self.trajectories.key_for(start_url, user_text)
+        self._recording = []
+        self._recording_field = None
+
+    def _recordable_action(self, func_name, args):
+        """
+        Действие для записи (или None). Прогон не записывается вовсе, если элемент
+        не опознать при повторе (нет отпечатка или текста: у чекбоксов отпечаток —
+        одна позиция в DOM), если в нём было ask_user или действие, которое
+        удаляет/отправляет: повтор прошёл бы без подтверждения пользователя.
+        """
+        if func_name == "ask_user":
+            self._recording = None
+            return None
+        if func_name not in REPLAYABLE_TOOLS:
+            return None
+        fp = text = None
+        if func_name in ELEMENT_TOOLS:
+            fp = self.driver.element_fingerprint(args.get("element_id"))
+            item = self.driver.element_item(args.get("element_id"))
+            if not fp or not item or not item.get("text") or is_risky(func_name, item):
+                self._recording = None
+                return None
+            text = item["text"][:40]
+            if func_name == "type_text":
+                self._recording_field = item
+        elif is_risky(func_name, {}, self._recording_field):
+            self._recording = None
+            return None
+        return {"name": func_name, "args": dict(args), "fp": fp, "text": text, "url": page_key(self.driver.page.url)}
+
+    def _save_trajectory(self, outcome):
+        """Удачный прогон с участием модели — в кэш траекторий"""
+        if self._recording is None or outcome["status"] != "completed":
+            return
+        self.trajectories.record(
+            self._trajectory_key, self._trajectory_slots, self._recording,
+            outcome["summary"], self.driver.page.url
+        )
+        self._recording = None
+
+    async def _replay_trajectory(self, entry):
+        """
+        Повторяет сохранённый прогон без LLM, сверяя страницу перед каждым действием:
+        тот же адрес и целевой элемент (по отпечатку и тексту) на месте.
+        Всегда возвращает None: дальше работает модель — продолжает с места
+        расхождения или проверяет результат на странице. Итог записанного прогона
+        мог зависеть от содержимого страницы (текста или слепка), поэтому
+        сохранённый summary как есть не отдаём.
+        """
+        self.log("system", f"⚡ Известная задача: повторяю {len(entry['steps'])} шаг(ов) без запросов к модели", "")
+        done = []
+        divergence = None
+
+        with self.tracer.span("replay", "agent", steps=len(entry["steps"])) as span:
+            for step in entry["steps"]:
+                self._recording.append([])
+                for action in step:
+                    divergence = await self._replay_action(action, done)
+                    if divergence:
+                        break
+                if divergence:
+                    break
+            if not divergence and page_key(self.driver.page.url) != entry["final_url"]:
+                divergence = f"ended on {page_key(self.driver.page.url)} instead of {entry['final_url']}"
+            span.set(replayed_actions=len(done), divergence=divergence)
+
+        actions = "; ".join(done) or "ничего"
+        if divergence:
+            self.trajectories.mark_failure(self._trajectory_key)
+            self.log("system", f"↪ Сценарий разошёлся со страницей ({divergence}), продолжаю с моделью", "")
+            note = (f"[Автоповтор известного сценария] Уже выполнено: {actions}. "
+                    f"Дальше сценарий разошёлся со страницей ({divergence}). Продолжи задачу с текущего состояния.")
+            self.context.add({"role": "user", "content": note}, ctx.REPLAY)
+            return None
+
+        self.trajectories.mark_hit(self._trajectory_key)
+        note = (f"[Автоповтор известного сценария] Уже выполнено: {actions}. "
+                f"В прошлый раз итог был таким: {entry['summary']}. "
+                f"Проверь результат на текущей странице и заверши задачу.")
+        self.context.add({"role": "user", "content": note}, ctx.REPLAY)
+        return None
+
+    async def _replay_action(self, action, done):
+        """Одно действие из кэша. Возвращает причину расхождения или None"""
+        current = page_key(self.driver.page.url)
+        if action["name"] != "navigate" and current != action["url"]:
+            return f"expected page {action['url']}, got {current}"
+
+        args = self.trajectories.fill_args(action, self._trajectory_slots)
+        if action["name"] in ELEMENT_TOOLS:
+            if not action.get("text"):
+                return f"target of {action['name']} has no text to recognise it by"
+            await self.driver.get_page_content() # Свежие id для отпечатков текущей страницы
+            element_id = await self.driver.find_by_fingerprint(action["fp"])
+            item = self.driver.element_item(element_id) if element_id is not None else None
+            if not item or item.get("text", "")[:40] != action["text"]:
+                return f"target of {action['name']} is not on the page"
+            if is_risky(action["name"], item):
+                return f"{action['name']} on '{action['text']}' needs the user's confirmation"
+            args["element_id"] = element_id
+
+        args_str = json.dumps(args, ensure_ascii=False)
+        self.log("tool_call", action["name"], args_str)
+        with self.tracer.span(action["name"], "tool", args=args_str[:300], replay=True) as span:
+            try:
+                result, _, _ = await self._execute_tool(action["name"], args)
+            except Exception as e:
+                result = f"Error: {e}"
+            span.set(result=str(result)[:300])
+        self.log("tool_result", str(result), str(result))
+        if str(result).startswith("Error"):
+            return str(result)
+
+        self._recording[-1].append({"name": action["name"], "args": args, "fp": action["fp"],
+                                    "text": action.get("text"), "url": current})
+        done.append(f"{action['name']}({args_str})")
+        return None
+
+    async def _execute_tool(self, func_name, args):
+        """
+        Исполняет один инструмент. Возвращает (результат, прервать ли остаток пачки,
+        итог задачи или None).
+        """
+        result = "Done"
+        stop_batch = False
+        stop_outcome = None
+
+        if func_name == "navigate":
+            result = await self.driver.navigate(args["url"])
+
+        elif func_name == "click_element":
+            result = await self.driver.click_element(args["element_id"])
+            # Если ошибка клика, прерываем остальные действия в батче,
+            # чтобы перечитать DOM
+            if "Error" in result:
+                stop_batch = True
+
+        elif func_name == "type_text":
+            result = await self.driver.type_text(args["element_id"], args["text"])
+
+        elif func_name == "press_key":
+            result = await self.driver.press_key(args["key"])
+
+        elif func_name == "wait":
+            result = await self.driver.wait(args["seconds"])
+
+        elif func_name == "read_visible_text":
+            result = await self.driver.read_visible_text(args.get("page", 1), args.get("full_page", False))
+            self.log("tool_result", "Text extracted", "Текст получен (скрыт)")
+
+        elif func_name == "find_elements":
+            result = await self.driver.find_elements(args.get("query", ""), args.get("page", 1))
+
+        elif func_name == "ask_user":
+            self.log("agent", f"🔒 {args['question']}", "")
+            self.log("system", "✋ Жду ответа...", "")
+            result = "User interaction requested."
+            stop_outcome = {"status": "needs_user", "summary": args['question']}
+            stop_batch = True # Остальные действия пропускаем
+
+        elif func_name == "task_complete":
+            self.log("success", args.get('summary', 'Done'), "")
+            result = "Completed"
+            stop_outcome = {"status": "completed", "summary": args.get('summary', 'Done')}
+            stop_batch = True
+
+        return result, stop_batch, stop_outcome
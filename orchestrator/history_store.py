@@ -0,0 +1,189 @@
+import json
+import os
+
+
+class ToolCallRecord:
+    __slots__ = ("id", "name", "arguments")
+
+    def __init__(self, id, name, arguments):
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+
+    def to_wire(self):
+        return {"id": self.id, "type": "function", "function": {"name": self.name, "arguments": self.arguments}}
+
+
+class HistoryRecord:
+    """
+    Одно сообщение истории. Всё, что нужно ContextManager (вид, токены, шаг),
+    лежит здесь же; в формат OpenAI переводит только to_wire().
+    """
+    __slots__ = ("role", "content", "tool_calls", "tool_call_id", "name", "kind", "tokens", "step", "_wire")
+
+    def __init__(self, role, content=None, tool_calls=(), tool_call_id=None, name=None, kind=None):
+        self.role = role
+        self.content = content
+        self.tool_calls = tuple(tool_calls)
+        self.tool_call_id = tool_call_id
+        self.name = name
+        self.kind = kind
+        self.tokens = 0
+        self.step = 0
+        self._wire = None # Кэш to_wire(); сбрасывается в set_content()
+
+    @classmethod
+    def from_message(cls, message, kind):
+        """Единственное место, где разбираем dict и объекты SDK"""
+        if isinstance(message, HistoryRecord):
+            message.kind = kind
+            return message
+        if isinstance(message, dict):
+            return cls(
+                message["role"], message.get("content"),
+                tool_call_id=message.get("tool_call_id"), name=message.get("name"), kind=kind
+            )
+        tool_calls = [
+            ToolCallRecord(call.id, call.function.name, call.function.arguments)
+            for call in (message.tool_calls or [])
+        ]
+        return cls(message.role, message.content, tool_calls=tool_calls, kind=kind)
+
+    def set_content(self, content):
+        self.content = content
+        self._wire = None
+
+    def to_wire(self):
+        """Сообщение в формате chat completions; одни и те же байты на каждом запросе"""
+        if self._wire is None:
+            wire = {"role": self.role, "content": self.content}
+            if self.tool_calls:
+                wire["tool_calls"] = [call.to_wire() for call in self.tool_calls]
+            if self.tool_call_id is not None:
+                wire["tool_call_id"] = self.tool_call_id
+            if self.name is not None:
+                wire["name"] = self.name
+            self._wire = wire
+        return self._wire
+
+    def to_json(self):
+        data = self.to_wire()
+        return dict(data, kind=self.kind)
+
+    @classmethod
+    def from_json(cls, data):
+        tool_calls = [
+            ToolCallRecord(call["id"], call["function"]["name"], call["function"]["arguments"])
+            for call in data.get("tool_calls", [])
+        ]
+        return cls(
+            data["role"], data.get("content"), tool_calls=tool_calls,
+            tool_call_id=data.get("tool_call_id"), name=data.get("name"), kind=data.get("kind")
+        )
+
+
+def drop_unanswered_calls(records):
+    """
+    Обрезает хвост истории, если последний вызов инструментов остался без ответов
+    (процесс упал посреди шага): API не примет assistant с tool_calls без tool-сообщений.
+    """
+    for index in range(len(records) - 1, -1, -1):
+        record = records[index]
+        if record.role != "assistant" or not record.tool_calls:
+            continue
+        answered = {later.tool_call_id for later in records[index + 1:] if later.role == "tool"}
+        if all(call.id in answered for call in record.tool_calls):
+            return records
+        return records[:index]
+    return records
+
+
+class SessionJournal:
+    """
+    Журнал сессии на диске (JSONL): каждое добавленное сообщение и итог каждой задачи.
+    Пишется в конец и сбрасывается на диск после каждого шага, так что
+    после падения процесса историю можно восстановить (см. Orchestrator.restore).
+    После сжатия контекста и в конце задачи журнал переписывается текущей историей
+    (rewrite), чтобы не расти без предела.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def append_record(self, record):
+        self._write({"type": "message", "message": record.to_json()})
+
+    def append_event(self, type, **data):
+        self._write(dict(data, type=type))
+
+    def flush(self):
+        if self._file:
+            try:
+                self._file.flush()
+            except Exception as e:
+                print(f"[SessionJournal] Flush failed: {e}")
+
+    def reset(self):
+        """Новая сессия — старый журнал больше не нужен"""
+        self.close()
+        try:
+            if os.path.exists(self.path): os.remove(self.path)
+        except Exception as e:
+            print(f"[SessionJournal] Error removing {self.path}: {e}")
+
+    def rewrite(self, records, events=()):
+        """Заменяет журнал текущей историей (через временный файл: падение не оставит полжурнала)"""
+        self.close()
+        temp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps({"type": "message", "message": record.to_json()}, ensure_ascii=False) + "\n")
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"[SessionJournal] Rewrite failed: {e}")
+
+    def load(self):
+        """
+        Возвращает (записи истории, события) из журнала; битую последнюю строку
+        и вызовы инструментов без ответов в конце пропускаем. У события "at" —
+        сколько записей истории было до него.
+        """
+        records, events = [], []
+        if not self.exists():
+            return records, events
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Процесс упал посреди записи
+                if entry.get("type") == "message":
+                    records.append(HistoryRecord.from_json(entry["message"]))
+                else:
+                    events.append(dict(entry, at=len(records)))
+        return drop_unanswered_calls(records), events
+
+    def close(self):
+        if self._file:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+    def _write(self, entry):
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"[SessionJournal] Write failed: {e}")
@@ -0,0 +1,150 @@
+import statistics
+from collections import deque
+
+# USD за 1M токенов: (вход, вход из кэша префикса, выход). Прайс меняется — сверяйтесь
+# с openai.com/api/pricing; для моделей не из списка стоимость не считается.
+MODEL_PRICES = {
+    "gpt-5.1": (1.25, 0.125, 10.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "o4-mini": (1.10, 0.275, 4.40),
+    "o1-mini": (1.10, 0.55, 4.40),
+}
+
+CHEAP_MODEL = "gpt-5-mini" # По умолчанию; в main.py — AGENT_CHEAP_MODEL, в ui_runner.cli — --cheap-model
+
+# После этих действий следующий шаг обычно рутинный (нажать Enter, кликнуть подсказку)
+ROUTINE_TOOLS = {"type_text", "press_key", "click_element", "wait"}
+
+
+def is_cheaper(model, than):
+    """model заметно дешевле than по прайсу (вход + выход); неизвестная цена — не дешевле"""
+    prices, other = MODEL_PRICES.get(model), MODEL_PRICES.get(than)
+    if not prices or not other:
+        return False
+    return prices[0] + prices[2] < other[0] + other[2]
+
+
+def estimate_cost(model, usage):
+    """Стоимость запроса в USD по usage ответа; None — цена модели неизвестна"""
+    prices = MODEL_PRICES.get(model)
+    if not prices or not usage:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    price_in, price_cached, price_out = prices
+    return ((usage.prompt_tokens - cached) * price_in + cached * price_cached
+            + usage.completion_tokens * price_out) / 1_000_000
+
+
+class ModelRouter:
+    """
+    Выбор модели на каждый шаг. Сильная модель (выбранная в панели) — для
+    планирования и трудных мест: первый шаг задачи, ошибка или пропуск на прошлом
+    шаге, повтор одних и тех же действий (зацикливание), большая страница, ответ
+    по прочитанному тексту. Рутинные продолжения после удачных кликов/ввода
+    отдаются дешёвой. После эскалации сильная модель держится escalate_steps шагов.
+    Если сильная модель не дороже cheap_model (или цена одной из них неизвестна),
+    все шаги идут в сильную: пользователь не получит модель, которую не выбирал, ради экономии.
+    Задержка, токены и стоимость копятся по моделям (stats/summary).
+    """
+
+    def __init__(self, cheap_model=CHEAP_MODEL, max_cheap_elements=300, escalate_steps=2, loop_window=4):
+        self.cheap_model = cheap_model
+        self.max_cheap_elements = max_cheap_elements
+        self.escalate_steps = escalate_steps
+        self.loop_window = loop_window
+
+        self.usage = {} # model -> {"calls", "latency_ms": [...], "prompt_tokens", "cached_tokens", "completion_tokens", "cost"}
+        self.start_task()
+
+    def start_task(self):
+        self._recent_actions = deque(maxlen=self.loop_window)
+        self._last_tools = []
+        self._last_failed = False
+        self._escalated_for = 0
+
+    def choose(self, strong_model, step, elements):
+        """Возвращает (модель, причина)"""
+        if not self.cheap_model or not is_cheaper(self.cheap_model, strong_model):
+            return strong_model, "no cheaper model"
+        reason = self._escalation_reason(step, elements)
+        if reason:
+            return strong_model, reason
+        if self._escalated_for > 0:
+            self._escalated_for -= 1
+            return strong_model, "escalated"
+        return self.cheap_model, "routine"
+
+    def escalate(self, steps=None):
+        """Следующие шаги — сильной модели (например, дешёвая не ответила)"""
+        self._escalated_for = max(self._escalated_for, self.escalate_steps if steps is None else steps)
+
+    def observe(self, tool_calls, results):
+        """Итог шага: вызовы модели [(имя, аргументы)] и тексты их результатов"""
+        self._last_tools = [name for name, _ in tool_calls]
+        self._last_failed = any(
+            result.startswith("Error") or result.startswith("Skipped") for result in results
+        )
+        self._recent_actions.append(tuple(tool_calls))
+
+    def record(self, model, latency_ms, usage):
+        entry = self.usage.setdefault(model, {
+            "calls": 0, "latency_ms": [], "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost": 0.0
+        })
+        entry["calls"] += 1
+        entry["latency_ms"].append(round(latency_ms, 1))
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            entry["prompt_tokens"] += usage.prompt_tokens
+            entry["cached_tokens"] += (getattr(details, "cached_tokens", None) or 0) if details else 0
+            entry["completion_tokens"] += usage.completion_tokens
+        cost = estimate_cost(model, usage)
+        if cost is not None:
+            entry["cost"] += cost
+
+    def stats(self):
+        result = {}
+        for model, entry in self.usage.items():
+            latencies = sorted(entry["latency_ms"])
+            result[model] = {
+                "calls": entry["calls"],
+                "median_latency_ms": round(statistics.median(latencies), 1),
+                "p90_latency_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))],
+                "prompt_tokens": entry["prompt_tokens"],
+                "cached_tokens": entry["cached_tokens"],
+                "completion_tokens": entry["completion_tokens"],
+                "cost_usd": round(entry["cost"], 5) if model in MODEL_PRICES else None,
+            }
+        return result
+
+    def summary(self):
+        parts = []
+        for model, entry in self.stats().items():
+            cost = f"${entry['cost_usd']:.4f}" if entry["cost_usd"] is not None else "n/a"
+            parts.append(f"{model}: {entry['calls']} calls, median {entry['median_latency_ms']:.0f} ms, {cost}")
+        return "; ".join(parts)
+
+    def _escalation_reason(self, step, elements):
+        if step == 1:
+            self._escalated_for = 0
+            return "planning"
+        if self._last_failed:
+            self.escalate()
+            return "previous step failed"
+        if self._is_looping():
+            self.escalate()
+            return "loop"
+        if elements and elements > self.max_cheap_elements:
+            return "large page"
+        if not self._last_tools:
+            return "no action"
+        if any(name not in ROUTINE_TOOLS for name in self._last_tools):
+            return "after " + ", ".join(name for name in self._last_tools if name not in ROUTINE_TOOLS)
+        return None
+
+    def _is_looping(self):
+        """Последний набор действий уже был в окне — модель ходит по кругу"""
+        actions = list(self._recent_actions)
+        return len(actions) >= 2 and actions[-1] in actions[:-1]
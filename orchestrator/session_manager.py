@@ -0,0 +1,150 @@
+import asyncio
+import itertools
+import os
+from playwright.async_api import async_playwright
+from browser_controller.driver import BrowserDriver, launch_chromium, USER_DATA_DIR, STATE_FILE
+from browser_controller.resource_policy import ResourcePolicy
+from orchestrator.engine import Orchestrator
+
+SESSIONS_DIR = os.path.join(USER_DATA_DIR, "sessions")
+
+
+class AgentSession:
+    """Одна независимая сессия: свой контекст браузера, свой драйвер, свой оркестратор"""
+
+    def __init__(self, session_id, driver, orchestrator):
+        self.session_id = session_id
+        self.driver = driver
+        self.orchestrator = orchestrator
+        self.pending_task = None # Прерванная задача из журнала (при open_session(resume=True))
+        self.temporary_files = [] # Удаляются при закрытии (одноразовая сессия без своего id)
+
+    async def run(self, task_text, model_name=None):
+        """task_text=None — продолжить прерванную задачу"""
+        return await self.orchestrator.process_task(task_text, model_name=model_name)
+
+
+class SessionManager:
+    """
+    Запускает Chromium один раз и держит поверх него до max_sessions
+    параллельных сессий. Каждая сессия получает изолированный BrowserContext
+    и собственный файл состояния; лишние open_session ждут освобождения слота.
+    """
+
+    def __init__(self, max_sessions=4, headless=True, width=1280, height=900, seed_state=STATE_FILE,
+                 lightweight=True, resource_overrides=None, max_elements=None):
+        self.max_sessions = max_sessions
+        self.headless = headless
+        self.width = width
+        self.height = height
+        # Общие куки (например, залогиненный аккаунт), которыми засевается новая сессия
+        self.seed_state = seed_state
+        # Без картинок/шрифтов/рекламы: быстрее загрузка и меньше памяти на вкладку
+        self.lightweight = lightweight
+        self.resource_overrides = resource_overrides
+        # Ограничение слепка (BrowserDriver.max_elements) для каждой сессии
+        self.max_elements = max_elements
+
+        self.playwright = None
+        self.browser = None
+        self.sessions = {}
+        self._slots = asyncio.Semaphore(max_sessions)
+        self._ids = itertools.count(1)
+
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+
+    async def start(self):
+        print(f"[SessionManager] Launching shared browser (max {self.max_sessions} sessions)...")
+        self.playwright = await async_playwright().start()
+        self.browser = await launch_chromium(
+            self.playwright, self.width, self.height, headless=self.headless
+        )
+
+    async def open_session(self, log_callback=None, session_id=None, state_file=None, resume=False, **orchestrator_kwargs):
+        """
+        Ждёт свободный слот и открывает сессию. resume=True — поднять историю
+        из журнала сессии с тем же id (session.pending_task — прерванная задача).
+        Без session_id сессия одноразовая: без журнала, а её файл состояния
+        удаляется при закрытии — пакетные прогоны не копят файлы в user_data.
+        """
+        await self._slots.acquire()
+        try:
+            ephemeral = session_id is None
+            session_id = session_id or f"session-{next(self._ids)}"
+            if session_id in self.sessions:
+                raise ValueError(f"Session {session_id} is already open")
+
+            default_state_file = os.path.join(SESSIONS_DIR, f"{session_id}.json")
+            policy = ResourcePolicy(overrides=self.resource_overrides) if self.lightweight else None
+            driver = BrowserDriver(
+                state_file=state_file or default_state_file,
+                resource_policy=policy,
+                max_elements=self.max_elements
+            )
+            driver.owns_browser = False
+            await driver.attach(self.browser, self.width, self.height, seed_state=self.seed_state)
+
+            log = log_callback or self._default_log(session_id)
+            if ephemeral:
+                orchestrator_kwargs.setdefault("journal_path", None)
+            orchestrator_kwargs.setdefault("journal_path", os.path.join(SESSIONS_DIR, f"{session_id}.jsonl"))
+            orchestrator = Orchestrator(driver, log, **orchestrator_kwargs)
+            session = AgentSession(session_id, driver, orchestrator)
+            if ephemeral and not state_file:
+                session.temporary_files.append(default_state_file)
+            if resume:
+                session.pending_task = await orchestrator.restore()
+            elif orchestrator.journal:
+                orchestrator.journal.reset() # Тот же id у новой сессии — старая история ей не нужна
+            self.sessions[session_id] = session
+            return session
+        except:
+            self._slots.release()
+            raise
+
+    async def close_session(self, session):
+        if self.sessions.pop(session.session_id, None) is None:
+            return
+        try:
+            if session.orchestrator.journal:
+                session.orchestrator.journal.close()
+            await session.driver.close() # Сохраняет состояние сессии и закрывает её контекст
+        finally:
+            for path in session.temporary_files:
+                try:
+                    if os.path.exists(path): os.remove(path)
+                except Exception as e:
+                    print(f"[SessionManager] Error removing {path}: {e}")
+            self._slots.release()
+
+    async def run_task(self, task_text, model_name=None, log_callback=None, session_id=None, **orchestrator_kwargs):
+        """Одноразовая сессия под одну задачу: открыть, выполнить, закрыть"""
+        session = await self.open_session(log_callback, session_id, **orchestrator_kwargs)
+        try:
+            return await session.run(task_text, model_name)
+        finally:
+            await self.close_session(session)
+
+    async def run_many(self, tasks, model_name=None):
+        """Выполняет задачи параллельно (не больше max_sessions одновременно), результаты в порядке задач"""
+        return await asyncio.gather(
+            *(self.run_task(task, model_name) for task in tasks),
+            return_exceptions=True
+        )
+
+    async def close(self):
+        for session in list(self.sessions.values()):
+            await self.close_session(session)
+        try:
+            if self.browser: await self.browser.close()
+            if self.playwright: await self.playwright.stop()
+        except:
+            pass
+
+    @staticmethod
+    def _default_log(session_id):
+        def log(type_msg, title, content=""):
+            if type_msg in ("thinking_start", "thinking_end"):
+                return
+            print(f"[{session_id}] {type_msg}: {title}")
+        return log
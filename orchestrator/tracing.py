@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Текущий открытый спан: у каждой asyncio-задачи своя копия, поэтому
+# вложенность правильная и для инструментов, исполняемых параллельно с LLM
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "category", "start_ns", "end_ns", "track", "attrs")
+
+    def __init__(self, span_id, parent_id, name, category, start_ns, track, attrs):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.start_ns = start_ns
+        self.end_ns = None
+        self.track = track
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration_ms(self):
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "cat": self.category,
+            "start_ms": round(self.start_ns / 1e6, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.end_ns is not None else None,
+            "attrs": self.attrs,
+        }
+
+
+class _NullSpan:
+    """Заглушка, когда трассировка выключена: set() ничего не делает"""
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Спаны вокруг шагов агента: чтение DOM, запрос к LLM, каждый инструмент.
+    Атрибуты спана (токены, число элементов, размер слепка) задаются через span.set().
+    Экспорт — построчный JSONL или Chrome trace-event (открывается в
+    chrome://tracing и ui.perfetto.dev).
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = [] # Закрытые спаны в порядке завершения
+        self._ids = itertools.count(1)
+        self._tracks = {} # asyncio-задача -> номер дорожки (tid) в трассе
+        self._origin_ns = time.perf_counter_ns()
+
+    def reset(self):
+        self.spans = []
+        self._tracks = {}
+        self._origin_ns = time.perf_counter_ns()
+
+    @contextmanager
+    def span(self, name, category="agent", **attrs):
+        if not self.enabled:
+            yield _NULL_SPAN
+            return
+
+        parent = _current_span.get()
+        span = Span(
+            next(self._ids), parent.span_id if parent else None, name, category,
+            time.perf_counter_ns() - self._origin_ns, self._track(), attrs
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.perf_counter_ns() - self._origin_ns
+            _current_span.reset(token)
+            self.spans.append(span)
+
+    def _track(self):
+        """Параллельные asyncio-задачи рисуем на разных дорожках, иначе спаны наложатся"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task) if task else 0
+        if key not in self._tracks:
+            self._tracks[key] = len(self._tracks) + 1
+        return self._tracks[key]
+
+    # --- Экспорт ---
+
+    def export_jsonl(self, path):
+        _ensure_dir(path)
+        with open(path, "w", encoding="utf-8") as f:
+            for span in sorted(self.spans, key=lambda s: s.start_ns):
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def chrome_trace(self):
+        events = [{
+            "name": "process_name", "ph": "M", "pid": 1, "tid": 0,
+            "args": {"name": "agent"},
+        }]
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start_ns / 1000, # микросекунды
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": 1,
+                "tid": span.track,
+                "args": span.attrs,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        _ensure_dir(path)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False, default=str)
+
+
+def _ensure_dir(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
@@ -0,0 +1,172 @@
+import json
+import os
+import re
+import time
+from urllib.parse import urlsplit
+from browser_controller.driver import USER_DATA_DIR
+
+TRAJECTORIES_FILE = os.path.join(USER_DATA_DIR, "trajectories.json")
+
+# Что повторяем: действия, меняющие страницу. Чтения (read_visible_text) и ожидания
+# нужны были модели, чтобы принять решение, — при повторе без модели они лишние.
+REPLAYABLE_TOOLS = {"navigate", "click_element", "type_text", "press_key"}
+ELEMENT_TOOLS = {"click_element", "type_text"}
+
+# Кнопки, после которых что-то удаляется, отправляется или оплачивается. Модель спрашивает
+# на них ask_user, а повтор шёл бы без спроса — такие прогоны не кэшируем
+_RISKY_TEXT = re.compile(
+    r"удал|спам|корзин|купи|покуп|оплат|оформ|заказ|отправ|подтверд|отпис|очист|сохран|"
+    r"delete|remove|trash|spam|cart|buy|purchase|pay|checkout|order|submit|send|confirm|unsubscribe|clear|save",
+    re.IGNORECASE
+)
+_SEARCH_FIELD = re.compile(r"поиск|найти|search|find", re.IGNORECASE)
+
+# Изменяемые части задачи: кавычки, ссылки, почта, числа — они становятся слотами шаблона
+_SLOT = re.compile(r"\"[^\"]+\"|«[^»]+»|'[^']+'|https?://\S+|[\w.+-]+@[\w-]+\.[\w.]+|\d+(?:[.,]\d+)?")
+
+
+def task_template(text):
+    """
+    "Найди «iPhone 15» на ozon.ru" -> ("найди {0} на ozon ru", ["iPhone 15"]).
+    Одинаковые по форме задачи с разными значениями дают один шаблон.
+    """
+    slots = []
+
+    def to_slot(match):
+        slots.append(match.group(0).strip("\"«»'"))
+        return f" {{{len(slots) - 1}}} "
+
+    template = _SLOT.sub(to_slot, text)
+    template = re.sub(r"[^\w{}]+", " ", template.lower()).strip()
+    return template, slots
+
+
+def is_risky(func_name, item, field=None):
+    """
+    Действие удаляет или отправляет что-то: клик по submit или кнопке с таким текстом,
+    Enter в поле ввода (кроме поиска). item — целевой элемент, field — поле, в которое
+    последним вводили текст (для press_key).
+    """
+    if func_name == "click_element":
+        return item.get("type") == "submit" or bool(_RISKY_TEXT.search(item.get("text") or ""))
+    if func_name == "press_key":
+        if field is None:
+            return False # Enter без ввода — навигация по странице, а не отправка формы
+        return field.get("type") != "search" and not _SEARCH_FIELD.search(field.get("text") or "")
+    return False
+
+
+def page_key(url):
+    """Адрес страницы без схемы, query и фрагмента: с ним сверяемся при повторе"""
+    parts = urlsplit(url or "")
+    return (parts.hostname or "") + parts.path.rstrip("/")
+
+
+class TrajectoryCache:
+    """
+    Кэш удачных прогонов: ключ — домен стартовой страницы и шаблон задачи,
+    значение — шаги (пачки действий), где элементы заданы стабильными
+    отпечатками (и текстом — по нему повтор сверяет, что это тот же элемент),
+    а не id. Записи, которые раз за разом расходятся со страницей,
+    выбрасываются после max_failures неудач подряд.
+    """
+
+    def __init__(self, path=TRAJECTORIES_FILE, max_entries=200, max_failures=3):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_failures = max_failures
+        self.entries = {}
+        self._load()
+
+    @staticmethod
+    def key_for(start_url, task_text):
+        template, slots = task_template(task_text)
+        return f"{urlsplit(start_url or '').hostname or ''}|{template}", slots
+
+    def lookup(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, slots, steps, summary, final_url):
+        """
+        Сохраняет удачный прогон; значения слотов в аргументах заменяются на {n}.
+        summary — итог записанного прогона: после повтора модель сверяет с ним
+        страницу, а не отдаёт его как есть.
+        """
+        steps = [[self._abstract(action, slots) for action in step] for step in steps]
+        steps = [step for step in steps if step]
+        if not steps:
+            return
+        self.entries[key] = {
+            "steps": steps,
+            "summary": summary,
+            "final_url": page_key(final_url),
+            "hits": 0,
+            "failures": 0,
+            "recorded_at": time.time(),
+        }
+        # Самые давние записи уходят первыми
+        if len(self.entries) > self.max_entries:
+            oldest = sorted(self.entries, key=lambda k: self.entries[k]["recorded_at"])
+            for old_key in oldest[:len(self.entries) - self.max_entries]:
+                del self.entries[old_key]
+        self._save()
+
+    def mark_hit(self, key):
+        entry = self.entries.get(key)
+        if entry:
+            entry["hits"] += 1
+            entry["failures"] = 0
+            self._save()
+
+    def mark_failure(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return
+        entry["failures"] += 1
+        if entry["failures"] >= self.max_failures:
+            del self.entries[key]
+        self._save()
+
+    @staticmethod
+    def fill_args(action, slots):
+        """Аргументы действия с подставленными значениями слотов текущей задачи"""
+        args = {}
+        for name, value in action["args"].items():
+            if isinstance(value, str):
+                for index, slot in enumerate(slots):
+                    value = value.replace(f"{{{index}}}", slot)
+            args[name] = value
+        return args
+
+    @staticmethod
+    def _abstract(action, slots):
+        args = {}
+        for name, value in action["args"].items():
+            if name == "element_id":
+                continue # Вместо id — отпечаток элемента
+            if isinstance(value, str):
+                # Длинные значения первыми, чтобы "15" не съело часть "iPhone 15";
+                # односимвольные ("3") — только если это значение целиком
+                for index, slot in sorted(enumerate(slots), key=lambda pair: -len(pair[1])):
+                    if value == slot or (len(slot) > 1 and slot in value):
+                        value = value.replace(slot, f"{{{index}}}")
+            args[name] = value
+        return {"name": action["name"], "args": args, "fp": action.get("fp"), "text": action.get("text"),
+                "url": action["url"]}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            print(f"[TrajectoryCache] Error loading {self.path}: {e}")
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        except Exception as e:
+            print(f"[TrajectoryCache] Error saving {self.path}: {e}")
@@ -1,9 +1,174 @@
+# Общий сборщик интерактивных элементов. Сначала все чтения (rect, стили, текст),
+# и только потом вызывающий код пишет атрибуты — так браузер пересчитывает layout
+# один раз, а не на каждом элементе.
+# Для каждого элемента считается отпечаток (тег, роль, тип, текст и путь по предкам
+# с позициями среди однотипных соседей) — по нему id переживает перерисовку и перезагрузку.
+# Открытые shadow root обходятся на месте своего хоста, iframe — отдельными вызовами
+# скрипта в каждом фрейме (см. BrowserDriver.get_page_content).
+_COLLECT_JS = """
+        const SELECTOR = 'a, button, input, textarea, [role="button"], [role="link"]';
+
+        // querySelectorAll не заглядывает в shadow root: обходим дерево сами, элементы
+        // из shadow root идут сразу за хостом (порядок документа сохраняется)
+        const queryInteractive = (root, out, shadowRoots) => {
+            for (const el of root.querySelectorAll('*')) {
+                if (el.matches(SELECTOR)) out.push(el);
+                if (el.shadowRoot) {
+                    shadowRoots.push(el.shadowRoot);
+                    queryInteractive(el.shadowRoot, out, shadowRoots);
+                }
+            }
+            return out;
+        };
+
+        // querySelector сквозь открытые shadow root
+        const queryDeep = (root, selector) => {
+            const found = root.querySelector(selector);
+            if (found) return found;
+            for (const el of root.querySelectorAll('*')) {
+                if (!el.shadowRoot) continue;
+                const inner = queryDeep(el.shadowRoot, selector);
+                if (inner) return inner;
+            }
+            return null;
+        };
+
+        const siblingIndexCache = new Map();
+        const siblingIndex = (el) => {
+            const parent = el.parentElement;
+            if (!parent) return 0;
+            let indexes = siblingIndexCache.get(parent);
+            if (!indexes) {
+                indexes = new Map();
+                const counters = {};
+                for (const child of parent.children) {
+                    counters[child.tagName] = (counters[child.tagName] || 0) + 1;
+                    indexes.set(child, counters[child.tagName]);
+                }
+                siblingIndexCache.set(parent, indexes);
+            }
+            return indexes.get(el) || 0;
+        };
+
+        const fingerprintOf = (el, item) => {
+            const path = [];
+            let node = el;
+            for (let depth = 0; node && node !== document.body && depth < 4; depth++) {
+                path.push(node.tagName.toLowerCase() + ':' + siblingIndex(node));
+                node = node.parentElement;
+            }
+            const raw = [item.tagName, item.role, item.type, item.text.substring(0, 40), path.join('/')].join('|');
+            // FNV-1a, чтобы не таскать длинные строки между страницей и Python
+            let hash = 0x811c9dc5;
+            for (let i = 0; i < raw.length; i++) {
+                hash ^= raw.charCodeAt(i);
+                hash = Math.imul(hash, 0x01000193);
+            }
+            return (hash >>> 0).toString(36);
+        };
+
+        // Область страницы, в которой лежит элемент: по ней ранжирование отличает
+        // основное содержимое от меню и подвала
+        const LANDMARK_SELECTOR = 'nav, header, footer, aside, main, form, dialog, [role="navigation"], [role="banner"], ' +
+            '[role="contentinfo"], [role="complementary"], [role="main"], [role="search"], [role="dialog"]';
+        const LANDMARK_ROLES = {navigation: 'nav', banner: 'header', contentinfo: 'footer', complementary: 'aside',
+                                main: 'main', search: 'form', dialog: 'dialog'};
+        const landmarkOf = (el) => {
+            let landmark = el.parentElement ? el.parentElement.closest(LANDMARK_SELECTOR) : null;
+            // Внутри shadow root closest не выходит за границу — продолжаем от хоста
+            for (let root = el.getRootNode(); !landmark && root.host; root = root.host.getRootNode()) {
+                landmark = root.host.closest(LANDMARK_SELECTOR);
+            }
+            if (!landmark) return '';
+            return LANDMARK_ROLES[landmark.getAttribute('role')] || landmark.tagName.toLowerCase();
+        };
+
+        const itemOf = (el) => {
+            let text = el.innerText || el.getAttribute('placeholder') || el.getAttribute('aria-label') || "";
+            text = text.replace(/\\s+/g, ' ').trim().substring(0, 100); // Обрезаем длинный текст
+            return {
+                tagName: el.tagName.toLowerCase(),
+                text: text,
+                type: el.getAttribute('type') || '',
+                role: el.getAttribute('role') || '',
+                landmark: landmarkOf(el)
+            };
+        };
+
+        const collectInteractive = (opts) => {
+            const margin = (opts && opts.viewportMargin != null) ? opts.viewportMargin : null;
+            const vw = window.innerWidth, vh = window.innerHeight;
+
+            const started = performance.now();
+            const shadowRoots = [];
+            // Фрейм нулевого размера (скрытый iframe, пиксели аналитики) — показывать нечего
+            const elements = (vw === 0 || vh === 0) ? [] : queryInteractive(document, [], shadowRoots);
+            const found = [];
+
+            for (const el of elements) {
+                const rect = el.getBoundingClientRect();
+                if (rect.width === 0 || rect.height === 0) continue;
+                // Режим "вьюпорт + запас": то, что далеко за экраном, не трогаем вовсе
+                if (margin !== null && (rect.bottom < -margin || rect.top > vh + margin ||
+                                        rect.right < -margin || rect.left > vw + margin)) continue;
+                if (window.getComputedStyle(el).visibility === 'hidden') continue;
+
+                const item = itemOf(el);
+                found.push([el, item, fingerprintOf(el, item)]);
+            }
+
+            // Одинаковые отпечатки (идентичные блоки в разных частях страницы) различаем порядковым номером
+            const seen = new Map();
+            for (const entry of found) {
+                const count = (seen.get(entry[2]) || 0) + 1;
+                seen.set(entry[2], count);
+                if (count > 1) entry[2] += '#' + count;
+            }
+
+            return {
+                found: found,
+                shadowRoots: shadowRoots,
+                timing: {scanned: elements.length, shadowRoots: shadowRoots.length, readMs: performance.now() - started}
+            };
+        };
+"""
+
+
 class DomService:
     @staticmethod
     def get_accessibility_tree_script():
         """
-        JS-скрипт, который находит все интерактивные элементы, 
+        JS-скрипт, который находит все интерактивные элементы,
         вешает на них временные атрибуты и возвращает их список.
+        Принимает {viewportMargin: px | null}, возвращает {items, timing}.
+        """
+        return """
+        (opts) => {
+        """ + _COLLECT_JS + """
+            const {found, timing} = collectInteractive(opts);
+
+            // Все записи — одним проходом после чтений
+            const writeStarted = performance.now();
+            const items = [];
+            let counter = 1;
+            for (const [el, item] of found) {
+                // Генерируем уникальный ID для этой сессии
+                item.id = counter++;
+                el.setAttribute('data-agent-id', item.id);
+                items.push(item);
+            }
+            timing.writeMs = performance.now() - writeStarted;
+            timing.totalMs = timing.readMs + timing.writeMs;
+
+            return {items: items, timing: timing};
+        }
+        """
+
+    @staticmethod
+    def get_legacy_accessibility_tree_script():
+        """
+        Прежняя версия скрипта (чтения и записи вперемешку).
+        Оставлена только для сравнения скорости с новой: legacy_ms в benchmarks.dom_scale_bench.
         """
         return """
         () => {
@@ -35,4 +200,312 @@ class DomService:
 
             return items;
         }
-        """
\ No newline at end of file
+        """
+    @staticmethod
+    def get_snapshot_tracker_script():
+        """
+        JS-скрипт инкрементальных слепков. Ставит в страницу трекер
+        (MutationObserver + WeakMap элемент -> id), который сохраняет
+        идентичность элементов между вызовами и возвращает либо полный
+        список, либо только изменения относительно прошлого слепка.
+        После навигации (новый документ или смена URL) всегда отдаёт полный слепок.
+
+        Id берутся из реестра отпечатков (fingerprint -> id), который хранит Python:
+        при первом вызове в новом документе скрипт отвечает {mode: 'need_registry'},
+        и его нужно вызвать повторно с {registry: {fpToId, nextId}}. Новые
+        привязки возвращаются в assigned, чтобы Python дописал их в реестр.
+        Принимает {forceFull, viewportMargin, registry}.
+        """
+        return """
+        (opts) => {
+            const forceFull = !!(opts && opts.forceFull);
+            const margin = (opts && opts.viewportMargin != null) ? opts.viewportMargin : null;
+            const OBSERVE = {subtree: true, childList: true, attributes: true, characterData: true};
+        """ + _COLLECT_JS + """
+            let t = window.__agentTracker;
+            if (!t || t.href !== location.href) {
+                if (!opts || !opts.registry) return {mode: 'need_registry', url: location.href};
+                if (t && t.observer) t.observer.disconnect();
+                t = window.__agentTracker = {
+                    href: location.href,
+                    ids: new WeakMap(),
+                    fpToId: new Map(Object.entries(opts.registry.fpToId)),
+                    nextId: opts.registry.nextId,
+                    prev: null,
+                    margin: margin,
+                    dirty: true,
+                    version: 0,
+                    observer: null,
+                    observedRoots: new WeakSet()
+                };
+                const markDirty = () => { t.dirty = true; t.version++; };
+                t.observer = new MutationObserver(markDirty);
+                t.observer.observe(document.documentElement, OBSERVE);
+                window.addEventListener('scroll', markDirty, {capture: true, passive: true});
+                window.addEventListener('resize', markDirty, {passive: true});
+            }
+            // Смена режима вьюпорта меняет набор элементов — сравнивать не с чем
+            if (t.margin !== margin) {
+                t.margin = margin;
+                t.dirty = true;
+            }
+
+            // Страница не менялась с прошлого слепка — сканировать нечего
+            if (!forceFull && t.prev && !t.dirty) {
+                return {
+                    mode: 'delta', url: location.href, total: t.prev.size,
+                    added: [], removed: [], changed: [], assigned: {}, nextId: t.nextId,
+                    timing: {scanned: 0, readMs: 0, writeMs: 0, totalMs: 0}
+                };
+            }
+
+            // 1. Только чтение (без записи в DOM между замерами)
+            const {found, shadowRoots, timing} = collectInteractive(opts);
+            // Мутации внутри shadow root до наблюдателя документа не доходят — следим за каждым
+            for (const root of shadowRoots) {
+                if (t.observedRoots.has(root)) continue;
+                t.observer.observe(root, OBSERVE);
+                t.observedRoots.add(root);
+            }
+
+            // 2. Запись: тот же узел — тот же id (WeakMap); новый узел — id по отпечатку
+            // (перерисованный или перезагруженный элемент); иначе — новый id
+            const writeStarted = performance.now();
+            const ids = new Array(found.length);
+            const taken = new Set();
+            found.forEach(([el], i) => {
+                const id = t.ids.get(el);
+                if (id !== undefined && !taken.has(id)) {
+                    ids[i] = id;
+                    taken.add(id);
+                }
+            });
+            found.forEach(([el, item, fp], i) => {
+                if (ids[i] !== undefined) return;
+                let id = t.fpToId.get(fp);
+                if (id === undefined || taken.has(id)) id = t.nextId++;
+                ids[i] = id;
+                taken.add(id);
+                t.ids.set(el, id);
+            });
+
+            const current = new Map();
+            const assigned = {};
+            found.forEach(([el, item, fp], i) => {
+                const id = ids[i];
+                if (t.fpToId.get(fp) !== id) {
+                    t.fpToId.set(fp, id);
+                    assigned[fp] = id;
+                }
+                if (el.getAttribute('data-agent-id') !== String(id)) el.setAttribute('data-agent-id', id);
+                item.id = id;
+                current.set(id, item);
+            });
+            // Наши собственные setAttribute не должны помечать страницу грязной
+            t.observer.takeRecords();
+            t.dirty = false;
+            timing.writeMs = performance.now() - writeStarted;
+            timing.totalMs = timing.readMs + timing.writeMs;
+
+            const prev = t.prev;
+            t.prev = current;
+
+            if (forceFull || !prev) {
+                return {mode: 'full', url: location.href, total: current.size, items: Array.from(current.values()), assigned: assigned, nextId: t.nextId, timing: timing};
+            }
+
+            const added = [], changed = [], removed = [];
+            for (const [id, item] of current) {
+                const old = prev.get(id);
+                if (!old) added.push(item);
+                else if (old.text !== item.text || old.tagName !== item.tagName || old.type !== item.type || old.role !== item.role) changed.push(item);
+            }
+            for (const id of prev.keys()) {
+                if (!current.has(id)) removed.push(id);
+            }
+
+            // Если поменялась большая часть страницы, полный слепок дешевле для модели
+            if (added.length + changed.length + removed.length > current.size / 2) {
+                return {mode: 'full', url: location.href, total: current.size, items: Array.from(current.values()), assigned: assigned, nextId: t.nextId, timing: timing};
+            }
+            return {mode: 'delta', url: location.href, total: current.size, added: added, removed: removed, changed: changed, assigned: assigned, nextId: t.nextId, timing: timing};
+        }
+        """
+
+    @staticmethod
+    def get_element_resolve_script():
+        """
+        Проверяет, что data-agent-id ещё висит на том же элементе: живом и с тем же
+        отпечатком (без ключей список перерисовывается переиспользованием узлов, и старый
+        атрибут оказывается на соседнем элементе). Иначе ищет элемент с этим отпечатком
+        и переносит id на него. Принимает {id, fp}; возвращает 'ok' | 'resolved' | 'missing'.
+        """
+        return """
+        ({id, fp}) => {
+        """ + _COLLECT_JS + """
+            let el = queryDeep(document, `[data-agent-id="${id}"]`);
+            if (el && !el.isConnected) el = null;
+            if (el && (!fp || fingerprintOf(el, itemOf(el)) === fp)) return 'ok';
+            if (!fp) return 'missing';
+
+            // Полный проход: и поиск замены, и отпечатки с номером повтора ("...#2"),
+            // которые зависят от остальных элементов страницы
+            const {found} = collectInteractive({});
+            for (const [candidate, item, candidateFp] of found) {
+                if (candidateFp !== fp) continue;
+                if (candidate === el) return 'ok';
+                if (el) {
+                    // Старый атрибут остался на чужом элементе — снимаем, иначе id неоднозначен
+                    el.removeAttribute('data-agent-id');
+                    if (window.__agentTracker) window.__agentTracker.ids.delete(el);
+                }
+                candidate.setAttribute('data-agent-id', id);
+                if (window.__agentTracker) window.__agentTracker.ids.set(candidate, id);
+                return 'resolved';
+            }
+            return 'missing';
+        }
+        """
+
+    @staticmethod
+    def get_main_content_script():
+        """
+        Текст страницы для чтения моделью. По умолчанию — только основное содержимое
+        (как в Readability: блоки с длинным текстом и малой долей ссылок, без навигации,
+        шапки и подвала); {fullPage: true} — весь видимый текст.
+        Не трогает innerText у body: текст собирается обходом узлов, видимость
+        проверяется через checkVisibility (пересчёт стилей без полного layout).
+        Если переданы knownDoc/knownVersion и документ с тех пор не менялся,
+        возвращает {cached: true} без извлечения.
+        """
+        return """
+        (opts) => {
+            const fullPage = !!(opts && opts.fullPage);
+
+            // Своя версия текста: считаем только вставки/удаления узлов и правки текста.
+            // Скролл и атрибуты (классы, стили анимаций) текст почти никогда не меняют.
+            let r = window.__agentReader;
+            if (!r || r.href !== location.href) {
+                if (r && r.observer) r.observer.disconnect();
+                r = window.__agentReader = {
+                    href: location.href,
+                    doc: Math.random().toString(36).slice(2),
+                    version: 0,
+                    observer: null
+                };
+                r.observer = new MutationObserver(() => { r.version++; });
+                r.observer.observe(document.documentElement, {subtree: true, childList: true, characterData: true});
+            }
+            if (opts && opts.knownDoc === r.doc && opts.knownVersion === r.version) {
+                return {cached: true, url: location.href, doc: r.doc, version: r.version};
+            }
+
+            const started = performance.now();
+            const SKIP = new Set(['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE', 'SVG', 'CANVAS', 'IFRAME', 'OBJECT', 'HEAD', 'SELECT']);
+            const BLOCK = new Set([
+                'P', 'DIV', 'SECTION', 'ARTICLE', 'MAIN', 'ASIDE', 'HEADER', 'FOOTER', 'NAV', 'UL', 'OL', 'LI',
+                'TABLE', 'TR', 'PRE', 'BLOCKQUOTE', 'FORM', 'FIGURE', 'FIGCAPTION', 'DL', 'DT', 'DD', 'BR', 'HR',
+                'H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'FIELDSET', 'DETAILS', 'SUMMARY', 'ADDRESS'
+            ]);
+            // Внутри основного блока выкидываем только явные служебные области
+            const LANDMARKS = new Set(['NAV', 'ASIDE', 'FOOTER']);
+            const LANDMARK_ROLES = new Set(['navigation', 'complementary', 'contentinfo', 'banner', 'search']);
+            const NEGATIVE = /nav|menu|footer|header|sidebar|breadcrumb|cookie|banner|promo|advert|social|share|related|subscribe|popup|modal/i;
+            const POSITIVE = /article|content|main|post|entry|story|text|body|message|result/i;
+
+            const tagOf = (el) => el.tagName.toUpperCase();
+            const isHidden = (el) => el.hidden || el.getAttribute('aria-hidden') === 'true' ||
+                (el.checkVisibility ? !el.checkVisibility() : false);
+            const textLength = (el) => el.textContent.replace(/\\s+/g, ' ').trim().length;
+
+            // 1. Выбор основного блока
+            let root = document.body;
+            let source = 'body';
+            if (!fullPage && document.body) {
+                const scores = new Map();
+                const baseScore = (el) => {
+                    const tag = tagOf(el);
+                    const hint = (el.id || '') + ' ' + (typeof el.className === 'string' ? el.className : '');
+                    let score = 0;
+                    if (tag === 'MAIN' || tag === 'ARTICLE' || el.getAttribute('role') === 'main') score += 30;
+                    if (LANDMARKS.has(tag) || tag === 'HEADER') score -= 30;
+                    if (NEGATIVE.test(hint)) score -= 25;
+                    if (POSITIVE.test(hint)) score += 25;
+                    return score;
+                };
+                const addScore = (el, value) => {
+                    if (!el || el === document.documentElement) return;
+                    if (!scores.has(el)) scores.set(el, baseScore(el));
+                    scores.set(el, scores.get(el) + value);
+                };
+
+                // Текстовые блоки: абзацы, ячейки, пункты и div без блочных детей
+                for (const block of document.body.querySelectorAll('p, pre, td, li, blockquote, div')) {
+                    if (tagOf(block) === 'DIV' && Array.prototype.some.call(block.children, (c) => BLOCK.has(tagOf(c)))) continue;
+                    const length = textLength(block);
+                    if (length < 25) continue;
+                    const value = 1 + (block.textContent.match(/[,，]/g) || []).length + Math.min(Math.floor(length / 100), 3);
+                    addScore(block.parentElement, value);
+                    if (block.parentElement) addScore(block.parentElement.parentElement, value / 2);
+                }
+
+                // Доля текста ссылок считаем только для лидеров — это самое дорогое
+                const leaders = Array.from(scores.entries()).sort((a, b) => b[1] - a[1]).slice(0, 10);
+                let best = null, bestScore = 0;
+                for (const [el, score] of leaders) {
+                    const length = textLength(el) || 1;
+                    let linkLength = 0;
+                    for (const a of el.querySelectorAll('a')) linkLength += textLength(a);
+                    const adjusted = score * (1 - Math.min(linkLength / length, 1));
+                    if (adjusted > bestScore && !isHidden(el)) { best = el; bestScore = adjusted; }
+                }
+
+                // Основной блок подозрительно мал (списки, приложения) — берём страницу целиком
+                const bodyLength = textLength(document.body);
+                if (best && (textLength(best) >= bodyLength * 0.25 || textLength(best) >= 2000)) {
+                    root = best;
+                    source = 'main';
+                }
+            }
+
+            // 2. Текст с сохранением структуры: блоки — с новой строки, строки таблиц — через " | "
+            const lines = [];
+            let line = '';
+            const flush = () => {
+                const text = line.replace(/\\s+/g, ' ').replace(/(\\s*\\|\\s*)+$/, '').trim();
+                if (text) lines.push(text);
+                line = '';
+            };
+            const walk = (node) => {
+                for (const child of node.childNodes) {
+                    if (child.nodeType === 3) { line += child.nodeValue; continue; }
+                    if (child.nodeType !== 1) continue;
+                    const tag = tagOf(child);
+                    if (SKIP.has(tag) || isHidden(child)) continue;
+                    if (source === 'main' && (LANDMARKS.has(tag) || LANDMARK_ROLES.has(child.getAttribute('role')))) continue;
+
+                    const block = BLOCK.has(tag);
+                    if (block) flush();
+                    if (tag === 'LI') line += '• ';
+                    else if (/^H[1-6]$/.test(tag)) line += '#'.repeat(+tag[1]) + ' ';
+                    else if (tag === 'INPUT' || tag === 'TEXTAREA') line += child.value ? ` [${child.value}] ` : '';
+                    walk(child);
+                    if (block) flush();
+                    else if (tag === 'TD' || tag === 'TH') line += ' | ';
+                }
+            };
+            if (root) walk(root);
+            flush();
+
+            return {
+                cached: false,
+                url: location.href,
+                doc: r.doc,
+                version: r.version,
+                title: document.title,
+                source: source,
+                text: lines.join('\\n'),
+                timing: {ms: performance.now() - started}
+            };
+        }
+        """
@@ -0,0 +1,85 @@
+import math
+import re
+
+# Ранжирование элементов слепка под задачу: BM25 по тексту элемента, его тегу/типу/роли
+# и области страницы (landmark) против текста задачи и последней реплики модели.
+# Никаких моделей и словарей — только слова, поэтому считается за миллисекунды.
+
+K1 = 1.2
+B = 0.75
+
+# Грубый стемминг: у длинных слов сравниваем только начало, чтобы "корзину",
+# "корзина" и "корзине" совпадали (падежи, времена, числа)
+STEM_CHARS = 5
+
+# Небольшая поправка к оценке: основное содержимое и поля ввода важнее меню и подвала.
+# Порядка десятых — решает только при близких оценках и при пустом запросе
+LANDMARK_PRIOR = {"main": 0.3, "form": 0.3, "dialog": 0.5, "nav": -0.3, "header": -0.2, "footer": -0.4, "aside": -0.3}
+FIELD_PRIOR = {"input": 0.3, "textarea": 0.3}
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [word[:STEM_CHARS] for word in _WORD.findall((text or "").lower())]
+
+
+def element_tokens(item):
+    words = tokenize(item.get("text"))
+    words.append(item["tagName"])
+    for key in ("type", "role", "landmark"):
+        if item.get(key):
+            words.append(item[key][:STEM_CHARS])
+    return words
+
+
+def score_items(items, query):
+    """Оценка каждого элемента (в том же порядке, что items)"""
+    query_terms = set(tokenize(query))
+    documents = [element_tokens(item) for item in items]
+    priors = [LANDMARK_PRIOR.get(item.get("landmark"), 0) + FIELD_PRIOR.get(item["tagName"], 0) for item in items]
+    if not query_terms or not documents:
+        return priors
+
+    total = len(documents)
+    average_length = sum(len(document) for document in documents) / total
+    frequency = {term: 0 for term in query_terms}
+    for document in documents:
+        for term in query_terms.intersection(document):
+            frequency[term] += 1
+    idf = {term: math.log(1 + (total - count + 0.5) / (count + 0.5)) for term, count in frequency.items() if count}
+
+    scores = []
+    for document, prior in zip(documents, priors):
+        score = prior
+        length_norm = K1 * (1 - B + B * len(document) / average_length)
+        for term in idf:
+            count = document.count(term)
+            if count:
+                score += idf[term] * count * (K1 + 1) / (count + length_norm)
+        scores.append(score)
+    return scores
+
+
+def select_top(items, query, limit):
+    """
+    limit самых подходящих элементов в порядке документа (так повторы
+    по-прежнему сворачиваются) и число оставшихся.
+    """
+    if len(items) <= limit:
+        return list(items), 0
+    scores = score_items(items, query)
+    # При равной оценке выше то, что раньше на странице
+    best = sorted(range(len(items)), key=lambda index: (-scores[index], index))[:limit]
+    return [items[index] for index in sorted(best)], len(items) - limit
+
+
+def search(items, query):
+    """Элементы, совпавшие с запросом хотя бы одним словом, — от лучших к худшим"""
+    query_terms = set(tokenize(query))
+    if not query_terms:
+        return []
+    scores = score_items(items, query)
+    matched = [index for index, item in enumerate(items) if query_terms.intersection(element_tokens(item))]
+    matched.sort(key=lambda index: (-scores[index], index))
+    return [items[index] for index in matched]
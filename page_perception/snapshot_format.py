@@ -0,0 +1,95 @@
+# Компактная запись элементов слепка для модели.
+#
+#   [3] input:search 'Поиск'        — тип поля через ":", роль через "@" (div@button)
+#   [5-28] button 'В корзину'       — подряд идущие одинаковые элементы (список, ряд ссылок)
+#   [31] =5, [40-44] =5             — такие же элементы, как [5] (повтор не подряд)
+#   [2:7] button 'Оплатить'         — элемент во фрейме 2 (iframe): номер фрейма, двоеточие, id в нём
+#
+# Строка собирается из частей одним join: время линейно по числу элементов.
+
+# Роль, которая ничего не добавляет к тегу
+IMPLIED_ROLES = {("a", "link"), ("button", "button")}
+
+
+def describe(item):
+    """Тег с типом/ролью и текст: "input:search 'Поиск'" """
+    kind = item["tagName"]
+    if item.get("type") and kind in ("input", "button") and item["type"] not in ("text", "submit"):
+        kind += ":" + item["type"]
+    role = item.get("role")
+    if role and (item["tagName"], role) not in IMPLIED_ROLES:
+        kind += "@" + role
+    return f"{kind} '{item['text']}'"
+
+
+def split_id(element_id):
+    """5 или "5" -> (0, 5); "2:5" -> (2, 5): номер фрейма (0 — сама страница) и id внутри него"""
+    frame, _, local = str(element_id).strip().rpartition(":")
+    return int(frame or 0), int(local)
+
+
+def join_id(frame, local):
+    return f"{frame}:{local}" if frame else local
+
+
+def format_ids(ids):
+    """[5, 6, 7, 9, 10] -> "5-7,9,10"; ["2:5", "2:6", "2:7"] -> "2:5-7" """
+    parts = []
+
+    def close(frame, start, end):
+        prefix = f"{frame}:" if frame else ""
+        if end > start + 1:
+            parts.append(f"{prefix}{start}-{end}")
+        else:
+            parts.extend(f"{prefix}{element_id}" for element_id in range(start, end + 1))
+
+    frame, start = split_id(ids[0])
+    prev = start
+    for element_id in ids[1:]:
+        element_frame, local = split_id(element_id)
+        if element_frame != frame or local != prev + 1:
+            close(frame, start, prev)
+            frame, start = element_frame, local
+        prev = local
+    close(frame, start, prev)
+    return ",".join(parts)
+
+
+def encode_items(items, prefix=""):
+    """
+    Строки слепка в компактной записи. prefix — "+ "/"~ " для дельт.
+    Ссылки "=id" ведут только на элементы этой же пачки.
+    """
+    lines = []
+    first_id = {} # описание -> id первого такого элемента
+    run_description = None
+    run_ids = []
+
+    def flush():
+        if not run_ids:
+            return
+        original = first_id.get(run_description)
+        if original is None:
+            first_id[run_description] = run_ids[0]
+            lines.append(f"{prefix}[{format_ids(run_ids)}] {run_description}")
+        elif len(run_description) > len(str(original)) + 1:
+            lines.append(f"{prefix}[{format_ids(run_ids)}] ={original}")
+        else:
+            lines.append(f"{prefix}[{format_ids(run_ids)}] {run_description}")
+
+    for item in items:
+        description = describe(item)
+        # Серия не переходит из фрейма во фрейм: диапазон id — внутри одного документа
+        if description == run_description and split_id(item["id"])[0] == split_id(run_ids[-1])[0]:
+            run_ids.append(item["id"])
+            continue
+        flush()
+        run_description = description
+        run_ids = [item["id"]]
+    flush()
+    return lines
+
+
+def encode_plain(items, prefix=""):
+    """Прежняя запись, строка на элемент: [id] tag 'text' (для сравнения и отладки)"""
+    return [f"{prefix}[{item['id']}] {item['tagName']} '{item['text']}'" for item in items]
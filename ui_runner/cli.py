@@ -1,25 +1,57 @@
+"""
+Агент без окна.
+
+Интерактивно (одна сессия, задачи из консоли):
+    python -m ui_runner.cli
+
+Пакетный прогон (задачи из JSONL-файла или stdin, результаты — JSONL по мере готовности):
+    python -m ui_runner.cli --batch tasks.jsonl --concurrency 4 --timeout 300 --out results.jsonl
+    cat tasks.txt | python -m ui_runner.cli --batch - > results.jsonl
+
+Строка задач — {"id": "...", "task": "...", "model": "...", "timeout": 120} (всё, кроме
+task, необязательно) или просто текст задачи. Пустые строки и строки с # пропускаются.
+"""
+import argparse
 import asyncio
+import hashlib
+import json
+import os
+import re
+import statistics
 import sys
+import tempfile
+import time
+
 from browser_controller.driver import BrowserDriver
+from orchestrator.engine import Orchestrator
+from orchestrator.session_manager import SessionManager
+from orchestrator.model_router import ModelRouter, CHEAP_MODEL
+from agent_core.llm_requests import LLMRequestPolicy
+from orchestrator.trajectory_cache import TrajectoryCache
+
+# Метрики шага, которые суммируем в итог задачи (см. Orchestrator._record_step)
+STEP_TOTALS = ["dom_ms", "llm_ms", "tools_ms", "settle_ms", "prompt_tokens", "cached_tokens", "completion_tokens"]
 
-# Импортируем заглушки (в будущем здесь будет логика)
-# from orchestrator import Orchestrator 
 
 class AgentCLI:
-    def __init__(self):
-        self.driver = BrowserDriver()
+    """Интерактивный режим: один браузер, один оркестратор, задачи по одной из stdin"""
+
+    def __init__(self, model_name=None, headless=False, max_elements=150, cheap_model=CHEAP_MODEL):
+        self.driver = BrowserDriver(max_elements=max_elements)
+        self.model_name = model_name
+        self.cheap_model = cheap_model
+        self.headless = headless
+        self.orchestrator = None
         self.is_running = True
 
     async def run(self):
         print("==================================================")
         print("🤖 AI WEB AGENT CLI")
         print("==================================================")
-        
+
         # 1. Запускаем браузер
-        await self.driver.start_browser()
-        
-        # Для демонстрации откроем Google или пустую вкладку
-        await self.driver.navigate("https://www.google.com")
+        await self.driver.start_browser(headless=self.headless)
+        self.orchestrator = Orchestrator(self.driver, self.log, router=ModelRouter(cheap_model=self.cheap_model))
 
         print("\nБраузер запущен. Введите задачу для агента.")
         print("Введите 'exit' или 'quit' для выхода.\n")
@@ -28,9 +60,11 @@ class AgentCLI:
         while self.is_running:
             try:
                 # Используем run_in_executor для input, чтобы не блокировать event loop
-                user_input = await asyncio.get_event_loop().run_in_executor(
+                user_input = await asyncio.get_running_loop().run_in_executor(
                     None, sys.stdin.readline
                 )
+                if not user_input:
+                    break # EOF
                 user_input = user_input.strip()
 
                 if not user_input:
@@ -41,7 +75,6 @@ class AgentCLI:
                     self.is_running = False
                     break
 
-                # Здесь будет передача управления Оркестратору
                 await self.process_command(user_input)
 
             except KeyboardInterrupt:
@@ -52,10 +85,231 @@ class AgentCLI:
         await self.driver.close()
 
     async def process_command(self, text: str):
-        """
-        Здесь будет вызов Orchestrator.
-        Пока просто эмулируем принятие задачи.
-        """
         print(f"\n[USER]: {text}")
-        print(f"[AGENT]: Задача принята. (Логика решения пока не реализована)")
-        print(f"[AGENT]: Ожидаю следующую команду...\n")
\ No newline at end of file
+        outcome = await self.orchestrator.process_task(text, model_name=self.model_name)
+        print(f"[AGENT] {outcome['status']}: {outcome['summary']}\n")
+
+    @staticmethod
+    def log(type_msg, title, content=""):
+        if type_msg in ("thinking_start", "thinking_end", "agent_delta"):
+            return
+        print(f"[{type_msg}] {title}")
+
+
+class BatchRunner:
+    """
+    Пакетный прогон: concurrency рабочих берут задачи из очереди и выполняют
+    каждую в своей сессии SessionManager (изолированный контекст общего
+    Chromium). Задача дольше timeout_s прерывается со статусом "timeout".
+    Результат каждой задачи сразу пишется строкой JSONL в out.
+    """
+
+    def __init__(self, out, concurrency=4, timeout_s=300, model_name=None, headless=True,
+                 trace_dir=None, replay=False, hedge=False, verbose=False, max_elements=150, cheap_model=CHEAP_MODEL):
+        self.out = out
+        self.cheap_model = cheap_model
+        self.concurrency = concurrency
+        self.timeout_s = timeout_s
+        self.model_name = model_name
+        self.trace_dir = trace_dir
+        self.verbose = verbose
+        self.manager = SessionManager(max_sessions=concurrency, headless=headless, max_elements=max_elements)
+        self.trajectories = TrajectoryCache() if replay else None
+        # Один на прогон: задержки копятся по всем задачам, p90 для hedge — общий
+        self.llm_requests = LLMRequestPolicy(hedge=hedge)
+        self.results = []
+
+    async def run(self, tasks):
+        """tasks — асинхронный итератор задач {"id", "task", ...}"""
+        started = time.perf_counter()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2) # Не читаем весь вход заранее
+        await self.manager.start()
+        # Состояние каждой сессии — во временной папке: сотни задач не должны мусорить в user_data
+        with tempfile.TemporaryDirectory(prefix="agent-batch-") as state_dir:
+            workers = [asyncio.create_task(self._worker(queue, state_dir)) for _ in range(self.concurrency)]
+            try:
+                async for task in tasks:
+                    await queue.put(task)
+            finally:
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+                await self.manager.close()
+        return self.summary(time.perf_counter() - started)
+
+    async def _worker(self, queue, state_dir):
+        while True:
+            task = await queue.get()
+            if task is None:
+                return
+            result = await self._run_one(task, state_dir)
+            self.results.append(result)
+            self.out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.out.flush()
+
+    async def _run_one(self, task, state_dir):
+        task_id = task["id"]
+        file_name = file_safe_id(task_id)
+        timeout_s = task.get("timeout", self.timeout_s)
+        result = {"id": task_id, "task": task["task"], "status": None, "summary": None, "error": None}
+        started_at = time.time()
+        queued = time.perf_counter()
+        session = None
+        try:
+            session = await self.manager.open_session(
+                log_callback=self._log(task_id), session_id=task_id,
+                state_file=os.path.join(state_dir, f"{file_name}.json"),
+                journal_path=None,
+                trace_dir=os.path.join(self.trace_dir, file_name) if self.trace_dir else None,
+                trajectory_cache=self.trajectories,
+                router=ModelRouter(cheap_model=self.cheap_model),
+                request_policy=self.llm_requests,
+            )
+            run_started = time.perf_counter()
+            result["open_ms"] = round((run_started - queued) * 1000, 1)
+            outcome = await asyncio.wait_for(session.run(task["task"], task.get("model", self.model_name)), timeout_s)
+            result["status"] = outcome["status"]
+            result["summary"] = outcome["summary"]
+        except asyncio.TimeoutError:
+            result["status"] = "timeout"
+            result["error"] = f"Task exceeded {timeout_s}s"
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if session:
+                result.update(self._task_metrics(session.orchestrator))
+                try:
+                    await self.manager.close_session(session)
+                except Exception as e:
+                    print(f"[BatchRunner] Error closing {task_id}: {e}", file=sys.stderr)
+
+        result["started_at"] = round(started_at, 3)
+        result["total_ms"] = round((time.perf_counter() - queued) * 1000, 1)
+        return result
+
+    @staticmethod
+    def _task_metrics(orchestrator):
+        steps = orchestrator.step_metrics
+        metrics = {"steps": len(steps)}
+        for key in STEP_TOTALS:
+            metrics[key] = round(sum(step[key] or 0 for step in steps), 1)
+        metrics["models"] = sorted({step["model"] for step in steps if step.get("model")})
+        return metrics
+
+    def _log(self, task_id):
+        def log(type_msg, title, content=""):
+            if self.verbose and type_msg not in ("thinking_start", "thinking_end", "agent_delta"):
+                print(f"[{task_id}] {type_msg}: {title}", file=sys.stderr)
+        return log
+
+    def summary(self, wall_s):
+        statuses = {}
+        for result in self.results:
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+        durations = sorted(result["total_ms"] for result in self.results)
+        return {
+            "tasks": len(self.results),
+            "statuses": statuses,
+            "wall_s": round(wall_s, 1),
+            "tasks_per_min": round(len(self.results) / wall_s * 60, 2) if wall_s else None,
+            "p50_task_ms": statistics.median(durations) if durations else None,
+            "p90_task_ms": durations[min(len(durations) - 1, int(len(durations) * 0.9))] if durations else None,
+            "llm_requests": self.llm_requests.stats(),
+        }
+
+
+def parse_task(line, number):
+    """Строка входа -> задача; None для пустых строк и комментариев"""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    task = json.loads(line) if line.startswith("{") else {"task": line}
+    task.setdefault("id", f"task-{number}")
+    task["id"] = str(task["id"])
+    return task
+
+
+def file_safe_id(task_id):
+    """
+    id задачи -> имя файла/папки: "../x" и "a/b" не должны выходить за пределы
+    каталога. Изменённое имя получает хвост из хеша, чтобы "a/b" и "a_b" не совпали.
+    """
+    name = re.sub(r"[^\w.-]", "_", task_id).lstrip(".")[:80]
+    if name and name == task_id:
+        return name
+    return f"{name or 'task'}-{hashlib.sha1(task_id.encode('utf-8')).hexdigest()[:8]}"
+
+
+async def read_tasks(source):
+    """
+    Задачи из файла или stdin ("-"); stdin читается по строке, не блокируя цикл.
+    Повторный id получает суффикс (-2, -3, …): по id различаются сессии и результаты.
+    """
+    loop = asyncio.get_running_loop()
+    stream = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    number = 0
+    seen = set()
+    try:
+        while True:
+            line = await loop.run_in_executor(None, stream.readline) if stream is sys.stdin else stream.readline()
+            if not line:
+                break
+            number += 1
+            try:
+                task = parse_task(line, number)
+            except json.JSONDecodeError as e:
+                print(f"[BatchRunner] Line {number}: bad JSON ({e}), skipped", file=sys.stderr)
+                continue
+            if not task:
+                continue
+            if task["id"] in seen:
+                original, suffix = task["id"], 2
+                while f"{original}-{suffix}" in seen:
+                    suffix += 1
+                task["id"] = f"{original}-{suffix}"
+                print(f"[BatchRunner] Line {number}: duplicate id {original!r}, renamed to {task['id']!r}", file=sys.stderr)
+            seen.add(task["id"])
+            yield task
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Headless agent: interactive console or batch runner")
+    parser.add_argument("--batch", metavar="TASKS", help="JSONL/text file with tasks, '-' for stdin")
+    parser.add_argument("--out", help="Results JSONL (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel sessions")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-task timeout, seconds")
+    parser.add_argument("--model", help="Strong model (default: AIClient.model)")
+    parser.add_argument("--cheap-model", default=CHEAP_MODEL, help="Model for routine steps ('' disables routing)")
+    parser.add_argument("--headful", action="store_true")
+    parser.add_argument("--trace", metavar="DIR", help="Save per-task traces here")
+    parser.add_argument("--replay", action="store_true", help="Use the trajectory cache")
+    parser.add_argument("--hedge", action="store_true", help="Duplicate LLM requests slower than p90")
+    parser.add_argument("--max-elements", type=int, default=150, help="Snapshot top-K elements (0: all)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Agent logs to stderr")
+    args = parser.parse_args()
+
+    if not args.batch:
+        await AgentCLI(model_name=args.model, headless=not args.headful, max_elements=args.max_elements or None,
+                       cheap_model=args.cheap_model).run()
+        return
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    try:
+        runner = BatchRunner(
+            out, concurrency=args.concurrency, timeout_s=args.timeout, model_name=args.model,
+            headless=not args.headful, trace_dir=args.trace, replay=args.replay, hedge=args.hedge,
+            verbose=args.verbose, max_elements=args.max_elements or None, cheap_model=args.cheap_model
+        )
+        summary = await runner.run(read_tasks(args.batch))
+        print(json.dumps(summary, ensure_ascii=False, indent=2), file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext
 import asyncio
 import json
+import queue
 
 THEME = {
     "bg": "#1e1e1e", "fg": "#d4d4d4", "panel_bg": "#252526", 
@@ -11,6 +12,12 @@ THEME = {
     "thinking": "#b362ff" # Фиолетовый для "думалки"
 }
 
+LOG_FLUSH_MS = 50 # Как часто выводим накопившиеся записи лога
+LOG_MAX_LINES = 5000 # Старые строки лога выбрасываются (кольцевой буфер)
+LOG_MAX_BATCH = 2000 # Записей за один тик; остальное — в следующий, чтобы окно не замирало
+PRETTY_JSON_MAX_CHARS = 2000 # Большие аргументы не форматируем — дорого и нечитаемо
+SEPARATOR = "-" * 40 + "\n"
+
 class AgentSidebar:
     def __init__(self, loop, process_task_callback, check_key_callback):
         self.loop = loop
@@ -24,6 +31,10 @@ class AgentSidebar:
         
         self.is_busy = False 
         self.thinking_task = None # Для анимации
+        self.agent_streaming = False # Идёт потоковый вывод ответа ассистента
+        # Лог пишется из цикла агента (и других потоков) только в очередь,
+        # а в виджет попадает пачками по таймеру — агент никогда не ждёт отрисовку
+        self.log_queue = queue.SimpleQueue()
         
         self._setup_ui()
         self._setup_tags()
@@ -32,6 +43,7 @@ class AgentSidebar:
         self.loop.call_soon_threadsafe(self.trigger_key_check)
         self.is_running = True
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(LOG_FLUSH_MS, self._flush_logs)
 
     def _setup_ui(self):
         # (Код UI без изменений, сокращен для краткости)
@@ -140,58 +152,55 @@ class AgentSidebar:
     # --- НОВОЕ: Анимация думалки ---
     def start_thinking(self):
         """Показывает анимацию, что модель думает"""
+        self.log_queue.put(("thinking_start", "", ""))
+
+    def stop_thinking(self):
+        """Останавливает анимацию и заменяет на галочку"""
+        self.log_queue.put(("thinking_end", "", ""))
+
+    def _render_start_thinking(self):
+        # Вставляем метку начала думания; позицию держит mark, она переживает обрезку лога
         self.log_area.config(state='normal')
-        # Вставляем метку начала думания
         self.log_area.insert(tk.END, "🧠 Thinking", "THINKING")
-        self.thinking_mark = self.log_area.index("end-1c linestart") # Запоминаем строку
+        self.log_area.mark_set("thinking", "end-1c linestart")
+        self.log_area.mark_gravity("thinking", tk.LEFT)
         self.log_area.insert(tk.END, "\n")
+        self.log_area.see(tk.END)
         self.log_area.config(state='disabled')
-        
+
         self.thinking_dots = 0
-        self._animate_thinking()
+        if not self.thinking_task:
+            self.thinking_task = self.root.after(500, self._animate_thinking)
 
     def _animate_thinking(self):
+        self.thinking_task = None
         if not self.is_busy: return # Если задача закончилась, стоп
         
-        # Обновляем текст в строке thinking_mark
+        # Обновляем текст в строке с меткой thinking
         dots = "." * (self.thinking_dots % 4) # . .. ...
-        text = f"🧠 Thinking{dots}"
-        
-        self.log_area.config(state='normal')
-        # Удаляем старую строку и пишем новую
-        line_idx = self.log_area.get(self.thinking_mark, f"{self.thinking_mark} lineend")
-        if "Thinking" in line_idx:
-            self.log_area.delete(self.thinking_mark, f"{self.thinking_mark} lineend")
-            self.log_area.insert(self.thinking_mark, text, "THINKING")
-        self.log_area.config(state='disabled')
+        self._replace_thinking_line(f"🧠 Thinking{dots}", "THINKING")
         
         self.thinking_dots += 1
         # Запускаем следующий кадр через 500мс
         self.thinking_task = self.root.after(500, self._animate_thinking)
 
-    def stop_thinking(self):
-        """Останавливает анимацию и заменяет на галочку"""
+    def _render_stop_thinking(self):
         if self.thinking_task:
             self.root.after_cancel(self.thinking_task)
             self.thinking_task = None
-        
-        self.log_area.config(state='normal')
-        # Находим строку Thinking и меняем на (Thought finished) или просто скрываем
-        # Для простоты просто оставим последнюю стадию или добавим время
-        # Но лучше просто удалить строку "Thinking..." чтобы не засорять лог, 
-        # так как ответ модели придет следом.
-        # ИЛИ меняем на "Reasoned."
-        
-        # Давайте заменим "Thinking..." на пустоту или разделитель, т.к. ответ уже пришел
-        # Но чтобы было видно что процесс был, напишем "Reasoning complete."
-        line_idx = self.log_area.get(self.thinking_mark, f"{self.thinking_mark} lineend")
-        if "Thinking" in line_idx:
-            self.log_area.delete(self.thinking_mark, f"{self.thinking_mark} lineend")
-            self.log_area.insert(self.thinking_mark, "⚡ Reasoning complete", "TOOL_RESULT")
-            
-        self.log_area.see(tk.END)
-        self.log_area.config(state='disabled')
+        # Ответ модели придёт следом — оставляем короткую отметку, что процесс был
+        self._replace_thinking_line("⚡ Reasoning complete", "TOOL_RESULT")
+        self.log_area.mark_unset("thinking")
 
+    def _replace_thinking_line(self, text, tag):
+        if "thinking" not in self.log_area.mark_names():
+            return
+        line = self.log_area.get("thinking", "thinking lineend")
+        if "Thinking" in line:
+            self.log_area.config(state='normal')
+            self.log_area.delete("thinking", "thinking lineend")
+            self.log_area.insert("thinking", text, tag)
+            self.log_area.config(state='disabled')
 
     def set_working_state(self, is_working: bool):
         self.is_busy = is_working
@@ -210,34 +219,91 @@ class AgentSidebar:
 
     # Методы добавления логов и остальные (без изменений)...
     def add_log(self, type: str, title: str, content: str = ""):
+        """Можно вызывать откуда угодно и сколь угодно часто: только кладёт запись в очередь"""
+        self.log_queue.put((type, title, content))
+
+    def _flush_logs(self):
+        """Выводит всё накопившееся одной вставкой и обрезает лог до LOG_MAX_LINES"""
+        if not self.is_running:
+            return
+        try:
+            segments = [] # (текст, тег) подряд, уходят в один insert
+            for _ in range(LOG_MAX_BATCH):
+                try:
+                    type, title, content = self.log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if type in ("thinking_start", "thinking_end"):
+                    # Анимация привязана к позиции в тексте — сначала выводим то, что перед ней
+                    self._insert_segments(segments)
+                    segments = []
+                    if type == "thinking_start": self._render_start_thinking()
+                    else: self._render_stop_thinking()
+                    continue
+                self._format_log(segments, type, title, content or "")
+            self._insert_segments(segments)
+        finally:
+            self.root.after(LOG_FLUSH_MS, self._flush_logs)
+
+    def _insert_segments(self, segments):
+        if not segments:
+            return
+        # Соседние куски с одним тегом склеиваем — меньше вызовов Tk
+        args = []
+        for text, tag in segments:
+            if args and args[-1] == tag:
+                args[-2] += text
+            else:
+                args.extend([text, tag])
+
         self.log_area.config(state='normal')
+        self.log_area.insert(tk.END, *args)
+        lines = int(self.log_area.index("end-1c").split(".")[0])
+        if lines > LOG_MAX_LINES:
+            self.log_area.delete("1.0", f"{lines - LOG_MAX_LINES + 1}.0")
+        self.log_area.see(tk.END)
+        self.log_area.config(state='disabled')
+
+    def _format_log(self, segments, type, title, content):
+        # Потоковый текст ассистента дописываем в одну строку, без разделителей
+        if type == "agent_delta":
+            if not self.agent_streaming:
+                segments.append(("🤖 Assistant: ", "AGENT"))
+                self.agent_streaming = True
+            segments.append((title, "AGENT"))
+            return
+        if self.agent_streaming:
+            self.agent_streaming = False
+            segments.append(("\n", "AGENT"))
+            segments.append((SEPARATOR, "TOOL_RESULT"))
         
         if type == "user":
-            self.log_area.insert(tk.END, f"\n👤 User:\n{title}\n", "USER")
+            segments.append((f"\n👤 User:\n{title}\n", "USER"))
         elif type == "agent":
-            self.log_area.insert(tk.END, f"🤖 Assistant: {title}\n", "AGENT")
+            segments.append((f"🤖 Assistant: {title}\n", "AGENT"))
         elif type == "tool_call":
-            self.log_area.insert(tk.END, f"🔧 Call: {title}\n", "TOOL_CALL")
+            segments.append((f"🔧 Call: {title}\n", "TOOL_CALL"))
             if content:
                 try:
+                    if len(content) > PRETTY_JSON_MAX_CHARS: raise ValueError
                     parsed = json.loads(content)
                     pretty = json.dumps(parsed, indent=2, ensure_ascii=False)
-                    self.log_area.insert(tk.END, f"{pretty}\n", "TOOL_CALL")
+                    segments.append((f"{pretty}\n", "TOOL_CALL"))
                 except:
-                    self.log_area.insert(tk.END, f"{content}\n", "TOOL_CALL")
+                    segments.append((f"{content[:PRETTY_JSON_MAX_CHARS]}\n", "TOOL_CALL"))
         elif type == "tool_result":
             preview = content[:300] + "..." if len(content) > 300 else content
-            self.log_area.insert(tk.END, f"   ↳ Result: {preview}\n", "TOOL_RESULT")
+            segments.append((f"   ↳ Result: {preview}\n", "TOOL_RESULT"))
         elif type == "system":
-            self.log_area.insert(tk.END, f"⚙️ {title}\n", "SYSTEM")
+            segments.append((f"⚙️ {title}\n", "SYSTEM"))
         elif type == "success":
-            self.log_area.insert(tk.END, f"✅ DONE: {title}\n", "SUCCESS")
+            segments.append((f"✅ DONE: {title}\n", "SUCCESS"))
         elif type == "error":
-            self.log_area.insert(tk.END, f"❌ ERROR: {title}\n", "ERROR")
+            segments.append((f"❌ ERROR: {title}\n", "ERROR"))
+        elif type == "metrics":
+            segments.append((f"📊 {title}\n", "TOOL_RESULT"))
 
-        self.log_area.insert(tk.END, "-" * 40 + "\n", "TOOL_RESULT")
-        self.log_area.see(tk.END)
-        self.log_area.config(state='disabled')
+        segments.append((SEPARATOR, "TOOL_RESULT"))
 
     def trigger_key_check(self):
         asyncio.run_coroutine_threadsafe(self.check_key_callback(), self.loop)